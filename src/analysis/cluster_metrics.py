@@ -0,0 +1,48 @@
+import numpy as np
+from sklearn.metrics import pairwise_distances, silhouette_score
+
+from src.analysis.cluster_summary import ClusterSummary
+from src.utils.feature_store import iter_row_chunks
+
+
+def cluster_scores(data, labels, sample_rows=None):
+    """
+    Quality scores of a partition, computed in row chunks so the data is
+    never copied whole:
+
+    - inertia: sum of squared distances of the cells to their cluster mean
+    - davies_bouldin: mean over clusters of the worst (s_i + s_j) / d(c_i, c_j),
+      with s the mean distance to the cluster mean (lower is better)
+    - silhouette: silhouette score on sample_rows only (all cells when None),
+      since it needs all pairwise distances (higher is better)
+
+    Scores that are undefined for fewer than two clusters are NaN.
+    """
+    labels = np.asarray(labels)
+    summary = ClusterSummary(data, labels, range(data.shape[1]))
+    classes, counts, centers = summary.clusters, summary.counts, summary.means
+    n_classes = len(classes)
+
+    scatter = np.zeros(n_classes, dtype=np.float64)
+    inertia = 0.0
+    for start, chunk in iter_row_chunks(data):
+        chunk_inverse = np.searchsorted(classes, labels[start:start + len(chunk)])
+        distances = np.linalg.norm(np.asarray(chunk, dtype=np.float64) - centers[chunk_inverse], axis=1)
+        scatter += np.bincount(chunk_inverse, weights=distances, minlength=n_classes)
+        inertia += float(np.dot(distances, distances))
+    scatter /= counts
+
+    scores = {'inertia': inertia, 'davies_bouldin': np.nan, 'silhouette': np.nan}
+    if n_classes < 2:
+        return scores
+
+    center_distances = pairwise_distances(centers)
+    np.fill_diagonal(center_distances, np.inf)
+    ratios = (scatter[:, None] + scatter[None, :]) / center_distances
+    scores['davies_bouldin'] = float(np.mean(np.max(ratios, axis=1)))
+
+    rows = np.arange(len(labels)) if sample_rows is None else np.asarray(sample_rows)
+    sample_labels = labels[rows]
+    if 2 <= len(np.unique(sample_labels)) < len(rows):
+        scores['silhouette'] = float(silhouette_score(np.asarray(data[rows]), sample_labels))
+    return scores
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from src.utils.feature_store import DEFAULT_CHUNK_ROWS
+
+
+def _label_lookup(labels):
+    """
+    (clusters, index_of) for integer labels: the sorted distinct labels and a
+    function mapping a block of labels to their positions in clusters, so no
+    full-length inverse array is materialized.
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind in "iu" and len(labels):
+        low = int(labels.min())
+        present = np.bincount((labels - low).astype(np.intp)) > 0
+        positions = np.cumsum(present) - 1
+        return np.flatnonzero(present) + low, lambda block: positions[block - low]
+    clusters = np.unique(labels)
+    return clusters, lambda block: np.searchsorted(clusters, block)
+
+
+class ClusterSummary:
+    """
+    Per-cluster statistics of a labelled feature matrix, computed in one
+    chunked pass: cell counts, marker means and variances (ddof=1), and
+    per-file x per-cluster cell counts. Sums come from a sparse one-hot
+    product per chunk, so only one chunk of the matrix is converted at a
+    time and the cell matrix is never copied.
+    """
+
+    def __init__(self, data, labels, feature_names, file_slices=None, chunk_size=DEFAULT_CHUNK_ROWS):
+        labels = np.asarray(labels)
+        if data.shape[0] != len(labels):
+            raise ValueError("Feature data rows do not match label length")
+
+        self.features = list(feature_names)
+        self.clusters, index_of = _label_lookup(labels)
+        n_clusters, n_features = len(self.clusters), data.shape[1]
+
+        # Sums are taken around the first chunk's mean to keep the variance numerically stable
+        shift = np.asarray(data[:chunk_size], dtype=np.float64).mean(axis=0) if len(labels) else np.zeros(n_features)
+        sums = np.zeros((n_clusters, n_features))
+        squares = np.zeros((n_clusters, n_features))
+        counts = np.zeros(n_clusters, dtype=np.int64)
+        for start in range(0, len(labels), chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64) - shift
+            positions = index_of(labels[start:start + len(chunk)])
+            onehot = sp.csr_matrix((np.ones(len(chunk)), (np.arange(len(chunk)), positions)),
+                                   shape=(len(chunk), n_clusters))
+            sums += onehot.T @ chunk
+            chunk *= chunk
+            squares += onehot.T @ chunk
+            counts += np.bincount(positions, minlength=n_clusters)
+
+        self.counts = counts
+        with np.errstate(invalid="ignore", divide="ignore"):
+            centred = sums / counts[:, None]
+            self.means = centred + shift
+            self.variances = (squares - sums * centred) / (counts[:, None] - 1)
+        self.variances[counts < 2] = np.nan
+        np.maximum(self.variances, 0.0, out=self.variances)
+
+        # Files are contiguous row ranges, so their counts only need the labels
+        self.file_counts = {
+            file_id: np.bincount(index_of(labels[rows]), minlength=n_clusters)
+            for file_id, rows in (file_slices or {}).items()
+        }
+
+    def _frame(self, values):
+        return pd.DataFrame(values, index=pd.Index(self.clusters, name="cluster_label"), columns=self.features)
+
+    def means_df(self):
+        """Clusters x markers mean expression."""
+        return self._frame(self.means)
+
+    def variances_df(self):
+        """Clusters x markers variance (NaN for single-cell clusters)."""
+        return self._frame(self.variances)
+
+    def counts_series(self):
+        return pd.Series(self.counts, index=pd.Index(self.clusters, name="cluster_label"), name="n_cells")
+
+    def file_counts_df(self):
+        """Files x clusters cell counts."""
+        return pd.DataFrame.from_dict(self.file_counts, orient="index", columns=self.clusters).rename_axis(
+            index="_file_id", columns="cluster_label")
@@ -1,9 +1,26 @@
+import time
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances_argmin
+from scipy.optimize import linear_sum_assignment
+from threadpoolctl import threadpool_limits
 import warnings
+from src.analysis.preprocessing import PreprocessingCache
+from src.utils.feature_store import iter_row_chunks
+from src.utils.parallel import SharedArray, process_pool, resolve_cpu_budget, results_in_order, split_budget
+from src.utils.cancellation import checkpoint, uninterruptible
+from src.utils.checkpoints import CheckpointStore
+from src.utils.run_log import format_run_log
+from src.analysis.graph_clustering import jaccard_graph, detect_communities_restarts, relabel_by_size
+from src.analysis.knn_cache import KnnGraphCache
+from src.analysis.som import SomModel, train_som, map_to_nodes
+from src.analysis.cluster_metrics import cluster_scores
+from src.analysis.cluster_summary import ClusterSummary
+from src.analysis.result_cache import ResultCache
+from src.analysis.result_writer import ResultWriter
 
 # Try importing phenograph
 try:
@@ -19,38 +36,337 @@ try:
 except ImportError:
     FLOWSOM_AVAILABLE = False
 
+SWEEP_ALGORITHMS = ("kmeans", "flowsom")
+CONSENSUS_ALGORITHMS = ("kmeans", "minibatch_kmeans", "graph_clustering", "flowsom")
+SUBSAMPLE_ALGORITHMS = ("kmeans", "minibatch_kmeans", "graph_clustering", "phenograph", "flowsom")
+EXTEND_METHODS = ("centroid", "knn")
+EXECUTION_PARAMS = ("n_jobs",)  # parameters that change how a run is executed, not its labels
+
+def _kmeans_restart(shared, n_clusters, max_iter, seed):
+    """One KMeans restart in a worker process; returns centers, not labels, to keep results small."""
+    start = time.perf_counter()
+    data = shared.open()
+    kmeans = KMeans(n_clusters=n_clusters, max_iter=max_iter, random_state=seed, n_init=1).fit(data)
+    return {
+        'seed': int(seed),
+        'inertia': float(kmeans.inertia_),
+        'n_iter': int(kmeans.n_iter_),
+        'seconds': time.perf_counter() - start,
+        'centers': kmeans.cluster_centers_,
+    }
+
+
+def _kmeans_sweep_point(data, n_clusters, max_iter, n_init, seed, sample_rows):
+    start = time.perf_counter()
+    kmeans = KMeans(n_clusters=n_clusters, max_iter=max_iter, random_state=seed, n_init=n_init).fit(data)
+    scores = cluster_scores(data, kmeans.labels_, sample_rows)
+    return {'n_clusters': int(n_clusters), **scores, 'n_iter': int(kmeans.n_iter_),
+            'seconds': time.perf_counter() - start, 'centers': kmeans.cluster_centers_}
+
+
+def _kmeans_sweep_worker(shared, n_clusters, max_iter, n_init, seed, sample_rows):
+    return _kmeans_sweep_point(shared.open(), n_clusters, max_iter, n_init, seed, sample_rows)
+
+
+def _seeded_run_worker(shared, algorithm, params, feature_names):
+    # One seed of run_consensus in a worker process: fit the shared matrix with a throwaway manager
+    # that has no data loader, only the names of the matrix columns
+    start = time.perf_counter()
+    manager = ClusterManager(None)
+    manager.markers = feature_names
+    with manager._fitting_on(shared.open(), None):
+        labels = getattr(manager, f"run_{algorithm}")(**params)
+    return labels, time.perf_counter() - start
+
+
+def _contingency(reference, labels, n_reference):
+    # (reference cluster x cluster) cell counts of two 0-based labellings, from one bincount
+    n_labels = int(labels.max()) + 1
+    return np.bincount(reference.astype(np.int64) * n_labels + labels,
+                       minlength=n_reference * n_labels).reshape(n_reference, n_labels)
+
+
+def _align_labels(reference, labels, n_reference):
+    """
+    Map the clusters of labels (0-based) onto the reference clusters with the
+    Hungarian algorithm on their contingency table. Clusters left unmatched
+    get ids from n_reference upwards.
+    """
+    ref_idx, label_idx = linear_sum_assignment(_contingency(reference, labels, n_reference), maximize=True)
+    mapping = np.full(int(labels.max()) + 1, -1, dtype=np.int64)
+    mapping[label_idx] = ref_idx
+    unmatched = mapping < 0
+    mapping[unmatched] = n_reference + np.arange(int(unmatched.sum()))
+    return mapping[labels]
+
+
+def _matched_jaccard(reference, labels, n_reference):
+    # Jaccard overlap of every reference cluster with its best-matched cluster in labels
+    table = _contingency(reference, labels, n_reference)
+    ref_idx, label_idx = linear_sum_assignment(table, maximize=True)
+    jaccard = np.zeros(n_reference)
+    overlap = table[ref_idx, label_idx]
+    union = table.sum(axis=1)[ref_idx] + table.sum(axis=0)[label_idx] - overlap
+    jaccard[ref_idx] = overlap / np.maximum(union, 1)
+    return jaccard
+
+
 class ClusterManager:
-    def __init__(self, data_loader):
+    def __init__(self, data_loader, preprocessing_cache=None, knn_cache=None):
         self.data_loader = data_loader
         self.labels = None
         self.scaled_data = None
         self.cluster_centers = None
+        self.transform = None  # optional ArcsinhTransform applied before scaling
+        self.markers = None  # optional subset of feature columns to cluster on (None = all)
+        self.preprocessing_cache = preprocessing_cache if preprocessing_cache is not None else PreprocessingCache()
+        self._scaled_key = None
+        self._fingerprint = None
+        self.knn_cache = knn_cache if knn_cache is not None else KnnGraphCache()
+        self.som = None  # last native FlowSOM model, reused while data and SOM parameters are unchanged
+        self.run_log = []  # timed stages of the last run: dicts with 'stage', 'seconds' and stage details
+        self._fit_data = None  # (matrix, fingerprint) overriding the scaled data during a subsample fit
+        self.sweep = None  # last n_clusters sweep: {'key', 'table', 'centers' (KMeans, per n_clusters)}
+        self.stability = None  # per-cluster stability table of the last consensus run
+        self.cell_agreement = None  # per-cell fraction of seeds agreeing with the consensus label
+        self._summary = None  # (labels, loader version, ClusterSummary) of the last summarized labelling
+        self.result_cache = ResultCache()
+
+    def _preprocess_key(self):
+        markers = tuple(self.markers) if self.markers else None
+        return (self.data_loader.version, self.transform, markers)
 
     def preprocess(self):
-        """Standardize the data before clustering"""
-        data = self.data_loader.get_feature_data()
-        if data is None:
-            raise ValueError("No data loaded")
-        
-        scaler = StandardScaler()
-        self.scaled_data = scaler.fit_transform(data)
+        """
+        Standardize the data before clustering (after the optional marker
+        selection and transform). The scaled matrix comes from the shared
+        preprocessing cache, so it is computed once per dataset and settings
+        and shared read-only with DimReductionManager. Scaling runs in row
+        chunks; when the loader spills to disk the scaled matrix is
+        memory-mapped as well.
+        """
+        key = self._preprocess_key()
+        self.scaled_data, self._fingerprint = self.preprocessing_cache.scaled(self.data_loader, key[1], key[2])
+        self._scaled_key = key
         return self.scaled_data
 
-    def run_kmeans(self, n_clusters=10, max_iter=300, random_state=42):
-        if self.scaled_data is None:
+    def _ensure_scaled(self):
+        # Matrix the algorithms fit on: a subsample while run_subsampled is fitting, otherwise
+        # the full scaled data, rescaled when the loaded data, markers or transform changed
+        if self._fit_data is not None:
+            return self._fit_data[0]
+        if self.scaled_data is None or self._scaled_key != self._preprocess_key():
             self.preprocess()
-            
-        kmeans = KMeans(n_clusters=n_clusters, max_iter=max_iter, random_state=random_state, n_init=10)
-        self.labels = kmeans.fit_predict(self.scaled_data) + 1 # Start from 1
-        self.cluster_centers = kmeans.cluster_centers_
+        return self.scaled_data
+
+    def _feature_names(self):
+        # Column names of the matrix being clustered (the marker selection, else all feature columns)
+        if self.markers:
+            return list(self.markers)
+        return list(self.data_loader.feature_columns or []) if self.data_loader is not None else None
+
+    def _data_fingerprint(self):
+        # Identifies the matrix being fitted (dataset content, markers, transform, subsample)
+        if self._fit_data is not None:
+            return self._fit_data[1]
+        return self._fingerprint
+
+    @contextmanager
+    def _fitting_on(self, data, fingerprint):
+        # Point the run_* methods at another matrix (a subsample) for the duration of one fit
+        previous = self._fit_data
+        self._fit_data = (data, fingerprint)
+        try:
+            yield
+        finally:
+            self._fit_data = previous
+
+    def run_kmeans(self, n_clusters=10, max_iter=300, random_state=42, n_init=10, n_jobs=None):
+        """
+        KMeans with n_init restarts, keeping the lowest inertia.
+
+        With n_jobs=None the restarts run one after another in this process
+        with scikit-learn's default threading. Any other value is a core
+        budget (0 = all cores, negative counts back from the total): the
+        restarts then run concurrently in worker processes, each capped at its
+        share of BLAS/OpenMP threads so the budget is never oversubscribed.
+        Both draw the same restart seeds, so n_jobs does not change the labels.
+        Restart timings are recorded in run_log.
+        """
+        data = self._ensure_scaled()
+        self.run_log = []
+
+        budget = resolve_cpu_budget(n_jobs) if n_jobs is not None else None
+        n_init = max(1, int(n_init))
+        seeds = np.random.default_rng(random_state).integers(0, np.iinfo(np.int32).max, size=n_init)
+        workers, threads = split_budget(n_init, budget) if budget is not None else (1, None)
+
+        # Finished restarts are checkpointed, so a stopped run only redoes the unfinished ones
+        store = self._checkpoint_store()
+        checkpoint_key = store.key("kmeans", self._data_fingerprint(), n_clusters, max_iter, random_state, n_init)
+        restarts = self._load_restarts(store, checkpoint_key, seeds)
+        pending = [i for i in range(n_init) if i not in restarts]
+
+        def finish(i, record):
+            restarts[i] = record
+            done = sorted(restarts)
+            store.save("kmeans", checkpoint_key, index=np.array(done),
+                       **{name: np.array([restarts[j][name] for j in done])
+                          for name in ('seed', 'inertia', 'n_iter', 'seconds', 'centers')})
+
+        if workers == 1 or len(pending) <= 1:
+            # Nothing to run concurrently: fit in-process with the whole budget (no limit for n_jobs=None)
+            with threadpool_limits(limits=budget):
+                for i in pending:
+                    checkpoint()
+                    start = time.perf_counter()
+                    kmeans = KMeans(n_clusters=n_clusters, max_iter=max_iter, random_state=seeds[i], n_init=1).fit(data)
+                    finish(i, {'seed': int(seeds[i]), 'inertia': float(kmeans.inertia_), 'n_iter': int(kmeans.n_iter_),
+                               'seconds': time.perf_counter() - start, 'centers': kmeans.cluster_centers_})
+        else:
+            shared = SharedArray.from_array(data, spill_dir=self.data_loader.spill_dir)
+            try:
+                with process_pool(min(workers, len(pending)), threads) as pool:
+                    futures = [pool.submit(_kmeans_restart, shared, n_clusters, max_iter, seeds[i]) for i in pending]
+                    for i, record in zip(pending, results_in_order(pool, futures)):
+                        finish(i, record)
+            finally:
+                shared.release()
+        store.clear("kmeans", checkpoint_key)
+
+        self.run_log = [{'stage': f"Restart {i + 1}", **restarts[i]} for i in range(n_init)]
+        best = min(self.run_log, key=lambda r: r['inertia'])
+        self.cluster_centers = best['centers']
+        for record in self.run_log:
+            del record['centers']
+
+        # Labels of the best restart
+        self.labels = self._assign_to_centers(data, self.cluster_centers, budget) + 1 # Start from 1
         return self.labels
 
+    def _checkpoint_store(self):
+        # Checkpoints live next to the loaded folder; matrices without a fingerprint
+        # (a throwaway manager in a worker process) are never checkpointed
+        directory = getattr(self.data_loader, 'directory', None)
+        return CheckpointStore(directory if self._data_fingerprint() is not None else None)
+
+    @staticmethod
+    def _load_restarts(store, checkpoint_key, seeds):
+        # Restart records saved by an interrupted run_kmeans, by restart index
+        saved = store.load("kmeans", checkpoint_key)
+        if saved is None:
+            return {}
+        restarts = {}
+        for j, i in enumerate(saved['index'].tolist()):
+            if i < len(seeds) and int(saved['seed'][j]) == int(seeds[i]):
+                restarts[i] = {'seed': int(saved['seed'][j]), 'inertia': float(saved['inertia'][j]),
+                               'n_iter': int(saved['n_iter'][j]), 'seconds': float(saved['seconds'][j]),
+                               'centers': saved['centers'][j], 'resumed': True}
+        return restarts
+
+    @staticmethod
+    def _assign_to_centers(data, centers, budget):
+        # Nearest center of every cell, assigned chunk by chunk
+        labels = np.empty(data.shape[0], dtype=np.int32)
+        with threadpool_limits(limits=budget):
+            for start, chunk in iter_row_chunks(data):
+                labels[start:start + len(chunk)] = pairwise_distances_argmin(np.asarray(chunk), centers)
+        return labels
+
+    def run_minibatch_kmeans(self, n_clusters=10, batch_size=4096, max_iter=20, tol=1e-4, random_state=42):
+        """
+        Mini-batch KMeans that streams the scaled matrix in batch_size row
+        blocks (visited in random order each pass), so memory stays bounded and
+        a memory-mapped matrix is read sequentially.
+
+        max_iter is the maximum number of passes over the data; training stops
+        early once the squared center shift of a pass, relative to the total
+        variance of the data, falls below tol. Labels are assigned in chunks.
+        """
+        data = self._ensure_scaled()
+        self.run_log = []
+        n = data.shape[0]
+        batch_size = max(int(batch_size), int(n_clusters))
+        rng = np.random.default_rng(random_state)
+
+        model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state, n_init=1)
+        # Initialize from a random sample larger than one batch (k-means++ on init_size rows)
+        init_size = min(n, max(3 * batch_size, 3 * int(n_clusters)))
+        init_idx = np.sort(rng.choice(n, size=init_size, replace=False))
+        model.partial_fit(np.asarray(data[init_idx]))
+
+        total_var = float(np.sum(np.var(data[init_idx], axis=0))) or 1.0
+        starts = np.arange(0, n, batch_size)
+        for _ in range(int(max_iter)):
+            previous = model.cluster_centers_.copy()
+            for start in rng.permutation(starts):
+                checkpoint()
+                model.partial_fit(np.asarray(data[start:start + batch_size]))
+            shift = float(np.sum((model.cluster_centers_ - previous) ** 2)) / total_var
+            if shift < tol:
+                break
+
+        labels = np.empty(n, dtype=np.int32)
+        for start, chunk in iter_row_chunks(data):
+            labels[start:start + len(chunk)] = model.predict(np.asarray(chunk))
+        self.labels = labels + 1 # Start from 1
+        self.cluster_centers = model.cluster_centers_
+        return self.labels
+
+    def run_graph_clustering(self, k=30, metric='euclidean', method='leiden', resolution=1.0,
+                             n_restarts=1, random_state=42, n_jobs=0):
+        """
+        Built-in Phenograph-style clustering that needs no phenograph install:
+        approximate kNN graph (NN-descent, taken from the shared kNN cache
+        when available), Jaccard reweighting of the kNN edges, then Leiden or
+        Louvain community detection.
+
+        n_jobs is the core budget (0 = all cores). Graph construction runs
+        multithreaded; community detection runs n_restarts seeds concurrently
+        in worker processes and keeps the partition with the highest
+        modularity. A single igraph run is single-threaded, so with the
+        default n_restarts=1 community detection uses one core whatever the
+        budget. Each stage is timed in run_log.
+        """
+        data = self._ensure_scaled()
+        self.run_log = []
+        budget = resolve_cpu_budget(n_jobs)
+        k = int(k)
+
+        start = time.perf_counter()
+        indices, _, cached = self.knn_cache.get_or_build(
+            data, k, metric, fingerprint=self._data_fingerprint(),
+            cache_dir=KnnGraphCache.cache_dir_for(self.data_loader.directory),
+            n_jobs=budget, random_state=random_state)
+        self.run_log.append({'stage': "kNN graph", 'k': k, 'cached': cached, 'seconds': time.perf_counter() - start})
+
+        checkpoint()
+        start = time.perf_counter()
+        graph = jaccard_graph(indices, n_jobs=budget)
+        self.run_log.append({'stage': "Jaccard weights", 'edges': int(graph.nnz // 2), 'seconds': time.perf_counter() - start})
+
+        checkpoint()
+        start = time.perf_counter()
+        seeds = np.random.default_rng(random_state).integers(0, np.iinfo(np.int32).max, size=max(1, int(n_restarts)))
+        membership, qualities = detect_communities_restarts(graph, method=method, resolution=resolution, seeds=seeds,
+                                                           budget=budget, spill_dir=self.data_loader.spill_dir)
+        self.run_log.append({'stage': f"Community detection ({method})", 'restarts': len(qualities),
+                             'modularity': max(q for _, q in qualities), 'seconds': time.perf_counter() - start})
+
+        self.labels = relabel_by_size(membership) + 1 # Start from 1
+        self.cluster_centers = None
+        return self.labels
+
+    def format_run_log(self):
+        """One line per timed stage of the last run, for the GUI log."""
+        return format_run_log(self.run_log)
+
     def run_phenograph(self, k=30, metric='euclidean', random_state=None):
         if not PHENOGRAPH_AVAILABLE:
             raise ImportError("Phenograph is not installed. Please install it to use this feature.")
             
-        if self.scaled_data is None:
-            self.preprocess()
+        data = self._ensure_scaled()
+        self.run_log = []
 
         # Phenograph implementation
         # Note: phenograph.cluster returns (communities, graph, Q)
@@ -59,63 +375,480 @@ class ClusterManager:
         if random_state is not None:
             np.random.seed(random_state)
             
-        communities, _, _ = phenograph.cluster(self.scaled_data, k=k, metric=metric)
+        with uninterruptible("Phenograph"):
+            communities, _, _ = phenograph.cluster(data, k=k, metric=metric)
         self.labels = communities + 1 # Start from 1
         return self.labels
 
-    def run_flowsom(self, n_clusters=10, xdim=10, ydim=10, rlen=10, seed=None):
+    def run_flowsom(self, n_clusters=10, xdim=10, ydim=10, rlen=10, seed=None, engine='native'):
+        """
+        FlowSOM: self-organizing map over all cells, then consensus
+        metaclustering of the map nodes into n_clusters.
+
+        engine='native' (default) uses the in-tree batch SOM (src.analysis.som),
+        which works on the scaled matrix in chunks without copying it and
+        needs neither flowsom nor anndata. engine='flowsom' runs the external
+        flowsom package.
+        """
+        seed = None if seed in (None, "") else int(seed)
+        if engine == 'native':
+            return self._run_native_flowsom(int(n_clusters), int(xdim), int(ydim), int(rlen), seed)
+        if engine != 'flowsom':
+            raise ValueError(f"Unknown FlowSOM engine: {engine}")
         if not FLOWSOM_AVAILABLE:
             raise ImportError("flowsom is not installed. Please install it to use this feature.")
 
-        if self.scaled_data is None:
-            self.preprocess()
+        data = self._ensure_scaled()
+        self.run_log = []
 
-        adata = ad.AnnData(self.scaled_data)
-        feature_data = self.data_loader.get_feature_data()
-        if feature_data is not None:
-            try:
-                adata.var_names = feature_data.columns.astype(str)
-            except Exception:
-                pass
+        adata = ad.AnnData(data)
+        feature_names = self._feature_names()
+        if feature_names and len(feature_names) == data.shape[1]:
+            adata.var_names = [str(name) for name in feature_names]
 
-        FlowSOM(adata, n_clusters=int(n_clusters), xdim=int(xdim), ydim=int(ydim), rlen=int(rlen), seed=None if seed in (None, "") else int(seed))
+        with uninterruptible("FlowSOM (flowsom package)"):
+            FlowSOM(adata, n_clusters=int(n_clusters), xdim=int(xdim), ydim=int(ydim), rlen=int(rlen), seed=seed)
         if "metaclustering" not in adata.obs:
             raise RuntimeError("FlowSOM did not produce metaclustering labels.")
 
         self.labels = adata.obs["metaclustering"].to_numpy() + 1
         return self.labels
 
+    def _run_native_flowsom(self, n_clusters, xdim, ydim, rlen, seed):
+        self.run_log = []
+        self._fit_som(xdim, ydim, rlen, seed)
+        return self.remetacluster(n_clusters)
+
+    def _fit_som(self, xdim, ydim, rlen, seed):
+        # Train the SOM and map all cells to it, unless the kept one already matches
+        data = self._ensure_scaled()
+        key = (self._data_fingerprint(), xdim, ydim, rlen, seed)
+
+        if self.som is not None and self.som.key == key and len(self.som.nodes) == len(data):
+            self.run_log.append({'stage': "SOM reused", 'nodes': xdim * ydim, 'seconds': 0.0})
+        else:
+            start = time.perf_counter()
+            store = self._checkpoint_store()
+            checkpoint_key = store.key(*key)
+            saved = store.load("som", checkpoint_key)
+            state = (int(saved['epoch']), saved['codebook']) if saved is not None else None
+            codebook = train_som(data, xdim=xdim, ydim=ydim, rlen=rlen, seed=seed, state=state,
+                                 on_epoch=lambda epoch, cb: store.save("som", checkpoint_key, epoch=epoch, codebook=cb))
+            store.clear("som", checkpoint_key)
+            record = {'stage': "SOM training", 'nodes': xdim * ydim, 'epochs': rlen}
+            if state is not None:
+                record['resumed_at_epoch'] = state[0]
+            self.run_log.append({**record, 'seconds': time.perf_counter() - start})
+
+            start = time.perf_counter()
+            self.som = SomModel(codebook, map_to_nodes(data, codebook), key, seed=seed)
+            self.run_log.append({'stage': "Node assignment", 'seconds': time.perf_counter() - start})
+        return self.som
+
+    def remetacluster(self, n_clusters):
+        """
+        Relabel all cells for another number of metaclusters using the SOM
+        from the last native FlowSOM run (no retraining, no pass over the
+        data beyond a node -> metacluster lookup).
+        """
+        if self.som is None:
+            raise ValueError("No trained SOM available; run FlowSOM first")
+        if len(self.som.nodes) != len(self._ensure_scaled()):
+            raise ValueError("The trained SOM does not match the current data; run FlowSOM again")
+
+        start = time.perf_counter()
+        self.labels = self.som.labels(n_clusters) + 1 # Start from 1
+        self.run_log.append({'stage': "Consensus metaclustering", 'n_clusters': int(n_clusters),
+                             'seconds': time.perf_counter() - start})
+        return self.labels
+
+    def run_consensus(self, algorithm, n_seeds=10, params=None, n_jobs=0):
+        """
+        Multi-seed consensus clustering. run_<algorithm>(**params) is repeated
+        with n_seeds seeds derived from the algorithm's own seed; KMeans,
+        mini-batch KMeans and FlowSOM seeds run concurrently in worker
+        processes over one shared copy of the scaled matrix (core budget
+        n_jobs), graph clustering runs them in turn on the cached kNN graph.
+
+        Every run is aligned to the first one by the Hungarian algorithm on
+        their contingency table, each cell gets the label most runs agree on,
+        and each consensus cluster is scored by the Jaccard overlap with its
+        matched cluster in every run. Nothing larger than n_cells x n_seeds
+        labels is held, never an n x n co-occurrence matrix.
+
+        Sets labels, stability (DataFrame per cluster: n_cells, stability
+        mean/min Jaccard, mean cell agreement) and cell_agreement.
+        """
+        if algorithm not in CONSENSUS_ALGORITHMS:
+            raise ValueError(f"Consensus clustering is not available for {algorithm}")
+        params = dict(params or {})
+        seed_param = 'seed' if algorithm == 'flowsom' else 'random_state'
+        base_seed = params.get(seed_param, 42)
+        seeds = np.random.default_rng(None if base_seed in (None, "") else int(base_seed)).integers(
+            0, np.iinfo(np.int32).max, size=max(2, int(n_seeds)))
+
+        data = self._ensure_scaled()
+        n_rows = data.shape[0]
+        budget = resolve_cpu_budget(n_jobs)
+        run_log = []
+        aligned = np.empty((n_rows, len(seeds)), dtype=np.int32)
+        reference = None
+        n_reference = 0
+
+        def collect(i, seed, labels, seconds):
+            nonlocal reference, n_reference
+            labels = np.unique(labels, return_inverse=True)[1].ravel()  # 0-based, consecutive
+            if reference is None:
+                reference, n_reference = labels, int(labels.max()) + 1
+                aligned[:, i] = labels
+            else:
+                aligned[:, i] = _align_labels(reference, labels, n_reference)
+            run_log.append({'stage': f"Seed {i + 1}", 'seed': int(seed), 'clusters': int(labels.max()) + 1,
+                            'seconds': seconds})
+
+        workers, threads = split_budget(len(seeds), budget)
+        if algorithm == 'graph_clustering' or workers == 1:
+            if algorithm in ('kmeans', 'graph_clustering'):
+                params['n_jobs'] = budget if algorithm == 'graph_clustering' else None
+            # Seeded FlowSOM runs replace the kept SOM; the one from before the consensus is restored
+            previous_som = self.som
+            try:
+                for i, seed in enumerate(seeds):
+                    checkpoint()
+                    start = time.perf_counter()
+                    with threadpool_limits(limits=budget):
+                        labels = getattr(self, f"run_{algorithm}")(**{**params, seed_param: int(seed)})
+                    collect(i, seed, labels, time.perf_counter() - start)
+            finally:
+                self.som = previous_som
+        else:
+            if algorithm == 'kmeans':
+                params['n_jobs'] = None  # restarts stay inside each worker
+            shared = SharedArray.from_array(data, spill_dir=self.data_loader.spill_dir)
+            try:
+                with process_pool(workers, threads) as pool:
+                    futures = [pool.submit(_seeded_run_worker, shared, algorithm, {**params, seed_param: int(seed)},
+                                           self._feature_names())
+                               for seed in seeds]
+                    for i, (seed, result) in enumerate(zip(seeds, results_in_order(pool, futures))):
+                        collect(i, seed, *result)
+            finally:
+                shared.release()
+
+        start = time.perf_counter()
+        n_labels = int(aligned.max()) + 1
+        consensus = np.empty(n_rows, dtype=np.int32)
+        agreement = np.empty(n_rows, dtype=np.float32)
+        for row in range(0, n_rows, 65536):
+            block = aligned[row:row + 65536]
+            votes = np.zeros((len(block), n_labels), dtype=np.int32)
+            np.add.at(votes, (np.arange(len(block))[:, None], block), 1)
+            consensus[row:row + len(block)] = np.argmax(votes, axis=1)
+            agreement[row:row + len(block)] = votes.max(axis=1) / len(seeds)
+        consensus = relabel_by_size(consensus)
+
+        n_clusters = int(consensus.max()) + 1
+        jaccard = np.column_stack([_matched_jaccard(consensus, np.unique(aligned[:, i], return_inverse=True)[1].ravel(),
+                                                    n_clusters) for i in range(len(seeds))])
+        counts = np.bincount(consensus, minlength=n_clusters)
+        self.stability = pd.DataFrame({
+            'n_cells': counts,
+            'stability_mean': jaccard.mean(axis=1),
+            'stability_min': jaccard.min(axis=1),
+            'agreement_mean': np.bincount(consensus, weights=agreement, minlength=n_clusters) / np.maximum(counts, 1),
+        }, index=pd.Index(np.arange(1, n_clusters + 1), name="cluster_label"))
+        run_log.append({'stage': "Consensus", 'seeds': len(seeds), 'clusters': n_clusters,
+                        'stability': float(np.average(self.stability['stability_mean'], weights=counts)),
+                        'seconds': time.perf_counter() - start})
+
+        self.run_log = run_log
+        self.labels = consensus + 1 # Start from 1
+        self.cell_agreement = agreement
+        self.cluster_centers = None
+        return self.labels
+
+    def save_cluster_stability(self, output_dir, filename="cluster_stability.csv"):
+        if self.stability is None:
+            raise ValueError("No consensus clustering results to save")
+        out_path = Path(output_dir)
+        out_path.mkdir(parents=True, exist_ok=True)
+        output_path = out_path / filename
+        self.stability.to_csv(output_path, index=True)
+        return str(output_path)
+
+    def _sweep_key(self, algorithm, params):
+        # Settings a sweep result depends on; n_clusters varies and n_jobs does not change the fit
+        settings = tuple(sorted((k, v) for k, v in params.items() if k not in ('n_clusters', 'n_jobs')))
+        return (self._data_fingerprint(), algorithm, settings)
+
+    def sweep_n_clusters(self, n_clusters_values, algorithm='kmeans', params=None, n_jobs=0,
+                         silhouette_cells=10000, seed=42):
+        """
+        Fit every number of clusters in n_clusters_values and score each
+        partition (see cluster_metrics.cluster_scores): inertia,
+        Davies-Bouldin on all cells and silhouette on a file-stratified
+        subsample of silhouette_cells. params are the run_<algorithm>
+        settings other than n_clusters.
+
+        KMeans fits run concurrently in worker processes (core budget
+        n_jobs, 0 = all cores) over one shared copy of the scaled matrix.
+        FlowSOM trains (or reuses) one SOM and only metaclusters it per value.
+
+        Returns a DataFrame with one row per n_clusters, also kept in
+        self.sweep. Labels are left unchanged; apply_sweep_result (or the
+        usual run_*) produces them for the chosen value.
+        """
+        if algorithm not in SWEEP_ALGORITHMS:
+            raise ValueError(f"Cluster-count sweep is not available for {algorithm}")
+        params = {k: v for k, v in (params or {}).items() if k not in ('n_clusters', 'n_jobs')}
+        values = sorted({int(v) for v in n_clusters_values})
+        if not values or values[0] < 2:
+            raise ValueError("Sweep needs numbers of clusters of at least 2")
+
+        data = self._ensure_scaled()
+        n_rows = data.shape[0]
+        sample_rows = self._stratified_sample(n_rows, int(silhouette_cells), seed) if silhouette_cells < n_rows else None
+        budget = resolve_cpu_budget(n_jobs)
+        records = []
+
+        if algorithm == 'kmeans':
+            fit_args = (int(params.get('max_iter', 300)), int(params.get('n_init', 10)), params.get('random_state', 42))
+            workers, threads = split_budget(len(values), budget)
+            self.run_log = []
+            if workers == 1:
+                with threadpool_limits(limits=budget):
+                    for k in values:
+                        checkpoint()
+                        records.append(_kmeans_sweep_point(data, k, *fit_args, sample_rows))
+            else:
+                shared = SharedArray.from_array(data, spill_dir=self.data_loader.spill_dir)
+                try:
+                    with process_pool(workers, threads) as pool:
+                        futures = [pool.submit(_kmeans_sweep_worker, shared, k, *fit_args, sample_rows) for k in values]
+                        records = list(results_in_order(pool, futures))
+                finally:
+                    shared.release()
+        else:
+            if params.get('engine', 'native') != 'native':
+                raise ValueError("Cluster-count sweep needs the native FlowSOM engine")
+            self.run_log = []
+            seed = params.get('seed')
+            self._fit_som(int(params.get('xdim', 10)), int(params.get('ydim', 10)), int(params.get('rlen', 10)),
+                          None if seed in (None, "") else int(seed))
+            for k in values:
+                start = time.perf_counter()
+                scores = cluster_scores(data, self.som.labels(k), sample_rows)
+                records.append({'n_clusters': k, **scores, 'seconds': time.perf_counter() - start})
+
+        centers = {record['n_clusters']: record.pop('centers') for record in records if 'centers' in record}
+        for record in records:
+            self.run_log.append({'stage': f"n_clusters={record['n_clusters']}",
+                                 **{k: v for k, v in record.items() if k != 'n_clusters'}})
+        table = pd.DataFrame(records).set_index('n_clusters')
+        self.sweep = {'key': self._sweep_key(algorithm, params), 'table': table, 'centers': centers}
+        return table
+
+    def apply_sweep_result(self, algorithm, params):
+        """
+        Set KMeans labels for params['n_clusters'] from the centers of the
+        last sweep when it covered the same data and settings. Returns False,
+        leaving the labels untouched, when a regular run is needed (FlowSOM
+        needs none: run_flowsom already reuses the swept SOM).
+        """
+        if algorithm != 'kmeans' or self.sweep is None or self.sweep['key'] != self._sweep_key(algorithm, params):
+            return False
+        n_clusters = int(params.get('n_clusters', 10))
+        if n_clusters not in self.sweep['table'].index:
+            return False
+
+        self.run_log = []
+        start = time.perf_counter()
+        self.cluster_centers = self.sweep['centers'][n_clusters]
+        self.labels = self._assign_to_centers(self._ensure_scaled(), self.cluster_centers,
+                                              resolve_cpu_budget(0)) + 1 # Start from 1
+        self.run_log.append({'stage': "Sweep result reused", 'n_clusters': n_clusters,
+                             'seconds': time.perf_counter() - start})
+        return True
+
+    def _stratified_sample(self, n_rows, n_cells, seed):
+        """
+        Sorted row indices of a seeded subsample of about n_cells rows, drawn
+        from every file in proportion to its size (at least one cell per
+        non-empty file).
+        """
+        slices = list(self.data_loader.file_slices.values()) or [slice(0, n_rows)]
+        sizes = np.array([s.stop - s.start for s in slices])
+        quotas = np.minimum(sizes, np.maximum(1, np.round(n_cells * sizes / n_rows)).astype(int))
+        rng = np.random.default_rng(seed)
+        parts = [s.start + rng.choice(size, size=quota, replace=False)
+                 for s, size, quota in zip(slices, sizes, quotas)]
+        return np.sort(np.concatenate(parts))
+
+    def run_subsampled(self, algorithm, n_cells=100000, extend='centroid', k=15, seed=42, params=None):
+        """
+        Subsample-and-extend: run one of the clustering algorithms (see
+        SUBSAMPLE_ALGORITHMS; params are passed to its run_* method) on a
+        seeded subsample of n_cells stratified by file, then label every cell
+        from the subsample clusters. extend='centroid' assigns each cell to
+        the nearest subsample cluster mean; extend='knn' takes a majority
+        vote over its k nearest subsample cells (approximate kNN index).
+        Native FlowSOM is always extended through its SOM nodes, so
+        remetacluster keeps working on all cells.
+
+        Subsampled cells keep their own labels. Labels cover every cell, so
+        get_results_df, save_results and the heatmap work as after a full run.
+        When n_cells covers the data the algorithm runs on all cells.
+        """
+        if algorithm not in SUBSAMPLE_ALGORITHMS:
+            raise ValueError(f"Unknown clustering algorithm: {algorithm}")
+        if extend not in EXTEND_METHODS:
+            raise ValueError(f"Unknown label extension method: {extend}")
+        params = dict(params or {})
+        fit = getattr(self, f"run_{algorithm}")
+
+        data = self._ensure_scaled()
+        n_rows = data.shape[0]
+        n_cells = int(n_cells)
+        if n_cells >= n_rows:
+            return fit(**params)
+
+        start = time.perf_counter()
+        rows = self._stratified_sample(n_rows, n_cells, seed)
+        sample = np.asarray(data[rows])
+        sample_log = {'stage': "Subsample", 'cells': len(rows), 'of': n_rows, 'seconds': time.perf_counter() - start}
+
+        with self._fitting_on(sample, f"{self._data_fingerprint()}-sub{len(rows)}-{seed}"):
+            fit(**params)
+        sample_labels = self.labels
+        self.run_log = [sample_log] + self.run_log
+
+        start = time.perf_counter()
+        native_som = (algorithm == 'flowsom' and params.get('engine', 'native') == 'native'
+                      and self.som is not None and len(self.som.nodes) == len(rows))
+        if native_som:
+            self.som.nodes = map_to_nodes(data, self.som.codebook)
+            labels = self.som.labels(params.get('n_clusters', 10)) + 1 # Start from 1
+            method = "SOM nodes"
+        elif extend == 'knn':
+            labels = self._extend_knn(data, sample, sample_labels, int(k), seed)
+            method = f"kNN vote, k={int(k)}"
+        else:
+            labels = self._extend_centroid(data, sample, sample_labels)
+            method = "nearest centroid"
+        labels[rows] = sample_labels
+        self.labels = labels
+        self.run_log.append({'stage': "Label extension", 'method': method, 'cells': n_rows,
+                             'seconds': time.perf_counter() - start})
+        return self.labels
+
+    @staticmethod
+    def _extend_centroid(data, sample, sample_labels):
+        # Nearest subsample-cluster mean, chunk by chunk over all cells
+        summary = ClusterSummary(sample, sample_labels, range(sample.shape[1]))
+        classes, centers = summary.clusters, summary.means
+        labels = np.empty(data.shape[0], dtype=np.asarray(sample_labels).dtype)
+        for start, chunk in iter_row_chunks(data):
+            labels[start:start + len(chunk)] = classes[pairwise_distances_argmin(np.asarray(chunk), centers)]
+        return labels
+
+    @staticmethod
+    def _extend_knn(data, sample, sample_labels, k, seed):
+        # Majority label of the k nearest subsample cells, queried chunk by chunk
+        from pynndescent import NNDescent
+
+        classes, inverse = np.unique(sample_labels, return_inverse=True)
+        k = max(1, min(k, len(sample) - 1))
+        with uninterruptible("kNN index construction"):
+            index = NNDescent(sample, n_neighbors=max(k, 2), random_state=seed, n_jobs=-1, low_memory=True)
+            index.prepare()
+        labels = np.empty(data.shape[0], dtype=classes.dtype)
+        for start, chunk in iter_row_chunks(data):
+            neighbours, _ = index.query(np.asarray(chunk), k=k)
+            votes = np.zeros((len(chunk), len(classes)), dtype=np.int32)
+            np.add.at(votes, (np.arange(len(chunk))[:, None], inverse[neighbours]), 1)
+            labels[start:start + len(chunk)] = classes[np.argmax(votes, axis=1)]
+        return labels
+
+    def result_key(self, algorithm, params, mode=None):
+        """
+        Result cache key of running run_<algorithm>(**params) on the loaded
+        data with the current transform and markers. mode holds any other
+        settings that change the labels (e.g. subsample or consensus options).
+
+        Execution-only parameters (EXECUTION_PARAMS, e.g. the core count) are
+        left out, so changing them still hits the cache.
+        """
+        markers = tuple(self.markers) if self.markers else None
+        settings = {'transform': repr(self.transform), 'markers': markers, 'mode': repr(mode)}
+        params = {k: v for k, v in params.items() if k not in EXECUTION_PARAMS}
+        return self.result_cache.key(self.data_loader.fingerprint(), algorithm, params, settings)
+
+    def _result_cache_dir(self):
+        return ResultCache.cache_dir_for(self.data_loader.directory)
+
+    def restore_result(self, key):
+        """
+        Load labels, centers and stability from the result cache. Returns the
+        cache entry (its 'output_dir' is where the outputs were last written)
+        or None on a miss, leaving the current results untouched.
+        """
+        start = time.perf_counter()
+        entry = self.result_cache.load(self._result_cache_dir(), key)
+        n_rows = self.data_loader.feature_matrix.shape[0] if self.data_loader.has_data() else None
+        if entry is None or len(entry['labels']) != n_rows:
+            return None
+        self.labels = entry['labels']
+        self.cluster_centers = entry['centers']
+        self.stability = entry['stability']
+        self.run_log = [{'stage': "Cached result", 'seconds': time.perf_counter() - start}]
+        return entry
+
+    def store_result(self, key, output_dir=None, include_stability=False, description=None):
+        """Save the current labels and centers (and the consensus stability table) under key."""
+        if self.labels is None:
+            raise ValueError("No clustering results to cache")
+        self.result_cache.store(self._result_cache_dir(), key, self.labels, centers=self.cluster_centers,
+                                stability=self.stability if include_stability else None,
+                                output_dir=output_dir, description=description)
+
+    def record_result_output_dir(self, key, output_dir):
+        """Point a cached result at the folder its outputs were rewritten to."""
+        self.result_cache.set_output_dir(self._result_cache_dir(), key, output_dir)
+
     def get_results_df(self):
         """Returns the merged dataframe with cluster labels"""
         if self.labels is None:
             return None
         
-        df = self.data_loader.get_merged_data().copy()
+        df = self.data_loader.get_merged_data()  # freshly built, safe to modify
         df.insert(0, 'cluster_label', self.labels)
         return df
 
-    def get_cluster_marker_means_df(self):
+    def summary(self):
         """
-        Returns a DataFrame where rows are cluster labels and columns are markers/features,
-        values are the mean expression per cluster.
+        ClusterSummary of the current labels over the loaded feature matrix
+        (counts, marker means and variances, per-file counts), computed in one
+        chunked pass and reused until the labels or the data change.
         """
         if self.labels is None:
             return None
+        if (self._summary is None or self._summary[0] is not self.labels
+                or self._summary[1] != self.data_loader.version):
+            data = self.data_loader.get_feature_matrix()
+            if data is None:
+                raise ValueError("No feature data loaded")
+            summary = ClusterSummary(data, self.labels, self.data_loader.feature_columns,
+                                     file_slices=self.data_loader.file_slices)
+            self._summary = (self.labels, self.data_loader.version, summary)
+        return self._summary[2]
 
-        feature_df = self.data_loader.get_feature_data()
-        if feature_df is None:
-            raise ValueError("No feature data loaded")
-
-        if len(feature_df) != len(self.labels):
-            raise ValueError("Feature data rows do not match label length")
-
-        df = feature_df.copy()
-        df.insert(0, "cluster_label", self.labels)
-        means = df.groupby("cluster_label").mean(numeric_only=True)
-        means.index = means.index.astype(int, copy=False)
-        means = means.sort_index()
-        means.index.name = "cluster_label"
-        return means
+    def get_cluster_marker_means_df(self):
+        """
+        Returns a DataFrame where rows are cluster labels and columns are markers/features,
+        values are the mean expression per cluster.
+        """
+        summary = self.summary()
+        return None if summary is None else summary.means_df()
 
     def save_cluster_marker_means(self, output_dir, filename="cluster_marker_means.csv"):
         out_path = Path(output_dir)
@@ -129,30 +862,32 @@ class ClusterManager:
         means.to_csv(output_path, index=True)
         return str(output_path)
 
-    def save_results(self, output_dir):
-        """
-        Save results as per requirements:
-        1. Individual CSVs with cluster label
-        2. Merged CSV
-        """
-        import os
-        from pathlib import Path
-        
+    def save_cluster_file_counts(self, output_dir, filename="cluster_counts_per_file.csv"):
+        """Cells per cluster in every input file (files x clusters)."""
+        summary = self.summary()
+        if summary is None:
+            raise ValueError("No clustering results to summarize")
+
         out_path = Path(output_dir)
         out_path.mkdir(parents=True, exist_ok=True)
-        
-        full_df = self.get_results_df()
-        if full_df is None:
+        output_path = out_path / filename
+        summary.file_counts_df().to_csv(output_path, index=True)
+        return str(output_path)
+
+    def save_results(self, output_dir, fmt="csv", float_precision=None, n_jobs=None, combined=False):
+        """
+        Save results as a partitioned dataset (see ResultDataset): one table
+        per input file with the cluster labels plus manifest.json, so every
+        cell is written once. With combined, combined_results is written too;
+        ResultDataset.export_combined_csv produces it later on demand.
+
+        Written by ResultWriter directly from the loaded arrays, with the
+        files written concurrently (n_jobs threads, None = all cores). fmt is
+        'csv', 'parquet' or 'feather'; float_precision rounds marker values
+        to that many decimals (None = full precision). Returns the manifest path.
+        """
+        if self.labels is None:
             raise ValueError("No results to save")
-            
-        # Save merged
-        full_df.to_csv(out_path / "combined_results.csv", index=False)
-        
-        # Save individual
-        grouped = full_df.groupby('_file_id')
-        for file_id, group in grouped:
-            # Remove internal columns
-            save_df = group.drop(columns=['_file_id', '_original_index'])
-            save_df.to_csv(out_path / f"{file_id}_clustered.csv", index=False)
-            
-        return str(out_path)
+        manifest = ResultWriter(self.data_loader, self.labels, fmt=fmt, float_precision=float_precision,
+                                n_jobs=n_jobs).write(output_dir, combined=combined)
+        return str(manifest)
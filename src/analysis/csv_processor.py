@@ -2,6 +2,8 @@ import pandas as pd
 from pathlib import Path
 from datetime import datetime
 import os
+from src.utils.folder_index import FolderIndex
+from src.analysis.result_dataset import ResultDataset, read_table
 
 class CsvSplitter:
     def __init__(self):
@@ -10,6 +12,8 @@ class CsvSplitter:
         self.folder_path = None
         self.folder_files = None
         self.folder_special_col = None
+        self.folder_index = None
+        self.folder_dataset = None  # ResultDataset when the folder holds partitioned clustering results
 
     def load_file(self, file_path):
         """
@@ -17,20 +21,17 @@ class CsvSplitter:
         """
         self.file_path = file_path
         try:
-            self.df = pd.read_csv(file_path)
+            self.df = read_table(file_path)
             return True, f"Successfully loaded {Path(file_path).name}"
         except Exception as e:
             return False, str(e)
 
     def load_folder(self, folder_path):
         folder = Path(folder_path)
-        csv_files = list(folder.glob("*.csv"))
-        if not csv_files:
-            return False, "No CSV files found in the folder.", None, None, None
-
         is_consistent, msg, common_columns = self.check_folder_consistency(folder_path)
         if not is_consistent:
             return False, msg, None, None, None
+        csv_files = self._folder_files()
 
         self.folder_path = str(folder)
         self.folder_files = csv_files
@@ -43,13 +44,13 @@ class CsvSplitter:
         else:
             self.folder_special_col = None
 
-        preview_df = pd.read_csv(csv_files[0]).head(100)
+        preview_df = read_table(csv_files[0], nrows=100)
 
         row_options = {}
         if self.folder_special_col is not None:
             values = set()
             for f in csv_files:
-                s = pd.read_csv(f, usecols=[self.folder_special_col])[self.folder_special_col]
+                s = read_table(f, columns=[self.folder_special_col])[self.folder_special_col]
                 values.update(set(s.dropna().astype(str).unique().tolist()))
             for v in values:
                 row_options[str(v)] = str(v)
@@ -59,30 +60,41 @@ class CsvSplitter:
     def check_folder_consistency(self, folder_path):
         """
         Check if all CSV files in the folder have the same columns.
+        Headers come from the folder's FolderIndex, which is reused by later
+        calls (load_folder, split_folder) instead of re-reading every file.
+        Only headers are read, and no index is written into the folder.
+        A clustering results folder (manifest.json) is read as its partitions,
+        whose shared columns the manifest records.
         Returns (is_consistent, message, common_columns)
         """
-        folder = Path(folder_path)
-        csv_files = list(folder.glob("*.csv"))
-        
+        if ResultDataset.is_dataset(folder_path):
+            try:
+                self.folder_dataset = ResultDataset(folder_path)
+            except ValueError as e:
+                return False, str(e), None
+            return True, "Clustering results: all samples have consistent columns.", list(self.folder_dataset.columns)
+        self.folder_dataset = None
+        try:
+            self.folder_index = FolderIndex.load_or_build(folder_path, persist=False)
+        except ValueError as e:
+            return False, str(e), None
+        csv_files = self.folder_index.files((".csv",))
+
         if not csv_files:
             return False, "No CSV files found in the folder.", None
 
-        first_file = csv_files[0]
-        try:
-            first_cols = set(pd.read_csv(first_file, nrows=0).columns)
-        except Exception as e:
-            return False, f"Error reading {first_file.name}: {e}", None
-
-        for f in csv_files[1:]:
-            try:
-                cols = set(pd.read_csv(f, nrows=0).columns)
-                if cols != first_cols:
-                    return False, f"Column mismatch in {f.name}", None
-            except Exception as e:
-                return False, f"Error reading {f.name}: {e}", None
+        is_consistent, msg, first_cols = self.folder_index.check_consistency(csv_files, ordered=False)
+        if not is_consistent:
+            return False, msg, None
 
         return True, "All CSV files have consistent columns.", list(first_cols)
 
+    def _folder_files(self):
+        # Sample tables of the checked folder: the partitions of a results dataset, or its CSV files
+        if self.folder_dataset is not None:
+            return self.folder_dataset.partition_paths()
+        return self.folder_index.files((".csv",))
+
     def split_csv(self, row_indices, col_indices, output_base_dir):
         if self.df is None:
             raise ValueError("No CSV file loaded.")
@@ -107,14 +119,10 @@ class CsvSplitter:
         return str(output_path)
 
     def split_folder(self, row_values, col_indices, folder_path, output_base_dir):
-        folder = Path(folder_path)
-        csv_files = list(folder.glob("*.csv"))
-        if not csv_files:
-            raise ValueError("No CSV files found in the folder.")
-
         is_consistent, msg, common_columns = self.check_folder_consistency(folder_path)
         if not is_consistent:
             raise ValueError(msg)
+        csv_files = self._folder_files()
 
         columns_set = {str(c).strip().lower() for c in common_columns}
         if "cluster_label" in columns_set:
@@ -138,7 +146,7 @@ class CsvSplitter:
 
         out_paths = []
         for f in csv_files:
-            df = pd.read_csv(f)
+            df = read_table(f)
             if special_col is not None and selected_values is not None:
                 df = df[df[special_col].fillna("").astype(str).isin(selected_values)]
             df = df[valid_cols]
@@ -219,7 +227,11 @@ class CsvMapper:
 
     def map_folder(self, folder_path, mapping_csv_path):
         folder = Path(folder_path)
-        csv_files = list(folder.glob("*.csv"))
+        if ResultDataset.is_dataset(folder):
+            # Clustering results: map the per-sample partitions, not the summary tables next to them
+            csv_files = ResultDataset(folder).partition_paths()
+        else:
+            csv_files = list(folder.glob("*.csv"))
         if not csv_files:
             raise ValueError("No CSV files found in the folder.")
 
@@ -233,7 +245,7 @@ class CsvMapper:
         for f in csv_files:
             if f.resolve() == mapping_path:
                 continue
-            df = pd.read_csv(f)
+            df = read_table(f)
             norm = self._normalize_cols(df.columns)
             if "cluster_label" not in norm:
                 raise ValueError(f"Missing cluster_label in {f.name}")
@@ -249,7 +261,7 @@ class CsvMapper:
             df = df.drop(columns=[cl_col])
             df.insert(insert_pos, "cell_type", mapped)
 
-            out_path = output_dir / f.name
+            out_path = output_dir / f"{f.stem}.csv"
             df.to_csv(out_path, index=False)
             out_paths.append(str(out_path))
 
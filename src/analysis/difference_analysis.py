@@ -6,7 +6,9 @@ from pathlib import Path
 
 import pandas as pd
 
+from src.analysis.result_dataset import ResultDataset, read_table
 from src.analysis.visualization import Visualizer
+from src.utils.folder_index import FolderIndex
 
 
 @dataclass(frozen=True)
@@ -27,24 +29,39 @@ class DifferenceAnalyzer:
             return lower_to_original["cell_type"]
         return None
 
-    def compute_cell_type_percentages(self, input_dir: str | Path) -> pd.DataFrame:
-        input_dir = Path(input_dir)
-        csv_files = sorted(input_dir.glob("*.csv"))
+    def _sample_columns(self, input_dir: str | Path) -> list[tuple[str, Path, str]]:
+        """(sample name, table path, cell_type column) of every sample in the folder."""
+        if ResultDataset.is_dataset(input_dir):
+            # Clustering results: one partition per sample; without annotation, group by cluster
+            dataset = ResultDataset(input_dir)
+            col = self._find_cell_type_column(dataset.columns)
+            if col is None:
+                col = next((c for c in dataset.columns if str(c).strip().lower() == "cluster_label"), None)
+            if col is None:
+                raise ValueError("Missing 'cell_type' column in the clustering results")
+            return [(p['file_id'], path, col) for p, path in zip(dataset.partitions, dataset.partition_paths())]
+
+        index = FolderIndex.load_or_build(input_dir, persist=False)
+        csv_files = index.files((".csv",))
         if not csv_files:
             raise ValueError("No CSV files found in the selected folder.")
-
-        rows = []
-        all_cell_types = set()
+        samples = []
         for f in csv_files:
-            df = pd.read_csv(f)
-            col = self._find_cell_type_column(df.columns)
+            # The index knows each header, so only the cell_type column is parsed
+            col = self._find_cell_type_column(index.entry(f).columns)
             if col is None:
                 raise ValueError(f"Missing 'cell_type' column in {f.name}")
+            samples.append((f.stem, f, col))
+        return samples
 
-            s = df[col].fillna("Unknown").astype(str)
+    def compute_cell_type_percentages(self, input_dir: str | Path) -> pd.DataFrame:
+        rows = []
+        all_cell_types = set()
+        for name, path, col in self._sample_columns(input_dir):
+            s = read_table(path, columns=[col])[col].fillna("Unknown").astype(str)
             pct = s.value_counts(normalize=True, dropna=False) * 100.0
             all_cell_types.update(pct.index.tolist())
-            rows.append((f.stem, pct))
+            rows.append((name, pct))
 
         all_cell_types = sorted(all_cell_types)
         out = pd.DataFrame(index=[name for name, _ in rows], columns=all_cell_types, dtype=float)
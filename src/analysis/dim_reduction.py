@@ -1,62 +1,202 @@
+import time
 import numpy as np
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 import umap
-from sklearn.preprocessing import StandardScaler
+from src.analysis.preprocessing import PreprocessingCache
+from src.analysis.knn_cache import KnnGraphCache
+from src.analysis.tsne import EXPLORATION_ITER, auto_learning_rate, joint_probabilities, optimize_tsne, squared_knn_distances
+from src.utils.cancellation import uninterruptible
+from src.utils.checkpoints import CheckpointStore
+from src.utils.parallel import resolve_cpu_budget
+from src.utils.run_log import format_run_log
+from threadpoolctl import threadpool_limits
+
+TSNE_CHECKPOINT_ITER = 250  # t-SNE iterations between checkpoints (and run_log entries)
+TSNE_KL_TOL = 1e-3  # early stopping: minimum relative KL decrease between evaluations (every 50 iterations)
+
 
 class DimReductionManager:
-    def __init__(self, data_loader):
+    def __init__(self, data_loader, preprocessing_cache=None, knn_cache=None):
         self.data_loader = data_loader
         self.embedding = None
         self.scaled_data = None
         self.custom_data = None
+        self.transform = None  # optional ArcsinhTransform for loader data (custom data is used as-is)
+        self.markers = None  # optional subset of feature columns for loader data (None = all)
+        self.preprocessing_cache = preprocessing_cache if preprocessing_cache is not None else PreprocessingCache()
+        self._scaled_key = None
+        self._fingerprint = None
+        self.knn_cache = knn_cache if knn_cache is not None else KnnGraphCache()
+        self.run_log = []  # timed stages of the last embedding: dicts with 'stage', 'seconds' and details
 
     def set_custom_data(self, data):
         """Set custom data for analysis, bypassing data_loader"""
         self.custom_data = data
-        self.scaled_data = None # Reset scaled data
+        self.scaled_data = None # Rescaled on demand (served from the preprocessing cache when unchanged)
+
+    def _preprocess_key(self):
+        markers = tuple(self.markers) if self.markers else None
+        return (self.data_loader.version, self.transform, markers)
 
     def preprocess(self):
+        """
+        Standardize the data (chunked; spills to disk along with the loader's
+        matrix). Results come from the shared preprocessing cache, so loader
+        data already scaled for clustering, or custom data seen before, is
+        not scaled again.
+        """
         if self.custom_data is not None:
-            data = self.custom_data
+            self.scaled_data, self._fingerprint = self.preprocessing_cache.scaled_array(self.custom_data)
+            self._scaled_key = None
         else:
-            data = self.data_loader.get_feature_data()
-            
-        if data is None:
-            raise ValueError("No data loaded")
-        
-        scaler = StandardScaler()
-        self.scaled_data = scaler.fit_transform(data)
+            key = self._preprocess_key()
+            self.scaled_data, self._fingerprint = self.preprocessing_cache.scaled(self.data_loader, key[1], key[2])
+            self._scaled_key = key
         return self.scaled_data
 
-    def run_tsne(self, perplexity=30, learning_rate=200.0, n_iter=1000, random_state=42):
+    def _ensure_scaled(self):
         if self.scaled_data is None:
-            self.preprocess()
-            
-        # Note: scikit-learn uses max_iter instead of n_iter in newer versions
-        tsne = TSNE(n_components=2, perplexity=perplexity, learning_rate=learning_rate, 
-                    max_iter=n_iter, random_state=random_state, init='pca', verbose=1)
-        self.embedding = tsne.fit_transform(self.scaled_data)
+            return self.preprocess()
+        if self.custom_data is None and self._scaled_key != self._preprocess_key():
+            return self.preprocess()
+        return self.scaled_data
+
+    def _knn(self, k, metric='euclidean', random_state=None):
+        """
+        kNN graph of the scaled data from the shared cache (built on a miss).
+        Graphs over loaded folders are also persisted next to the data.
+        """
+        directory = self.data_loader.directory if self.custom_data is None else None
+        indices, distances, _ = self.knn_cache.get_or_build(
+            self.scaled_data, k, metric, fingerprint=self._fingerprint,
+            cache_dir=KnnGraphCache.cache_dir_for(directory), n_jobs=-1, random_state=random_state)
+        return indices, distances
+
+    @staticmethod
+    def _with_self(indices, distances):
+        """Prepend each point as its own neighbour at distance 0."""
+        n = indices.shape[0]
+        own = np.arange(n, dtype=indices.dtype)[:, None]
+        return np.hstack([own, indices]), np.hstack([np.zeros((n, 1), dtype=distances.dtype), distances])
+
+    def run_tsne(self, perplexity=30, learning_rate=200.0, n_iter=1000, random_state=42, use_knn_cache=True,
+                 angle=0.5, n_jobs=0, early_stopping=False, kl_tol=TSNE_KL_TOL, n_iter_without_progress=300,
+                 min_grad_norm=1e-7):
+        """
+        Barnes-Hut t-SNE with PCA initialization. With use_knn_cache the
+        affinities are computed from the shared kNN graph (3 * perplexity
+        neighbours, as scikit-learn would use) instead of a fresh exact
+        neighbour search.
+
+        angle is the Barnes-Hut trade-off (higher is faster and coarser) and
+        n_jobs the number of threads for the gradient, neighbour search and
+        PCA (0 = all cores). learning_rate='auto' is scikit-learn's
+        n / early exaggeration / 4, but never below 200.
+
+        The optimizer (src.analysis.tsne) is scikit-learn's, run in-tree so
+        its state can be saved: for loaded folders it is checkpointed every
+        TSNE_CHECKPOINT_ITER iterations and a stopped run resumes exactly
+        where it was. With early_stopping the run also ends once one of the
+        KL evaluations (every 50 iterations) lowers the KL divergence by less
+        than kl_tol relative to the previous one;
+        n_iter_without_progress and min_grad_norm are scikit-learn's own
+        stopping rules. Timings and KL divergences are kept in run_log.
+        """
+        self._ensure_scaled()
+        self.run_log = []
+        data = self.scaled_data
+        n = data.shape[0]
+        k = min(n - 1, int(3.0 * perplexity + 1))
+        budget = resolve_cpu_budget(n_jobs)
+
+        start = time.perf_counter()
+        with threadpool_limits(limits=budget):
+            if use_knn_cache:
+                indices, distances = self._knn(k, random_state=random_state)
+                distances = KnnGraphCache._to_csr(indices, np.square(distances, dtype=np.float32))
+            else:
+                distances = squared_knn_distances(data, k, n_jobs=budget)
+            P = joint_probabilities(distances, perplexity)
+            # Same PCA initialization scikit-learn applies for init='pca'
+            init = PCA(n_components=2, svd_solver='randomized', random_state=random_state).fit_transform(data)
+        init = (init / np.std(init[:, 0]) * 1e-4).astype(np.float32)
+        self.run_log.append({'stage': "Affinities and PCA init", 'k': k, 'seconds': time.perf_counter() - start})
+
+        rate = auto_learning_rate(n) if learning_rate == 'auto' else float(learning_rate)
+        # The optimizer state at a given iteration does not depend on n_iter or the early stopping settings
+        store = CheckpointStore(self.data_loader.directory if self.custom_data is None else None)
+        checkpoint_key = store.key("tsne", self._fingerprint, perplexity, rate, random_state,
+                                   use_knn_cache, angle, n_iter_without_progress, min_grad_norm)
+        saved = store.load("tsne", checkpoint_key)
+        if saved is not None and int(saved['iteration']) > n_iter:
+            saved = None
+        if saved is not None:
+            self.run_log.append({'stage': "Resumed from checkpoint", 'iteration': int(saved['iteration']),
+                                 'seconds': 0.0})
+
+        block = {'first': int(saved['iteration']) if saved is not None else 0, 'start': time.perf_counter()}
+
+        def log_block(state):
+            phase = "Early exaggeration, i" if block['first'] < EXPLORATION_ITER else "I"
+            self.run_log.append({'stage': f"{phase}terations {block['first'] + 1}-{state['iteration']}",
+                                 'kl_divergence': state['kl_divergence'],
+                                 'seconds': time.perf_counter() - block['start']})
+            block['first'], block['start'] = state['iteration'], time.perf_counter()
+
+        def on_check(state):
+            if state['iteration'] % TSNE_CHECKPOINT_ITER:
+                return
+            log_block(state)
+            if not state['stop_reason']:
+                store.save("tsne", checkpoint_key, **state)
+
+        embedding, state = optimize_tsne(P, init, rate, n_iter=n_iter, angle=angle, n_threads=budget,
+                                         n_iter_without_progress=n_iter_without_progress,
+                                         min_grad_norm=min_grad_norm, kl_tol=kl_tol if early_stopping else None,
+                                         state=saved, on_check=on_check)
+        if state['iteration'] > block['first']:
+            log_block(state)
+        if state['stop_reason']:
+            self.run_log.append({'stage': "Early stop", 'iterations': state['iteration'],
+                                 'reason': state['stop_reason'], 'seconds': 0.0})
+        store.clear("tsne", checkpoint_key)
+
+        self.embedding = embedding
         return self.embedding
 
-    def run_umap(self, n_neighbors=15, min_dist=0.1, metric='euclidean', random_state=42):
-        if self.scaled_data is None:
-            self.preprocess()
-            
-        reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric=metric, 
-                            random_state=random_state, verbose=True)
-        self.embedding = reducer.fit_transform(self.scaled_data)
+    def format_run_log(self):
+        """One line per timed stage of the last embedding, for the GUI log."""
+        return format_run_log(self.run_log)
+
+    def run_umap(self, n_neighbors=15, min_dist=0.1, metric='euclidean', random_state=42, use_knn_cache=True):
+        """UMAP; with use_knn_cache the neighbour graph comes from the shared kNN cache."""
+        self._ensure_scaled()
+
+        precomputed_knn = (None, None, None)
+        n = self.scaled_data.shape[0]
+        if use_knn_cache and 1 < n_neighbors < n:
+            # UMAP counts each point as its own nearest neighbour
+            indices, distances = self._with_self(*self._knn(n_neighbors - 1, metric, random_state))
+            precomputed_knn = (indices, distances, None)
+
+        reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric=metric,
+                            random_state=random_state, verbose=True, precomputed_knn=precomputed_knn)
+        with uninterruptible("UMAP"):
+            self.embedding = reducer.fit_transform(self.scaled_data)
         return self.embedding
 
     def run_3d_reduction(self, method='tsne', **kwargs):
         """Helper for 3D reduction if needed, though requirements say 2D/3D visualization, usually implies 3D coords"""
-        if self.scaled_data is None:
-            self.preprocess()
-            
+        self._ensure_scaled()
+
         if method == 'tsne':
             tsne = TSNE(n_components=3, **kwargs)
-            self.embedding = tsne.fit_transform(self.scaled_data)
+            with uninterruptible("3D t-SNE"):
+                self.embedding = tsne.fit_transform(self.scaled_data)
         elif method == 'umap':
             reducer = umap.UMAP(n_components=3, **kwargs)
-            self.embedding = reducer.fit_transform(self.scaled_data)
+            with uninterruptible("3D UMAP"):
+                self.embedding = reducer.fit_transform(self.scaled_data)
             
         return self.embedding
@@ -0,0 +1,157 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from src.utils.cancellation import checkpoint, uninterruptible
+from src.utils.parallel import SharedArray, process_pool, results_in_order, split_budget
+
+try:
+    import igraph
+    IGRAPH_AVAILABLE = True
+except ImportError:
+    IGRAPH_AVAILABLE = False
+
+GRAPH_METHODS = ("leiden", "louvain")
+_JACCARD_CHUNK_NNZ = 8_000_000  # rough bound on 2-hop pairs held per row block
+
+
+def knn_graph(data, k=30, metric="euclidean", n_jobs=1, random_state=None):
+    """
+    Approximate k nearest neighbours of every row (NN-descent, parallel over
+    n_jobs threads). Returns (indices, distances), each (n, k), without the
+    point itself.
+    """
+    # Imported here so community-detection worker processes don't load numba
+    from pynndescent import NNDescent
+
+    data = np.asarray(data)
+    n = data.shape[0]
+    if n <= k:
+        raise ValueError(f"Need more than k={k} cells for a kNN graph, got {n}")
+
+    with uninterruptible("kNN graph construction"):
+        index = NNDescent(data, n_neighbors=k + 1, metric=metric, random_state=random_state,
+                          n_jobs=n_jobs, low_memory=True, compressed=True)
+        indices, distances = index.neighbor_graph
+
+    # Drop each point from its own list (or the farthest neighbour when it is missing)
+    is_self = indices == np.arange(n)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    keep = ~is_self
+    return indices[keep].reshape(n, k).astype(np.int32), distances[keep].reshape(n, k).astype(np.float32)
+
+
+def jaccard_graph(indices, n_jobs=1):
+    """
+    Phenograph-style graph: every kNN edge i -> j is weighted by the Jaccard
+    similarity of the two neighbour sets, |N(i) & N(j)| / |N(i) | N(j)|, and
+    the result is symmetrized as (W + W.T) / 2.
+
+    Shared-neighbour counts come from sparse products A[rows] @ A.T over row
+    blocks, masked to the kNN edges, so no dense n x n matrix is formed. The
+    blocks run on n_jobs threads (scipy's sparse kernels release the GIL).
+    """
+    n, k = indices.shape
+    indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+    adjacency = sp.csr_matrix((np.ones(n * k, dtype=np.float32), indices.ravel(), indptr), shape=(n, n))
+    adjacency_t = adjacency.T.tocsr()
+
+    block_rows = max(1, _JACCARD_CHUNK_NNZ // (k * k))
+    starts = range(0, n, block_rows)
+
+    def weigh(start):
+        rows = adjacency[start:start + block_rows]
+        shared = (rows @ adjacency_t).multiply(rows).tocsr()
+        shared.data = shared.data / (2 * k - shared.data)
+        shared.eliminate_zeros()
+        return shared
+
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            blocks = list(executor.map(weigh, starts))
+    else:
+        blocks = [weigh(start) for start in starts]
+
+    weights = sp.vstack(blocks, format="csr")
+    weights = ((weights + weights.T) * 0.5).tocsr()
+    weights.data = weights.data.astype(np.float32, copy=False)
+    return weights
+
+
+def detect_communities(graph, method="leiden", resolution=1.0, seed=0):
+    """
+    Community detection on a symmetric weighted graph. Returns
+    (membership, modularity). Both methods optimize modularity at the given
+    resolution using igraph's implementations.
+    """
+    if method not in GRAPH_METHODS:
+        raise ValueError(f"Unknown community detection method: {method}")
+    if not IGRAPH_AVAILABLE:
+        raise ImportError("python-igraph is not installed. Please install it to use graph clustering.")
+
+    upper = sp.triu(graph, k=1).tocoo()
+    # Plain lists build the igraph edge list far faster than a numpy array
+    g = igraph.Graph(n=graph.shape[0], edges=list(zip(upper.row.tolist(), upper.col.tolist())), directed=False)
+    weights = upper.data.astype(np.float64)
+
+    # igraph draws from Python's random module
+    random.seed(int(seed))
+    if method == "leiden":
+        membership = g.community_leiden(objective_function="modularity", weights=weights,
+                                        resolution=resolution, n_iterations=-1).membership
+    else:
+        membership = g.community_multilevel(weights=weights, resolution=resolution).membership
+
+    membership = np.asarray(membership, dtype=np.int32)
+    quality = g.modularity(membership.tolist(), weights=weights, resolution=resolution)
+    return membership, float(quality)
+
+
+def _detect_worker(shared_parts, n, method, resolution, seed):
+    indptr, indices, data = (part.open() for part in shared_parts)
+    graph = sp.csr_matrix((np.asarray(data), np.asarray(indices), np.asarray(indptr)), shape=(n, n))
+    membership, quality = detect_communities(graph, method, resolution, seed)
+    return membership, quality
+
+
+def detect_communities_restarts(graph, method="leiden", resolution=1.0, seeds=(0,), budget=1, spill_dir=None):
+    """
+    Run community detection once per seed and keep the partition with the
+    highest modularity. Restarts run concurrently in worker processes (one
+    thread each) when the core budget allows; the graph is shared with them
+    through memory-mapped files. Each run itself is single-threaded, so a
+    single seed gets no parallelism. Returns (best membership, [(seed, modularity)]).
+    """
+    seeds = [int(s) for s in seeds]
+    workers, _ = split_budget(len(seeds), budget)
+
+    if workers == 1:
+        results = []
+        for seed in seeds:
+            with uninterruptible("community detection"):
+                results.append(detect_communities(graph, method, resolution, seed))
+    else:
+        n = graph.shape[0]
+        shared_parts = [SharedArray.from_array(part, spill_dir=spill_dir)
+                        for part in (graph.indptr, graph.indices, graph.data)]
+        try:
+            with process_pool(workers, 1) as pool:
+                futures = [pool.submit(_detect_worker, shared_parts, n, method, resolution, seed) for seed in seeds]
+                results = list(results_in_order(pool, futures))
+        finally:
+            for part in shared_parts:
+                part.release()
+
+    best = max(range(len(results)), key=lambda i: results[i][1])
+    return results[best][0], [(seed, quality) for seed, (_, quality) in zip(seeds, results)]
+
+
+def relabel_by_size(membership):
+    """Renumber communities 0..c-1 from largest to smallest."""
+    counts = np.bincount(membership)
+    order = np.argsort(-counts, kind="stable")
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[membership].astype(np.int32)
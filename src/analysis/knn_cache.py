@@ -0,0 +1,120 @@
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+
+from src.analysis.graph_clustering import knn_graph
+from src.utils.feature_store import array_fingerprint
+from src.utils.sample_cache import CACHE_DIR_NAME
+
+KNN_DIR_NAME = "knn"
+
+
+class KnnGraphCache:
+    """
+    Cache of approximate kNN graphs over a scaled matrix, shared by
+    ClusterManager (graph clustering) and DimReductionManager (UMAP and
+    t-SNE affinities).
+
+    Entries are keyed by a fingerprint of the matrix, the metric and k. A
+    request for k neighbours is served from any cached graph with at least k
+    neighbours per row by keeping the first k columns (rows are ordered by
+    distance), so a cluster-then-embed workflow builds the graph once. The
+    most recent graph is kept in memory; with a cache_dir the graphs are also
+    persisted as sparse .npz files (one row of exactly k ordered entries per
+    cell) and reused across sessions.
+    """
+
+    def __init__(self):
+        self._memory = None  # (fingerprint, metric, indices, distances)
+
+    @staticmethod
+    def cache_dir_for(directory):
+        """On-disk location for graphs over a loaded folder (None keeps them in memory only)."""
+        return Path(directory) / CACHE_DIR_NAME / KNN_DIR_NAME if directory else None
+
+    @staticmethod
+    def _file_name(fingerprint, metric, k):
+        return f"{fingerprint}_{metric}_k{k}.npz"
+
+    @staticmethod
+    def _to_csr(indices, distances):
+        n, k = indices.shape
+        indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+        # Built directly (not via coo) so each row keeps its neighbour order and explicit zero distances
+        return sp.csr_matrix((distances.ravel(), indices.ravel(), indptr), shape=(n, n))
+
+    @staticmethod
+    def _from_csr(graph):
+        n = graph.shape[0]
+        k = graph.indptr[1] - graph.indptr[0] if n else 0
+        return graph.indices.reshape(n, k).astype(np.int32), graph.data.reshape(n, k).astype(np.float32)
+
+    def _find_on_disk(self, cache_dir, fingerprint, metric, k):
+        if cache_dir is None or not Path(cache_dir).is_dir():
+            return None
+        pattern = re.compile(rf"^{re.escape(fingerprint)}_{re.escape(metric)}_k(\d+)\.npz$")
+        candidates = []
+        for name in os.listdir(cache_dir):
+            match = pattern.match(name)
+            if match and int(match.group(1)) >= k:
+                candidates.append((int(match.group(1)), name))
+        for _, name in sorted(candidates):
+            try:
+                return self._from_csr(sp.load_npz(Path(cache_dir) / name))
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def _store_on_disk(self, cache_dir, fingerprint, metric, indices, distances):
+        if cache_dir is None:
+            return
+        try:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            path = cache_dir / self._file_name(fingerprint, metric, indices.shape[1])
+            tmp = path.with_name(path.stem + ".tmp.npz")
+            sp.save_npz(tmp, self._to_csr(indices, distances), compressed=False)
+            os.replace(tmp, path)
+            # Graphs with fewer neighbours for the same data are now redundant
+            for name in os.listdir(cache_dir):
+                if name.startswith(f"{fingerprint}_{metric}_k") and name != path.name:
+                    os.remove(cache_dir / name)
+        except OSError:
+            # Read-only folder: the graph just isn't persisted
+            pass
+
+    def get(self, fingerprint, k, metric="euclidean", cache_dir=None):
+        """(indices, distances) with k neighbours per row, or None when no graph with >= k is cached."""
+        if self._memory is not None:
+            fp, m, indices, distances = self._memory
+            if fp == fingerprint and m == metric and indices.shape[1] >= k:
+                return indices[:, :k], distances[:, :k]
+
+        found = self._find_on_disk(cache_dir, fingerprint, metric, k)
+        if found is None:
+            return None
+        self._memory = (fingerprint, metric) + found
+        return found[0][:, :k], found[1][:, :k]
+
+    def get_or_build(self, data, k, metric="euclidean", fingerprint=None, cache_dir=None,
+                     n_jobs=1, random_state=None):
+        """
+        kNN graph of data (without self-neighbours) from the cache, building
+        and storing it on a miss. Returns (indices, distances, was_cached).
+        """
+        k = int(k)
+        fingerprint = fingerprint or array_fingerprint(data)
+        cached = self.get(fingerprint, k, metric, cache_dir)
+        if cached is not None:
+            return cached[0], cached[1], True
+
+        indices, distances = knn_graph(data, k=k, metric=metric, n_jobs=n_jobs, random_state=random_state)
+        self._memory = (fingerprint, metric, indices, distances)
+        self._store_on_disk(cache_dir, fingerprint, metric, indices, distances)
+        return indices, distances, False
+
+    def clear(self):
+        self._memory = None
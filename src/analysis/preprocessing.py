@@ -0,0 +1,223 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from src.utils.feature_store import DEFAULT_CHUNK_ROWS, array_fingerprint, iter_row_chunks
+
+DEFAULT_CACHE_BYTES = 4 * 1024 ** 3  # RAM budget of PreprocessingCache
+
+
+def standard_scale(data, out=None, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Chunked equivalent of ``StandardScaler().fit_transform(data)``.
+
+    Statistics are accumulated with ``partial_fit`` over row chunks and the
+    transform is written chunk by chunk into ``out`` (allocated in RAM when not
+    given), so a memory-mapped input is never loaded as a whole. Float32 input
+    stays float32.
+
+    Returns (scaled, scaler).
+    """
+    arr = data.to_numpy() if hasattr(data, "to_numpy") else data
+    if arr is None or arr.shape[0] == 0:
+        raise ValueError("No data loaded")
+
+    scaler = StandardScaler()
+    for _, chunk in iter_row_chunks(arr, chunk_size):
+        scaler.partial_fit(chunk)
+
+    if out is None:
+        dtype = arr.dtype if arr.dtype in (np.float32, np.float64) else np.float64
+        out = np.empty(arr.shape, dtype=dtype)
+    for start, chunk in iter_row_chunks(arr, chunk_size):
+        out[start:start + len(chunk)] = scaler.transform(chunk)
+    return out, scaler
+
+
+@dataclass(frozen=True)
+class ArcsinhTransform:
+    """
+    ``arcsinh(x / cofactor)`` per marker, optionally clipped.
+
+    ``cofactor`` applies to every marker unless overridden in ``cofactors``
+    (a tuple of (marker, cofactor) pairs, kept as a tuple so the transform is
+    hashable and can key caches). The common CyTOF choice is a cofactor of 5.
+    """
+    cofactor: float = 5.0
+    cofactors: tuple = ()
+    clip_min: float | None = None
+    clip_max: float | None = None
+
+    def cofactor_vector(self, feature_columns, dtype=np.float32):
+        overrides = dict(self.cofactors)
+        values = np.array([overrides.get(c, self.cofactor) for c in feature_columns], dtype=dtype)
+        if np.any(values <= 0):
+            raise ValueError("Arcsinh cofactors must be positive")
+        return values
+
+    def apply_inplace(self, block, cofactors):
+        """Transform a float block in place (cofactors from cofactor_vector)."""
+        np.divide(block, cofactors, out=block)
+        np.arcsinh(block, out=block)
+        if self.clip_min is not None or self.clip_max is not None:
+            np.clip(block, self.clip_min, self.clip_max, out=block)
+        return block
+
+    def transform(self, data, feature_columns, out=None, chunk_size=DEFAULT_CHUNK_ROWS):
+        """Transform data chunk by chunk into out (a new array when not given); data is left untouched."""
+        if out is None:
+            dtype = data.dtype if data.dtype in (np.float32, np.float64) else np.float64
+            out = np.empty(data.shape, dtype=dtype)
+        cofactors = self.cofactor_vector(feature_columns, dtype=out.dtype)
+        for start, chunk in iter_row_chunks(data, chunk_size):
+            block = out[start:start + len(chunk)]
+            block[...] = chunk
+            self.apply_inplace(block, cofactors)
+        return out
+
+
+class PreprocessingCache:
+    """
+    Memoized preprocessing shared by ClusterManager and DimReductionManager:
+    transformed and standardized marker matrices keyed by the dataset's
+    content fingerprint, the marker subset and the transform. Both managers
+    get the same scaled array (callers must not modify it in place), so a
+    dataset is transformed and scaled once per session instead of once per
+    manager and run.
+
+    Entries are evicted least-recently-used first once the in-memory entries
+    exceed max_bytes (memory-mapped entries live on disk and do not count).
+    When the loaded data changes (e.g. after DataLoader.refresh), a new
+    transformed matrix copies unchanged files from an earlier entry with the
+    same transform and markers, and only added or modified files are
+    transformed again; scaling is recomputed because its statistics are
+    global.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (array, file slices, file tokens)
+
+    @staticmethod
+    def _fingerprint(key):
+        return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def nbytes(self):
+        """Bytes held in RAM by cached entries."""
+        return sum(arr.nbytes for arr, _, _ in self._entries.values() if not isinstance(arr, np.memmap))
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, array, slices=None, tokens=None):
+        self._entries[key] = (array, slices, tokens)
+        self._entries.move_to_end(key)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == key:
+                break
+            del self._entries[oldest]
+
+    @staticmethod
+    def _fill(out, data, column_idx, transform, columns):
+        """Copy data (optionally a column subset) into out chunk by chunk, applying the transform."""
+        cofactors = transform.cofactor_vector(columns, dtype=out.dtype) if transform is not None else None
+        for start, chunk in iter_row_chunks(data):
+            block = out[start:start + len(chunk)]
+            block[...] = chunk if column_idx is None else chunk[:, column_idx]
+            if transform is not None:
+                transform.apply_inplace(block, cofactors)
+
+    def transformed(self, data_loader, transform=None, markers=None):
+        """
+        The loader's marker matrix restricted to markers (None = all) with
+        the transform applied. Returns the loader's own matrix when there is
+        nothing to do.
+        """
+        data = data_loader.get_feature_matrix()
+        if data is None:
+            raise ValueError("No data loaded")
+        if markers is not None and tuple(markers) == tuple(data_loader.feature_columns):
+            markers = None
+        if transform is None and markers is None:
+            return data
+
+        columns = list(data_loader.feature_columns)
+        column_idx = None
+        if markers is not None:
+            missing = [m for m in markers if m not in columns]
+            if missing:
+                raise ValueError(f"Unknown markers: {missing}")
+            column_idx = np.array([columns.index(m) for m in markers])
+            columns = list(markers)
+
+        key = ("transformed", data_loader.fingerprint(), markers, transform)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        # An earlier version of the dataset under the same transform/markers to copy unchanged files from
+        previous = None
+        for other, entry in reversed(self._entries.items()):
+            if other[0] == "transformed" and other[2:] == key[2:] and entry[1]:
+                previous = entry
+                break
+
+        out = data_loader.allocate((data.shape[0], len(columns)), dtype=data.dtype)
+        if previous is None or not data_loader.file_slices:
+            self._fill(out, data, column_idx, transform, columns)
+        else:
+            old, old_slices, old_tokens = previous
+            for file_id, sl in data_loader.file_slices.items():
+                token = data_loader.file_tokens.get(file_id)
+                old_sl = old_slices.get(file_id)
+                if token is not None and old_tokens.get(file_id) == token and old_sl is not None and old_sl.stop - old_sl.start == sl.stop - sl.start:
+                    out[sl] = old[old_sl]
+                else:
+                    self._fill(out[sl], data[sl], column_idx, transform, columns)
+
+        self._store(key, out, dict(data_loader.file_slices), dict(data_loader.file_tokens))
+        return out
+
+    def scaled(self, data_loader, transform=None, markers=None):
+        """
+        Standardized (chunked StandardScaler) matrix of the loader's data
+        after marker selection and transform. Returns (scaled, fingerprint);
+        the fingerprint identifies the scaled data and keys e.g. the kNN cache.
+        """
+        if data_loader.get_feature_matrix() is None:
+            raise ValueError("No data loaded")
+        if markers is not None and tuple(markers) == tuple(data_loader.feature_columns):
+            markers = None
+        key = ("scaled", data_loader.fingerprint(), markers, transform)
+        cached = self._lookup(key)
+        if cached is None:
+            source = self.transformed(data_loader, transform, markers)
+            cached, _ = standard_scale(source, out=data_loader.allocate(source.shape, dtype=source.dtype))
+            self._store(key, cached)
+        return cached, self._fingerprint(key)
+
+    def scaled_array(self, data, allocate=None):
+        """
+        Standardized copy of an arbitrary array or DataFrame (e.g. custom
+        data for dim reduction), keyed by a hash of its contents.
+        Returns (scaled, fingerprint).
+        """
+        arr = data.to_numpy() if hasattr(data, "to_numpy") else np.asarray(data)
+        key = ("scaled", "array:" + array_fingerprint(arr), None, None)
+        cached = self._lookup(key)
+        if cached is None:
+            out = allocate(arr.shape, dtype=arr.dtype) if allocate is not None else None
+            cached, _ = standard_scale(arr, out=out)
+            self._store(key, cached)
+        return cached, self._fingerprint(key)
+
+    def clear(self):
+        self._entries = OrderedDict()
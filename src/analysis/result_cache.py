@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.utils.sample_cache import CACHE_DIR_NAME
+
+RESULTS_DIR_NAME = "results"
+RESULT_FORMAT = 1  # bump when the meaning of stored labels or the key changes
+
+# Packages whose version can change clustering output
+_VERSIONED_PACKAGES = ("numpy", "scipy", "scikit-learn", "pynndescent", "igraph", "phenograph", "flowsom")
+
+
+def library_versions():
+    versions = {}
+    for name in _VERSIONED_PACKAGES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+class ResultCache:
+    """
+    On-disk cache of clustering results under ``<folder>/.cydat_cache/results``.
+
+    An entry is keyed by the dataset content fingerprint, the algorithm, its
+    parameters, the preprocessing/run settings and the versions of the
+    libraries that produce the labels. It holds the labels in the smallest
+    integer type that fits (compressed .npz), the cluster centers and the
+    consensus stability table when present, plus a JSON manifest recording
+    the folder the outputs were last written to.
+    """
+
+    def __init__(self):
+        self._versions = None
+
+    @staticmethod
+    def cache_dir_for(directory):
+        """On-disk location for results over a loaded folder (None disables the cache)."""
+        return Path(directory) / CACHE_DIR_NAME / RESULTS_DIR_NAME if directory else None
+
+    def key(self, fingerprint, algorithm, params, settings=None):
+        if self._versions is None:
+            self._versions = library_versions()
+        raw = repr((RESULT_FORMAT, fingerprint, algorithm, sorted(params.items()),
+                    sorted((settings or {}).items()), sorted(self._versions.items())))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _paths(cache_dir, key):
+        return Path(cache_dir) / f"{key}.json", Path(cache_dir) / f"{key}.npz"
+
+    def load(self, cache_dir, key):
+        """
+        The cached entry as a dict with 'labels', 'centers', 'stability' and
+        'output_dir' (None where absent), or None on a miss.
+        """
+        if cache_dir is None:
+            return None
+        meta_path, data_path = self._paths(cache_dir, key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with np.load(data_path) as arrays:
+                labels = arrays["labels"].astype(np.int32)
+                centers = arrays["centers"] if "centers" in arrays else None
+                stability = None
+                if "stability" in arrays:
+                    stability = pd.DataFrame(arrays["stability"], columns=meta["stability_columns"],
+                                             index=pd.Index(arrays["stability_index"], name="cluster_label"))
+                    stability['n_cells'] = stability['n_cells'].astype(np.int64)
+        except (OSError, ValueError, KeyError):
+            return None
+        return {'labels': labels, 'centers': centers, 'stability': stability, 'output_dir': meta.get("output_dir")}
+
+    def store(self, cache_dir, key, labels, centers=None, stability=None, output_dir=None, description=None):
+        if cache_dir is None:
+            return
+        labels = np.asarray(labels)
+        arrays = {'labels': labels.astype(np.min_scalar_type(int(labels.max())) if labels.min() >= 0 else np.int32)}
+        meta = {'format': RESULT_FORMAT, 'output_dir': str(output_dir) if output_dir else None,
+                'description': description}
+        if centers is not None:
+            arrays['centers'] = np.asarray(centers)
+        if stability is not None:
+            arrays['stability'] = stability.to_numpy(dtype=np.float64)
+            arrays['stability_index'] = stability.index.to_numpy()
+            meta['stability_columns'] = list(stability.columns)
+
+        try:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            meta_path, data_path = self._paths(cache_dir, key)
+            tmp = data_path.with_name(data_path.stem + ".tmp.npz")
+            np.savez_compressed(tmp, **arrays)
+            os.replace(tmp, data_path)
+            self.set_output_dir(cache_dir, key, output_dir, meta)
+        except OSError:
+            # Read-only folder: the result just isn't cached
+            pass
+
+    def set_output_dir(self, cache_dir, key, output_dir, meta=None):
+        """Record where the outputs of a cached result now live."""
+        meta_path, _ = self._paths(cache_dir, key)
+        try:
+            if meta is None:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            meta['output_dir'] = str(output_dir) if output_dir else None
+            tmp = meta_path.with_name(meta_path.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp, meta_path)
+        except (OSError, ValueError):
+            pass
@@ -0,0 +1,130 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.utils.cancellation import checkpoint
+from src.utils.feature_store import _remove_quietly
+
+MANIFEST_NAME = "manifest.json"
+ORIGINAL_INDEX_NAME = "original_index.npy"
+LAYOUT_FORMAT = 1
+COMBINED_NAME = "combined_results"
+
+
+def read_table(path, columns=None, nrows=None):
+    """Read a CSV, Parquet or Feather table (by extension), optionally only some columns or rows."""
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".csv":
+        return pd.read_csv(path, usecols=columns, nrows=nrows)
+    if suffix == ".parquet":
+        df = pd.read_parquet(path, columns=columns)
+    elif suffix == ".feather":
+        df = pd.read_feather(path, columns=columns)
+    else:
+        raise ValueError(f"Unsupported table format: {path.name}")
+    return df.head(nrows) if nrows is not None else df
+
+
+class ResultDataset:
+    """
+    Partitioned clustering results: one table per input sample (its cells,
+    cluster_label and the source columns) plus ``manifest.json`` listing the
+    partitions in order with their row counts, and ``original_index.npy``
+    with the row of every cell in its source file. Each cell is stored once;
+    the combined view (all partitions with ``_file_id`` and
+    ``_original_index``) is assembled lazily, partition by partition, and can
+    be exported as a single CSV on demand.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        try:
+            with open(self.directory / MANIFEST_NAME, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Not a clustering results folder: {self.directory}") from e
+        if manifest.get("layout") != LAYOUT_FORMAT:
+            raise ValueError(f"Unsupported results layout in {self.directory}")
+        self.table_format = manifest["table_format"]
+        self.columns = list(manifest["columns"])
+        self.partitions = manifest["partitions"]  # [{'file_id', 'path', 'n_rows', 'offset'}]
+        self.n_rows = int(manifest["n_rows"])
+
+    @staticmethod
+    def is_dataset(directory):
+        return directory is not None and (Path(directory) / MANIFEST_NAME).is_file()
+
+    @staticmethod
+    def write_manifest(directory, table_format, columns, partitions, original_index):
+        """
+        Record a written dataset: partitions is a list of (file_id, path, n_rows)
+        in row order. The manifest is written last (atomically), so a folder
+        with a manifest holds a complete dataset.
+        """
+        directory = Path(directory)
+        index_path = directory / ORIGINAL_INDEX_NAME
+        tmp = index_path.with_name(index_path.name + ".tmp.npy")
+        np.save(tmp, np.asarray(original_index))
+        os.replace(tmp, index_path)
+
+        entries, offset = [], 0
+        for file_id, path, n_rows in partitions:
+            entries.append({'file_id': str(file_id), 'path': Path(path).name, 'n_rows': int(n_rows), 'offset': offset})
+            offset += int(n_rows)
+        manifest = {'layout': LAYOUT_FORMAT, 'table_format': table_format, 'columns': list(columns),
+                    'n_rows': offset, 'partitions': entries}
+        manifest_path = directory / MANIFEST_NAME
+        tmp = manifest_path.with_name(manifest_path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, manifest_path)
+        return manifest_path
+
+    def partition_paths(self):
+        return [self.directory / p['path'] for p in self.partitions]
+
+    def read_partition(self, partition, columns=None):
+        """One partition (entry of partitions, or its file id) as a DataFrame."""
+        if not isinstance(partition, dict):
+            file_id = str(partition)
+            partition = next((p for p in self.partitions if p['file_id'] == file_id), None)
+            if partition is None:
+                raise ValueError(f"No partition for sample {file_id}")
+        return read_table(self.directory / partition['path'], columns=columns)
+
+    def original_index(self):
+        """Row of every cell in its source file, in partition order (memory-mapped)."""
+        return np.load(self.directory / ORIGINAL_INDEX_NAME, mmap_mode="r")
+
+    def iter_combined(self, columns=None):
+        """Yield the combined view one partition at a time, with _file_id and _original_index added."""
+        original_index = self.original_index()
+        for partition in self.partitions:
+            checkpoint()
+            df = self.read_partition(partition, columns)
+            rows = slice(partition['offset'], partition['offset'] + partition['n_rows'])
+            df['_file_id'] = partition['file_id']
+            df['_original_index'] = np.asarray(original_index[rows])
+            yield df
+
+    def read_combined(self, columns=None):
+        """The whole combined view in memory; prefer iter_combined for large datasets."""
+        return pd.concat(list(self.iter_combined(columns)), ignore_index=True)
+
+    def export_combined_csv(self, path=None):
+        """Write the combined view as one CSV (default: combined_results.csv in the folder)."""
+        path = Path(path) if path is not None else self.directory / f"{COMBINED_NAME}.csv"
+        tmp = path.with_name(path.name + ".tmp")
+        try:
+            with open(tmp, "w", encoding="utf-8", newline="") as f:
+                for i, df in enumerate(self.iter_combined()):
+                    df.to_csv(f, index=False, header=i == 0)
+            os.replace(tmp, path)
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+        return path
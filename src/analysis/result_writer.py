@@ -0,0 +1,207 @@
+import csv
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.analysis.result_dataset import COMBINED_NAME, ResultDataset
+from src.utils.cancellation import activate, active_token, checkpoint
+from src.utils.feature_store import DEFAULT_CHUNK_ROWS, _remove_quietly
+from src.utils.parallel import resolve_cpu_budget
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+RESULT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+WRITE_CHUNK_ROWS = DEFAULT_CHUNK_ROWS // 4  # rows converted and written at a time
+
+
+def result_file_name(stem, fmt="csv"):
+    """File name of a result table in the given format, e.g. combined_results.parquet."""
+    if fmt not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format: {fmt}")
+    return f"{stem}{RESULT_FORMATS[fmt]}"
+
+
+def _needs_quoting(block):
+    """Whether a text column of the block contains a comma, quote or line break."""
+    return any(block[c].astype(str).str.contains(r'[,"\r\n]', na=False).any()
+               for c in block.columns if pd.api.types.is_string_dtype(block[c].dtype))
+
+
+class ResultWriter:
+    """
+    Writes clustering results (cluster_label + the loaded columns) straight
+    from the loader's arrays, a block of rows at a time, so the merged
+    results frame is never built or copied.
+
+    The per-file tables (and the combined table when requested) are written
+    concurrently on a thread pool of n_jobs threads (None/0 = all cores).
+    float_precision rounds marker values to that many decimals (None keeps
+    full precision), which shrinks CSVs considerably. Formats are 'csv',
+    'parquet' and 'feather' (Arrow IPC); the binary formats need pyarrow,
+    which also provides a much faster, GIL-releasing CSV encoder (pandas is
+    used for CSV otherwise). Each file is written to a temporary name and
+    moved into place when complete.
+    """
+
+    def __init__(self, data_loader, labels, fmt="csv", float_precision=None, n_jobs=None,
+                 chunk_rows=WRITE_CHUNK_ROWS):
+        if fmt not in RESULT_FORMATS:
+            raise ValueError(f"Unknown result format: {fmt}")
+        if fmt != "csv" and not PYARROW_AVAILABLE:
+            raise ImportError("pyarrow is not installed. Please install it to use this feature.")
+        if data_loader.feature_matrix is None or len(labels) != data_loader.feature_matrix.shape[0]:
+            raise ValueError("Labels do not match the loaded data")
+        self.data_loader = data_loader
+        self.labels = np.asarray(labels)
+        self.fmt = fmt
+        self.float_precision = None if float_precision is None else int(float_precision)
+        self.n_jobs = n_jobs
+        self.chunk_rows = int(chunk_rows)
+
+    def columns(self, per_file=False):
+        """Output columns: cluster_label, the source columns and (combined only) _file_id, _original_index."""
+        # A cluster_label column in the input is replaced by the new labels
+        columns = ['cluster_label'] + [c for c in self.data_loader.columns if c != 'cluster_label']
+        return columns if per_file else columns + ['_file_id', '_original_index']
+
+    def _block(self, start, stop, columns):
+        loader = self.data_loader
+        features = np.asarray(loader.feature_matrix[start:stop])
+        if self.float_precision is not None:
+            features = np.round(features, self.float_precision)
+        feature_pos = {c: i for i, c in enumerate(loader.feature_columns)}
+        data = {}
+        for c in columns:
+            if c == 'cluster_label':
+                data[c] = self.labels[start:stop]
+            elif c == '_file_id':
+                data[c] = np.asarray(loader.file_ids.categories, dtype=object)[loader.file_ids.codes[start:stop]]
+            elif c == '_original_index':
+                data[c] = loader.original_index[start:stop]
+            elif c in feature_pos:
+                data[c] = features[:, feature_pos[c]]
+            else:
+                data[c] = loader.reserved_data[c][start:stop]
+        return pd.DataFrame(data, columns=columns)
+
+    def _open(self, path):
+        # (write_block, close) for one output file
+        if self.fmt == "csv" and not PYARROW_AVAILABLE:
+            f = open(path, "w", encoding="utf-8", newline="")
+            first = [True]
+
+            def write(block):
+                block.to_csv(f, index=False, header=first[0])
+                first[0] = False
+            return write, f.close
+
+        if self.fmt == "csv":
+            return self._open_csv(path)
+
+        writer = [None]
+
+        def write(block):
+            if writer[0] is None:
+                table = pa.Table.from_pandas(block, preserve_index=False)
+                if self.fmt == "parquet":
+                    writer[0] = pq.ParquetWriter(str(path), table.schema)
+                else:
+                    writer[0] = pa.ipc.new_file(str(path), table.schema,
+                                                options=pa.ipc.IpcWriteOptions(compression="lz4"))
+            else:
+                table = pa.Table.from_pandas(block, schema=writer[0].schema, preserve_index=False)
+            writer[0].write_table(table)
+
+        def close():
+            if writer[0] is not None:
+                writer[0].close()
+        return write, close
+
+    @staticmethod
+    def _open_csv(path):
+        # pyarrow quotes every string cell unless told otherwise; pandas quotes only the cells that need it
+        sink = open(path, "wb")
+        schema = [None]
+
+        def write(block):
+            if schema[0] is None:
+                # Header written as pandas does (pyarrow would quote every column name)
+                header = io.StringIO()
+                csv.writer(header, lineterminator="\n").writerow(block.columns)
+                sink.write(header.getvalue().encode("utf-8"))
+                table = pa.Table.from_pandas(block, preserve_index=False)
+                schema[0] = table.schema
+            else:
+                table = pa.Table.from_pandas(block, schema=schema[0], preserve_index=False)
+            # Unquoted as in the pandas CSVs; a block with separators, quotes or newlines in its text
+            # needs quoting, which pyarrow then applies to all of its text cells
+            quoting = "needed" if _needs_quoting(block) else "none"
+            pa_csv.write_csv(table, sink, write_options=pa_csv.WriteOptions(include_header=False,
+                                                                             quoting_style=quoting))
+        return write, sink.close
+
+    def write_table(self, path, rows=None, per_file=False):
+        """Write the rows of the slice rows (all rows when None) to path."""
+        path = Path(path)
+        rows = rows if rows is not None else slice(0, len(self.labels))
+        columns = self.columns(per_file)
+        tmp = path.with_name(path.name + ".tmp")
+        write, close = self._open(tmp)
+        try:
+            try:
+                for start in range(rows.start, max(rows.stop, rows.start + 1), self.chunk_rows):
+                    checkpoint()
+                    write(self._block(start, min(start + self.chunk_rows, rows.stop), columns))
+            finally:
+                close()
+            os.replace(tmp, path)
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+        return path
+
+    def write(self, output_dir, combined=False, per_file_suffix="_clustered"):
+        """
+        Write the partitioned result dataset into output_dir (see
+        ResultDataset): one <file>_clustered table per input file, the
+        original row index of every cell and manifest.json. With combined,
+        combined_results is written as well. Returns the manifest path.
+        """
+        out_path = Path(output_dir)
+        out_path.mkdir(parents=True, exist_ok=True)
+        partitions = [(file_id, out_path / result_file_name(f"{file_id}{per_file_suffix}", self.fmt), rows)
+                      for file_id, rows in self.data_loader.file_slices.items()]
+        tasks = [(path, rows, True) for _, path, rows in partitions]
+        if combined:
+            # Largest table first, so it does not end up running alone
+            tasks.insert(0, (out_path / result_file_name(COMBINED_NAME, self.fmt), None, False))
+
+        # Helper threads check the caller's cancellation token as well
+        token = active_token()
+
+        def run(task):
+            with activate(token):
+                return self.write_table(*task)
+
+        workers = max(1, min(len(tasks), resolve_cpu_budget(self.n_jobs)))
+        if workers == 1:
+            for task in tasks:
+                run(task)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(run, tasks))
+
+        return ResultDataset.write_manifest(
+            out_path, self.fmt, self.columns(per_file=True),
+            [(file_id, path, rows.stop - rows.start) for file_id, path, rows in partitions],
+            self.data_loader.original_index)
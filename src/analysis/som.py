@@ -0,0 +1,179 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import pdist, squareform
+
+from src.utils.feature_store import iter_row_chunks
+
+SOM_CHUNK_ROWS = 65536  # cells per block; bounds the (block x nodes) distance matrix
+
+
+def grid_coordinates(xdim, ydim):
+    """(xdim * ydim, 2) grid positions of the SOM nodes, x varying fastest."""
+    xs, ys = np.meshgrid(np.arange(xdim), np.arange(ydim))
+    return np.column_stack([xs.ravel(), ys.ravel()]).astype(np.float64)
+
+
+def _nearest_nodes(chunk, codebook, codebook_sq):
+    # argmin ||x - w||^2 = argmin (||w||^2 - 2 x.w); ||x||^2 is constant per row
+    scores = chunk @ codebook.T
+    scores *= -2.0
+    scores += codebook_sq
+    return np.argmin(scores, axis=1).astype(np.int32)
+
+
+def _node_sums(data, codebook, chunk_size):
+    """Per-node sums and counts of the cells assigned to each node, accumulated chunk by chunk."""
+    n_nodes, n_features = codebook.shape
+    sums = np.zeros((n_nodes, n_features), dtype=np.float64)
+    counts = np.zeros(n_nodes, dtype=np.int64)
+    codebook = codebook.astype(data.dtype, copy=False)
+    codebook_sq = np.einsum("ij,ij->i", codebook, codebook)
+    for _, chunk in iter_row_chunks(data, chunk_size):
+        chunk = np.asarray(chunk)
+        nodes = _nearest_nodes(chunk, codebook, codebook_sq)
+        onehot = sp.csr_matrix((np.ones(len(nodes), dtype=chunk.dtype), (np.arange(len(nodes)), nodes)),
+                               shape=(len(nodes), n_nodes))
+        sums += onehot.T @ chunk
+        counts += np.bincount(nodes, minlength=n_nodes)
+    return sums, counts
+
+
+def train_som(data, xdim=10, ydim=10, rlen=10, seed=None, chunk_size=SOM_CHUNK_ROWS, state=None, on_epoch=None):
+    """
+    Batch self-organizing map. The codebook starts from randomly drawn cells;
+    each of the rlen epochs assigns every cell to its best-matching unit in
+    chunks, then sets each node to the neighbourhood-weighted mean of the
+    cells mapped around it. The Gaussian neighbourhood radius shrinks linearly
+    from the 0.67 quantile of grid distances (FlowSOM's default) to zero, so
+    the last epoch is a plain k-means step on the nodes.
+
+    Training can be resumed: state is a (completed epochs, codebook) pair
+    saved from an interrupted run, and on_epoch(epoch, codebook) is called
+    after every epoch so the caller can save one. Resuming gives the same
+    codebook as an uninterrupted run.
+
+    Returns the (xdim * ydim, n_features) codebook.
+    """
+    data_rows = data.shape[0]
+    n_nodes = int(xdim) * int(ydim)
+    if data_rows < n_nodes:
+        raise ValueError(f"Need at least {n_nodes} cells for a {xdim}x{ydim} SOM, got {data_rows}")
+
+    if state is not None:
+        first_epoch, codebook = int(state[0]), np.array(state[1], dtype=np.float64)
+    else:
+        rng = np.random.default_rng(seed)
+        start_rows = np.sort(rng.choice(data_rows, size=n_nodes, replace=False))
+        first_epoch, codebook = 0, np.asarray(data[start_rows], dtype=np.float64)
+
+    grid_dist = squareform(pdist(grid_coordinates(int(xdim), int(ydim))))
+    radius_start = np.quantile(grid_dist, 0.67)
+    rlen = max(1, int(rlen))
+    for epoch in range(first_epoch, rlen):
+        radius = radius_start * (1.0 - epoch / max(rlen - 1, 1))
+        if radius > 1e-3:
+            neighbourhood = np.exp(-(grid_dist ** 2) / (2.0 * radius ** 2))
+        else:
+            neighbourhood = np.eye(n_nodes)
+
+        sums, counts = _node_sums(data, codebook, chunk_size)
+        numerator = neighbourhood @ sums
+        denominator = neighbourhood @ counts
+        filled = denominator > 0
+        codebook[filled] = numerator[filled] / denominator[filled, None]
+        if on_epoch is not None:
+            on_epoch(epoch + 1, codebook)
+
+    return codebook
+
+
+def map_to_nodes(data, codebook, chunk_size=SOM_CHUNK_ROWS):
+    """Best-matching SOM node of every cell, computed in chunks."""
+    nodes = np.empty(data.shape[0], dtype=np.int32)
+    codebook = codebook.astype(data.dtype, copy=False)
+    codebook_sq = np.einsum("ij,ij->i", codebook, codebook)
+    for start, chunk in iter_row_chunks(data, chunk_size):
+        chunk = np.asarray(chunk)
+        nodes[start:start + len(chunk)] = _nearest_nodes(chunk, codebook, codebook_sq)
+    return nodes
+
+
+def consensus_resamples(codebook, reps=100, p_item=0.9, seed=None):
+    """
+    The resampling half of consensus metaclustering: reps random subsets of
+    p_item of the nodes and the average-linkage tree of each. The trees do
+    not depend on the number of metaclusters, so they can be cut at any k.
+    """
+    n_nodes = codebook.shape[0]
+    rng = np.random.default_rng(seed)
+    subset_size = min(n_nodes, max(2, int(round(p_item * n_nodes))))
+    resamples = []
+    for _ in range(int(reps)):
+        subset = np.sort(rng.choice(n_nodes, size=subset_size, replace=False))
+        resamples.append((subset, linkage(codebook[subset], method="average")))
+    return resamples
+
+
+def consensus_metaclusters(codebook, n_clusters, reps=100, p_item=0.9, seed=None, resamples=None):
+    """
+    Consensus hierarchical metaclustering of the SOM nodes (as in FlowSOM /
+    ConsensusClusterPlus): average-linkage clustering of reps random subsets
+    of p_item of the nodes, a node x node consensus matrix of how often two
+    nodes land in the same cluster, and a final average-linkage clustering of
+    1 - consensus cut at n_clusters. Pass resamples from consensus_resamples
+    to reuse the subset trees across several n_clusters.
+
+    Returns the 0-based metacluster of every node.
+    """
+    n_nodes = codebook.shape[0]
+    n_clusters = int(n_clusters)
+    if not 2 <= n_clusters <= n_nodes:
+        raise ValueError(f"Number of metaclusters must be between 2 and {n_nodes}, got {n_clusters}")
+
+    if resamples is None:
+        resamples = consensus_resamples(codebook, reps, p_item, seed)
+    together = np.zeros((n_nodes, n_nodes))
+    sampled = np.zeros((n_nodes, n_nodes))
+    for subset, tree in resamples:
+        labels = fcluster(tree, n_clusters, criterion="maxclust")
+        cell = np.ix_(subset, subset)
+        together[cell] += labels[:, None] == labels[None, :]
+        sampled[cell] += 1.0
+
+    consensus = np.divide(together, sampled, out=np.zeros_like(together), where=sampled > 0)
+    distance = 1.0 - consensus
+    np.fill_diagonal(distance, 0.0)
+    final = fcluster(linkage(squareform(distance, checks=False), method="average"), n_clusters, criterion="maxclust")
+    return (final - 1).astype(np.int32)
+
+
+class SomModel:
+    """
+    A trained SOM kept for reuse: the codebook, the node of every cell and
+    the key (data and training parameters) it was trained for. Metaclustering
+    only touches the xdim * ydim codebook, and the consensus subset trees are
+    computed once, so relabelling all cells for another number of
+    metaclusters is a lookup through node -> metacluster.
+    """
+
+    def __init__(self, codebook, nodes, key, seed=None):
+        self.codebook = codebook
+        self.nodes = nodes
+        self.key = key
+        self.seed = seed
+        self._resamples = None
+        self._node_clusters = {}  # n_clusters -> metacluster per node
+
+    def node_metaclusters(self, n_clusters):
+        n_clusters = int(n_clusters)
+        if n_clusters not in self._node_clusters:
+            if self._resamples is None:
+                self._resamples = consensus_resamples(self.codebook, seed=self.seed)
+            self._node_clusters[n_clusters] = consensus_metaclusters(self.codebook, n_clusters,
+                                                                     resamples=self._resamples)
+        return self._node_clusters[n_clusters]
+
+    def labels(self, n_clusters):
+        """0-based metacluster of every cell."""
+        return self.node_metaclusters(n_clusters)[self.nodes]
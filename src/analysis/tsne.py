@@ -0,0 +1,128 @@
+import numpy as np
+from sklearn.manifold._t_sne import _joint_probabilities_nn, _kl_divergence_bh
+from sklearn.neighbors import NearestNeighbors
+
+from src.utils.cancellation import checkpoint
+
+# scikit-learn's TSNE schedule and defaults (TSNE._EXPLORATION_MAX_ITER, TSNE._N_ITER_CHECK)
+EARLY_EXAGGERATION = 12.0
+EXPLORATION_ITER = 250  # iterations with early exaggeration
+N_ITER_CHECK = 50  # iterations between KL divergence evaluations
+MIN_GAIN = 0.01
+# scikit-learn's floor is 50, which converged worse than the former fixed 200 on up to ~10,000 cells
+MIN_AUTO_LEARNING_RATE = 200.0
+
+_STATE_ARRAYS = ("embedding", "update", "gains")
+
+
+def auto_learning_rate(n_samples):
+    """scikit-learn's learning_rate='auto', n / early exaggeration / 4, but at least MIN_AUTO_LEARNING_RATE."""
+    return max(n_samples / EARLY_EXAGGERATION / 4, MIN_AUTO_LEARNING_RATE)
+
+
+def squared_knn_distances(data, n_neighbors, n_jobs=None):
+    """CSR of squared euclidean distances from every row to its n_neighbors nearest other rows (exact search)."""
+    distances = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=n_jobs).fit(data).kneighbors_graph(mode="distance")
+    distances.data **= 2
+    return distances
+
+
+def joint_probabilities(distances, perplexity):
+    """Symmetric sparse t-SNE affinities P from a CSR of squared kNN distances (same k in every row)."""
+    # scikit-learn sorts the indices in place, which would reorder arrays shared with the kNN cache
+    return _joint_probabilities_nn(distances.sorted_indices(), perplexity, 0)
+
+
+def _start_phase(state):
+    # Each phase starts with zero momentum, unit gains and fresh progress tracking, as in scikit-learn
+    state['update'] = np.zeros_like(state['embedding'])
+    state['gains'] = np.ones_like(state['embedding'])
+    state['best_error'] = float(np.finfo(float).max)
+    state['best_iter'] = state['iteration']
+
+
+def _restore(saved):
+    state = {name: np.array(saved[name], dtype=np.float32) for name in _STATE_ARRAYS}
+    state.update(iteration=int(saved['iteration']), exploring=bool(saved['exploring']),
+                 best_error=float(saved['best_error']), best_iter=int(saved['best_iter']),
+                 kl_divergence=float(saved['kl_divergence']), previous_kl=float(saved['previous_kl']),
+                 stop_reason=str(saved['stop_reason']))
+    return state
+
+
+def optimize_tsne(P, init, learning_rate, n_iter=1000, angle=0.5, n_threads=1, n_iter_without_progress=300,
+                  min_grad_norm=1e-7, kl_tol=None, state=None, on_check=None):
+    """
+    Barnes-Hut t-SNE gradient descent on the affinities P, step for step the
+    optimizer of scikit-learn's TSNE: EXPLORATION_ITER iterations with early
+    exaggeration and momentum 0.5, then momentum 0.8 with fresh gains; the
+    KL divergence is evaluated every N_ITER_CHECK iterations and the run
+    stops after n_iter_without_progress iterations without improvement or
+    once the gradient norm drops below min_grad_norm. With kl_tol it also
+    stops once an evaluation after the exploration phase lowers the KL
+    divergence by less than kl_tol (relative to the previous evaluation),
+    the opt-SNE criterion.
+
+    The whole optimizer state (embedding, update, gains, progress tracking)
+    lives in a dict: on_check(state) is called after every KL evaluation so
+    the caller can save it (or end the run by setting state['stop_reason']),
+    and passing a saved state resumes exactly where it was taken.
+
+    Returns (embedding, state); state['stop_reason'] is '' when all n_iter
+    iterations ran.
+    """
+    n_samples = P.shape[0]
+    if state is None:
+        state = {'iteration': 0, 'exploring': True, 'embedding': np.array(init, dtype=np.float32).ravel(),
+                 'kl_divergence': float("nan"), 'previous_kl': float("nan"), 'stop_reason': ""}
+        _start_phase(state)
+    else:
+        state = _restore(state)
+    learning_rate = float(learning_rate)
+    exaggerated = P * EARLY_EXAGGERATION
+
+    while state['iteration'] < n_iter and not state['stop_reason']:
+        checkpoint()
+        i, exploring = state['iteration'], state['exploring']
+        evaluate = (i + 1) % N_ITER_CHECK == 0
+        error, grad = _kl_divergence_bh(state['embedding'], exaggerated if exploring else P, 1, n_samples, 2,
+                                        angle=angle, compute_error=evaluate or i == n_iter - 1,
+                                        num_threads=n_threads)
+        update, gains = state['update'], state['gains']
+        inc = update * grad < 0.0
+        gains[inc] += 0.2
+        gains[~inc] *= 0.8
+        np.clip(gains, MIN_GAIN, np.inf, out=gains)
+        grad *= gains
+        update *= 0.5 if exploring else 0.8
+        update -= learning_rate * grad
+        state['embedding'] += update
+        state['iteration'] = i + 1
+        if evaluate or i == n_iter - 1:
+            state['kl_divergence'] = float(error)
+        if not evaluate:
+            continue
+
+        reason = ""
+        if error < state['best_error']:
+            state['best_error'], state['best_iter'] = float(error), i
+        elif i - state['best_iter'] > (EXPLORATION_ITER if exploring else n_iter_without_progress):
+            reason = "no progress"
+        if not reason and np.linalg.norm(grad) <= min_grad_norm:
+            reason = "gradient norm"
+        if exploring:
+            # The exploration phase ends on schedule or when it stops making progress
+            if reason or state['iteration'] >= EXPLORATION_ITER:
+                state['exploring'] = False
+                _start_phase(state)
+        else:
+            # Values from the exploration phase are on the exaggerated affinities and are not compared
+            previous = state['previous_kl']
+            if not reason and kl_tol is not None and previous - error < kl_tol * previous:
+                reason = "KL plateau"
+            state['previous_kl'] = float(error)
+            state['stop_reason'] = reason
+        if on_check is not None:
+            on_check(state)
+
+    return state['embedding'].reshape(n_samples, 2), state
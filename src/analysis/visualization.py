@@ -18,16 +18,21 @@ class Visualizer:
                 return f"Cluster {group_value}"
         return str(group_value)
     @staticmethod
-    def plot_heatmap(data, labels, feature_names, output_path, dpi=300):
+    def plot_heatmap(data, labels, feature_names, output_path, dpi=300, cluster_means=None):
         """
         Generates heatmap of cluster mean expression levels.
+        Pass cluster_means (clusters x features, e.g. ClusterSummary.means_df())
+        to plot precomputed means; data and labels are then not used.
         """
-        # Create DataFrame
-        df = pd.DataFrame(data, columns=feature_names)
-        df['Cluster'] = labels
-        
-        # Calculate mean expression per cluster
-        cluster_means = df.groupby('Cluster').mean()
+        if cluster_means is None:
+            # Create DataFrame
+            df = pd.DataFrame(data, columns=feature_names)
+            df['Cluster'] = labels
+
+            # Calculate mean expression per cluster
+            cluster_means = df.groupby('Cluster').mean()
+        else:
+            cluster_means = cluster_means.rename_axis('Cluster')
         
         # Create Clustermap
         # standard_scale=1 normalizes columns to 0-1 range, matching the "Normalized intensity" style
@@ -249,3 +254,27 @@ class Visualizer:
         plt.tight_layout()
         plt.savefig(output_path, dpi=dpi, bbox_inches="tight")
         plt.close()
+
+    @staticmethod
+    def plot_cluster_sweep(sweep_df, output_path, dpi=300):
+        """
+        Quality scores against the number of clusters (one panel per score)
+        from ClusterManager.sweep_n_clusters.
+        """
+        df = pd.DataFrame(sweep_df)
+        if df.shape[0] == 0:
+            raise ValueError("No data available for plotting.")
+
+        panels = [("inertia", "Inertia (lower is better)"),
+                  ("silhouette", "Silhouette (higher is better)"),
+                  ("davies_bouldin", "Davies-Bouldin (lower is better)")]
+        fig, axes = plt.subplots(1, len(panels), figsize=(15, 4.5))
+        for ax, (column, title) in zip(axes, panels):
+            ax.plot(df.index, df[column], marker="o", color="#3a4a7a")
+            ax.set_title(title)
+            ax.set_xlabel("Number of clusters")
+            ax.set_xticks(df.index)
+            ax.grid(alpha=0.3)
+        plt.tight_layout()
+        plt.savefig(output_path, dpi=dpi, bbox_inches="tight")
+        plt.close()
@@ -5,15 +5,32 @@ import numpy as np
 from pathlib import Path
 from src.gui.tabs import ClusteringTab, DimReductionTab, CsvProcessorTab, DifferenceAnalysisTab
 from src.gui.workers import AnalysisWorker
+from src.utils.cancellation import checkpoint
 from src.utils.data_loader import DataLoader
 from src.analysis.clustering import ClusterManager
 from src.analysis.dim_reduction import DimReductionManager
+from src.analysis.preprocessing import ArcsinhTransform, PreprocessingCache
+from src.analysis.knn_cache import KnnGraphCache
 from src.analysis.visualization import Visualizer
+from src.analysis.result_writer import result_file_name
+from src.analysis.result_dataset import COMBINED_NAME, MANIFEST_NAME
 from src.analysis.csv_processor import CsvSplitter, CsvMapper
 from src.analysis.difference_analysis import DifferenceAnalyzer
 
 from datetime import datetime
 
+# Stamp in each results folder naming the cached result its outputs belong to
+RESULT_KEY_FILE = ".result_key"
+
+# Clustering tab algorithm -> ClusterManager.run_<name>
+CLUSTERING_ALGORITHMS = {
+    "KMeans": "kmeans",
+    "Mini-batch KMeans": "minibatch_kmeans",
+    "Graph (Leiden/Louvain)": "graph_clustering",
+    "Phenograph": "phenograph",
+    "FlowSOM": "flowsom",
+}
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -22,8 +39,12 @@ class MainWindow(QMainWindow):
         
         # State
         self.data_loader = DataLoader()
-        self.cluster_manager = ClusterManager(self.data_loader)
-        self.dim_manager = DimReductionManager(self.data_loader)
+        self.preprocessing_cache = PreprocessingCache()  # shared so clustering and embedding transform and scale once
+        self.knn_cache = KnnGraphCache()  # shared so graph clustering, UMAP and t-SNE build the kNN graph once
+        self.cluster_manager = ClusterManager(self.data_loader, preprocessing_cache=self.preprocessing_cache,
+                                              knn_cache=self.knn_cache)
+        self.dim_manager = DimReductionManager(self.data_loader, preprocessing_cache=self.preprocessing_cache,
+                                               knn_cache=self.knn_cache)
         self.csv_splitter = CsvSplitter()
         self.csv_mapper = CsvMapper()
         self.difference_analyzer = DifferenceAnalyzer()
@@ -67,10 +88,11 @@ class MainWindow(QMainWindow):
         worker = AnalysisWorker(self.run_clustering_logic, config)
         worker.result.connect(self.on_clustering_finished)
         worker.error.connect(self.on_clustering_error)
+        worker.cancelled.connect(lambda: self.on_analysis_cancelled(self.clustering_tab))
         worker.finished.connect(lambda: self.clustering_tab.run_btn.setEnabled(True))
         worker.finished.connect(lambda: self.clustering_tab.stop_btn.setEnabled(False))
         worker.finished.connect(lambda: self.clustering_tab.progress.setRange(0, 100))
-        worker.finished.connect(lambda: self.clustering_tab.progress.setValue(100))
+        worker.finished.connect(lambda: self.clustering_tab.progress.setValue(0 if worker.is_cancelled() else 100))
         worker.start()
         self.worker = worker # Keep reference
 
@@ -78,43 +100,179 @@ class MainWindow(QMainWindow):
         input_dir = config['input_dir']
         
         # 1. Load Data
-        if not self.data_loader.get_merged_data() is not None or self.input_dir_changed(input_dir):
-            self.data_loader.load_directory(input_dir)
-            self.current_input_dir = input_dir
-            
+        load_note = self.load_clustering_data(config)
+
         # 2. Clustering
-        algo = config['algorithm']
+        algo = CLUSTERING_ALGORITHMS[config['algorithm']]
         params = config['params']
-        
-        if algo == "KMeans":
-            self.cluster_manager.run_kmeans(**params)
-        elif algo == "Phenograph":
-            self.cluster_manager.run_phenograph(**params)
-        elif algo == "FlowSOM":
-            self.cluster_manager.run_flowsom(**params)
+        if algo == 'kmeans' and not params.get('n_jobs'):
+            # "Default" runs the restarts in-process; a core count opts into the process pool
+            params = dict(params, n_jobs=None)
+        subsample = config.get('subsample')
+        consensus = config.get('consensus')
+
+        if config.get('sweep'):
+            return self.run_sweep_logic(config, algo, params, load_note)
+        if consensus and subsample:
+            raise ValueError("Consensus and subsample-and-extend cannot be combined; choose one.")
+        result_key = self.cluster_manager.result_key(algo, params, mode={'subsample': subsample, 'consensus': consensus})
+        cached = self.cluster_manager.restore_result(result_key)
+        if cached is None:
+            if consensus:
+                self.cluster_manager.run_consensus(algo, params=params, n_jobs=params.get('n_jobs', 0), **consensus)
+            elif subsample:
+                self.cluster_manager.run_subsampled(algo, params=params, **subsample)
+            elif not self.cluster_manager.apply_sweep_result(algo, params):
+                getattr(self.cluster_manager, f"run_{algo}")(**params)
              
-        # 3. Save Results
-        timestamp = datetime.now().strftime("%y%m%d_%H%M")
-        self.output_dir = Path(input_dir) / "results" / "cluster_results" / timestamp
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        
-        saved_path = self.cluster_manager.save_results(self.output_dir)
+        # 3. Save Results (a cached result only rebuilds outputs missing from its last folder)
+        reuse_dir = cached is not None and self.output_dir_holds(cached['output_dir'], result_key)
+        if reuse_dir:
+            self.output_dir = Path(cached['output_dir'])
+        else:
+            timestamp = datetime.now().strftime("%y%m%d_%H%M")
+            self.output_dir = Path(input_dir) / "results" / "cluster_results" / timestamp
+            suffix = 1
+            while self.output_dir.exists():
+                # Another run saved this minute; keep its outputs intact
+                suffix += 1
+                self.output_dir = Path(input_dir) / "results" / "cluster_results" / f"{timestamp}_{suffix}"
+            self.output_dir.mkdir(parents=True)
+            (self.output_dir / RESULT_KEY_FILE).write_text(result_key, encoding="utf-8")
+
+        if cached is None:
+            # Stored before the outputs are written, so a run stopped while saving resumes with the saving
+            self.cluster_manager.store_result(result_key, self.output_dir, include_stability=bool(consensus),
+                                              description=f"{config['algorithm']} {params}")
+        elif Path(cached['output_dir'] or "") != self.output_dir:
+            self.cluster_manager.record_result_output_dir(result_key, self.output_dir)
+        outputs, rebuilt = self.save_clustering_outputs(self.output_dir, include_stability=bool(consensus),
+                                                        only_missing=reuse_dir, output=config.get('output'))
+
+        if cached is None:
+            message = f"Clustering completed. Results saved to {self.output_dir}"
+        else:
+            message = (f"Reused the cached result of an identical run ({len(rebuilt)} missing output(s) rebuilt). "
+                       f"Results are in {self.output_dir}")
+        if load_note:
+            message = f"{load_note}\n{message}"
+        if consensus:
+            message = f"{message}\nCluster stability saved to {outputs['stability']}"
+        return {
+            'message': message,
+            'run_log': self.cluster_manager.format_run_log(),
+            'heatmap': str(outputs['heatmap']),
+            'marker_means': str(outputs['marker_means']),
+            'file_counts': str(outputs['file_counts']),
+            'n_clusters': len(np.unique(self.cluster_manager.labels))
+        }
 
-        marker_means_path = self.cluster_manager.save_cluster_marker_means(self.output_dir)
-        
-        # 4. Generate Heatmap
-        heatmap_path = self.output_dir / "heatmap.png"
-        data = self.data_loader.get_feature_data().values
-        labels = self.cluster_manager.labels
-        features = self.data_loader.feature_columns
-        
-        Visualizer.plot_heatmap(data, labels, features, str(heatmap_path))
-         
+    @staticmethod
+    def output_dir_holds(output_dir, result_key):
+        # True when output_dir still holds the outputs of result_key (its key stamp matches)
+        if not output_dir:
+            return False
+        try:
+            return (Path(output_dir) / RESULT_KEY_FILE).read_text(encoding="utf-8").strip() == result_key
+        except OSError:
+            return False
+
+    def save_clustering_outputs(self, output_dir, include_stability=False, only_missing=False, output=None):
+        """
+        Write the clustering outputs into output_dir. With only_missing, files
+        that already exist are kept. output holds the result file 'format' and
+        'float_precision'. Returns ({output: path}, [rebuilt outputs]).
+        """
+        manager = self.cluster_manager
+        output = output or {}
+        fmt = output.get('format', 'csv')
+        results = [output_dir / MANIFEST_NAME] + [output_dir / result_file_name(f"{file_id}_clustered", fmt)
+                                                  for file_id in self.data_loader.file_slices]
+        if output.get('combined'):
+            results.append(output_dir / result_file_name(COMBINED_NAME, fmt))
+        outputs = {
+            'results': results,
+            'marker_means': output_dir / "cluster_marker_means.csv",
+            'file_counts': output_dir / "cluster_counts_per_file.csv",
+            'heatmap': output_dir / "heatmap.png",
+        }
+        if include_stability:
+            outputs['stability'] = output_dir / "cluster_stability.csv"
+
+        def write(name):
+            if name == 'results':
+                manager.save_results(output_dir, fmt=fmt, float_precision=output.get('float_precision'),
+                                     combined=bool(output.get('combined')))
+            elif name == 'marker_means':
+                manager.save_cluster_marker_means(output_dir)
+            elif name == 'file_counts':
+                manager.save_cluster_file_counts(output_dir)
+            elif name == 'stability':
+                manager.save_cluster_stability(output_dir)
+            else:
+                # Means come from the cluster summary, so the cells are not regrouped
+                summary = manager.summary()
+                Visualizer.plot_heatmap(None, None, summary.features, str(outputs['heatmap']),
+                                        cluster_means=summary.means_df())
+
+        rebuilt = []
+        for name, paths in outputs.items():
+            paths = paths if isinstance(paths, list) else [paths]
+            if only_missing and all(path.exists() for path in paths):
+                continue
+            checkpoint()
+            write(name)
+            rebuilt.append(name)
+        outputs['results'] = outputs['results'][0]
+        return outputs, rebuilt
+
+    def load_clustering_data(self, config):
+        # Load (or refresh) the input folder and apply the preprocessing settings; returns a reload note or None
+        input_dir = config['input_dir']
+        max_cells = config.get('max_cells_per_file')
+        load_note = None
+        self.data_loader.max_cells_per_file = max_cells
+        # A precision change reloads the folder (refresh compares the load settings)
+        self.data_loader.dtype = np.dtype(config.get('dtype') or np.float32)
+        if not self.data_loader.has_data() or self.input_dir_changed(input_dir):
+            self.data_loader.load_directory(input_dir)
+            self.current_input_dir = input_dir
+        else:
+            # Same folder: only parse files that were added or changed since the last load
+            changes = self.data_loader.refresh()
+            if any(changes.values()):
+                load_note = (f"Reloaded folder: {len(changes['added'])} added, "
+                             f"{len(changes['modified'])} modified, {len(changes['removed'])} removed file(s).")
+
+        transform_cfg = config.get('transform')
+        transform = ArcsinhTransform(**transform_cfg) if transform_cfg else None
+        self.cluster_manager.transform = transform
+        self.dim_manager.transform = transform
+        return load_note
+
+    def run_sweep_logic(self, config, algo, params, load_note):
+        # Compare cluster counts; only the table and plot are saved, not per-cell results
+        sweep = config['sweep']
+        table = self.cluster_manager.sweep_n_clusters(sweep['values'], algorithm=algo, params=params,
+                                                      n_jobs=params.get('n_jobs', 0),
+                                                      silhouette_cells=sweep['silhouette_cells'])
+
+        timestamp = datetime.now().strftime("%y%m%d_%H%M")
+        output_dir = Path(config['input_dir']) / "results" / "cluster_sweeps" / timestamp
+        output_dir.mkdir(parents=True, exist_ok=True)
+        table_path = output_dir / "n_clusters_sweep.csv"
+        plot_path = output_dir / "n_clusters_sweep.png"
+        table.to_csv(table_path, index=True)
+        Visualizer.plot_cluster_sweep(table, str(plot_path))
+
+        message = (f"Cluster count sweep completed. Comparison saved to {table_path}\n"
+                   "Set the chosen number of clusters and run without the sweep to save its results.")
+        if load_note:
+            message = f"{load_note}\n{message}"
         return {
-            'message': f"Clustering completed. Results saved to {saved_path}",
-            'heatmap': str(heatmap_path),
-            'marker_means': str(marker_means_path),
-            'n_clusters': len(set(labels))
+            'message': message,
+            'run_log': self.cluster_manager.format_run_log(),
+            'heatmap': str(plot_path),
         }
 
     def input_dir_changed(self, new_dir):
@@ -124,11 +282,19 @@ class MainWindow(QMainWindow):
         return self.current_input_dir != new_dir
 
     def on_clustering_finished(self, result):
+        for line in result.get('run_log', []):
+            self.clustering_tab.update_log(line)
         self.clustering_tab.update_log(result['message'])
         if 'marker_means' in result:
             self.clustering_tab.update_log(f"Cluster marker means saved to {result['marker_means']}")
-        self.clustering_tab.update_log(f"Found {result['n_clusters']} clusters.")
+        if 'file_counts' in result:
+            self.clustering_tab.update_log(f"Cells per cluster and file saved to {result['file_counts']}")
         self.clustering_tab.show_preview(result['heatmap'])
+        if 'n_clusters' not in result:
+            # Cluster count sweep: nothing labelled yet
+            self.status_bar.showMessage("Cluster count sweep completed.")
+            return
+        self.clustering_tab.update_log(f"Found {result['n_clusters']} clusters.")
         self.status_bar.showMessage("Clustering completed successfully.")
         
         # Update DimTab state if needed (e.g. enable it)
@@ -143,21 +309,32 @@ class MainWindow(QMainWindow):
         self.clustering_tab.stop_btn.setEnabled(False)
 
     def stop_analysis(self):
-        if hasattr(self, 'worker') and self.worker.isRunning():
+        # Cooperative stop: the worker raises at its next cancellation checkpoint and the
+        # UI is reset by its finished signal, so no thread is killed mid-write
+        if not (hasattr(self, 'worker') and self.worker.isRunning()):
+            return
+        stage = self.worker.blocking_stage()
+        if stage and self.worker.is_cancelled():
+            # Second Stop during a stage without checkpoints: hard stop, losing that stage's progress
             self.worker.terminate()
             self.worker.wait()
-            self.status_bar.showMessage("Analysis stopped by user.")
-            
-            # Reset UI
-            self.clustering_tab.run_btn.setEnabled(True)
-            self.clustering_tab.stop_btn.setEnabled(False)
-            self.clustering_tab.progress.setRange(0, 100)
-            self.clustering_tab.progress.setValue(0)
-            
-            self.dim_tab.run_btn.setEnabled(True)
-            self.dim_tab.stop_btn.setEnabled(False)
-            self.dim_tab.progress.setRange(0, 100)
-            self.dim_tab.progress.setValue(0)
+            self.worker.finished.emit()
+            self.status_bar.showMessage(f"Analysis force-stopped during {stage}; its progress was lost.")
+            return
+        self.worker.cancel()
+        if stage:
+            self.status_bar.showMessage(f"Stopping after {stage}, which cannot be interrupted. "
+                                        "Press Stop again to force it (its progress is lost).")
+            return
+        self.status_bar.showMessage("Stopping at the next checkpoint...")
+        self.clustering_tab.stop_btn.setEnabled(False)
+        self.dim_tab.stop_btn.setEnabled(False)
+
+    def on_analysis_cancelled(self, tab):
+        tab.update_log("Analysis stopped by user. Finished KMeans restarts, FlowSOM map training, t-SNE progress "
+                       "and saved result files were checkpointed; running again with the same settings resumes "
+                       "from them.")
+        self.status_bar.showMessage("Analysis stopped by user.")
 
     def start_visualization(self, config):
         custom_file = config.get('custom_file')
@@ -173,10 +350,11 @@ class MainWindow(QMainWindow):
         worker = AnalysisWorker(self.run_vis_logic, config)
         worker.result.connect(self.on_vis_finished)
         worker.error.connect(self.on_vis_error)
+        worker.cancelled.connect(lambda: self.on_analysis_cancelled(self.dim_tab))
         worker.finished.connect(lambda: self.dim_tab.run_btn.setEnabled(True))
         worker.finished.connect(lambda: self.dim_tab.stop_btn.setEnabled(False))
         worker.finished.connect(lambda: self.dim_tab.progress.setRange(0, 100))
-        worker.finished.connect(lambda: self.dim_tab.progress.setValue(100))
+        worker.finished.connect(lambda: self.dim_tab.progress.setValue(0 if worker.is_cancelled() else 100))
         worker.start()
         self.worker = worker
 
@@ -226,10 +404,9 @@ class MainWindow(QMainWindow):
             
         else:
             self.dim_manager.set_custom_data(None)
-            merged_df = self.data_loader.get_merged_data()
-            if merged_df is not None and 'cell_type' in {str(c).strip().lower() for c in merged_df.columns}:
-                cell_type_col = next(c for c in merged_df.columns if str(c).strip().lower() == 'cell_type')
-                labels = merged_df[cell_type_col].fillna("Unknown").astype(str).values
+            cell_types = self.data_loader.get_metadata_column('cell_type')
+            if cell_types is not None:
+                labels = pd.Series(cell_types).fillna("Unknown").astype(str).values
             else:
                 labels = self.cluster_manager.labels
             
@@ -247,8 +424,14 @@ class MainWindow(QMainWindow):
             self.output_dir.mkdir(parents=True, exist_ok=True)
         
         # 1. Run Reduction
+        run_log = []
         if algo == "t-SNE":
+            params = dict(params)
+            if not params.get('learning_rate'):
+                params['learning_rate'] = 'auto'
+            params['early_stopping'] = params.get('early_stopping') == "On"
             embedding = self.dim_manager.run_tsne(**params)
+            run_log = self.dim_manager.format_run_log()
         elif algo == "UMAP":
             embedding = self.dim_manager.run_umap(**params)
             
@@ -276,8 +459,8 @@ class MainWindow(QMainWindow):
             # Re-construct df from DataLoader
             # We might have multiple files merged.
             # Ideally DataLoader should provide a way to export merged df with metadata if needed.
-            # But currently `get_merged_data()` returns the merged DataFrame including file_id etc.
-            df = self.data_loader.get_merged_data().copy()
+            # `get_merged_data()` builds a fresh merged DataFrame including file_id etc.
+            df = self.data_loader.get_merged_data()
         
         # Determine column names based on algorithm
         if algo == "t-SNE":
@@ -302,10 +485,13 @@ class MainWindow(QMainWindow):
         
         return {
             'message': f"Visualization saved to {output_path}\nCoordinates saved to {csv_output_path}",
-            'image': str(output_path)
+            'image': str(output_path),
+            'run_log': run_log
         }
 
     def on_vis_finished(self, result):
+        for line in result.get('run_log', []):
+            self.dim_tab.update_log(line)
         self.dim_tab.update_log(result['message'])
         self.dim_tab.show_preview(result['image'])
         self.status_bar.showMessage("Visualization completed.")
@@ -90,16 +90,48 @@ class ClusteringTab(QWidget):
         
         input_layout.addWidget(self.dir_btn)
         input_layout.addWidget(self.dir_label)
+
+        sampling_layout = QFormLayout()
+        self.max_cells_spin = QSpinBox()
+        self.max_cells_spin.setRange(0, 100000000)
+        self.max_cells_spin.setSingleStep(10000)
+        self.max_cells_spin.setValue(0)
+        self.max_cells_spin.setSpecialValueText("All")
+        self.max_cells_spin.setToolTip("Randomly keep at most this many cells per file while loading (0 = all cells).")
+        sampling_layout.addRow("Cells per file:", self.max_cells_spin)
+        self.precision_combo = QComboBox()
+        self.precision_combo.addItems(["float32 (compact)", "float64 (exact)"])
+        self.precision_combo.setToolTip("Precision marker values are loaded and saved with. float32 halves memory "
+                                        "but keeps about 7 significant digits, so result files do not repeat the "
+                                        "source values exactly; float64 keeps them unchanged.")
+        sampling_layout.addRow("Value precision:", self.precision_combo)
+        input_layout.addLayout(sampling_layout)
+
         input_group.setLayout(input_layout)
         left_layout.addWidget(input_group)
 
+        # Preprocessing
+        prep_group = QGroupBox("Preprocessing")
+        prep_layout = QFormLayout()
+        self.arcsinh_check = QCheckBox("Arcsinh transform")
+        self.arcsinh_check.setToolTip("Apply arcsinh(x / cofactor) to every marker before scaling.")
+        self.cofactor_spin = QDoubleSpinBox()
+        self.cofactor_spin.setRange(0.1, 1000.0)
+        self.cofactor_spin.setValue(5.0)
+        self.cofactor_spin.setEnabled(False)
+        self.arcsinh_check.toggled.connect(self.cofactor_spin.setEnabled)
+        prep_layout.addRow(self.arcsinh_check)
+        prep_layout.addRow("Cofactor:", self.cofactor_spin)
+        prep_group.setLayout(prep_layout)
+        left_layout.addWidget(prep_group)
+
         # 2. Algorithm Settings
         algo_group = QGroupBox("Algorithm Settings")
         algo_layout = QFormLayout()
         algo_layout.setSpacing(15)
         
         self.algo_combo = QComboBox()
-        self.algo_combo.addItems(["KMeans", "Phenograph", "FlowSOM"])
+        self.algo_combo.addItems(["KMeans", "Mini-batch KMeans", "Graph (Leiden/Louvain)", "Phenograph", "FlowSOM"])
         self.algo_combo.currentTextChanged.connect(self.update_params)
         self.algo_combo.setMinimumHeight(30)
         algo_layout.addRow("Algorithm:", self.algo_combo)
@@ -111,7 +143,102 @@ class ClusteringTab(QWidget):
         
         algo_group.setLayout(algo_layout)
         left_layout.addWidget(algo_group)
-        
+
+        # Subsample-and-extend
+        subsample_group = QGroupBox("Subsample && Extend")
+        subsample_layout = QFormLayout()
+        self.subsample_check = QCheckBox("Cluster a subsample, then label all cells")
+        self.subsample_check.setToolTip("Run the algorithm on a per-file stratified subsample and "
+                                        "propagate its clusters to every cell.")
+        self.subsample_cells_spin = QSpinBox()
+        self.subsample_cells_spin.setRange(1000, 100000000)
+        self.subsample_cells_spin.setSingleStep(10000)
+        self.subsample_cells_spin.setValue(100000)
+        self.extend_combo = QComboBox()
+        self.extend_combo.addItems(["Nearest centroid", "kNN vote"])
+        self.extend_k_spin = QSpinBox()
+        self.extend_k_spin.setRange(1, 200)
+        self.extend_k_spin.setValue(15)
+        self.extend_k_spin.setToolTip("Neighbours per cell for the kNN vote.")
+        for widget in (self.subsample_cells_spin, self.extend_combo, self.extend_k_spin):
+            widget.setEnabled(False)
+            self.subsample_check.toggled.connect(widget.setEnabled)
+        subsample_layout.addRow(self.subsample_check)
+        subsample_layout.addRow("Subsample cells:", self.subsample_cells_spin)
+        subsample_layout.addRow("Extend labels by:", self.extend_combo)
+        subsample_layout.addRow("kNN k:", self.extend_k_spin)
+        subsample_group.setLayout(subsample_layout)
+        left_layout.addWidget(subsample_group)
+
+        # Multi-seed consensus
+        consensus_group = QGroupBox("Consensus")
+        consensus_layout = QFormLayout()
+        self.consensus_check = QCheckBox("Consensus over several seeds")
+        self.consensus_check.setToolTip("Repeat the algorithm with different seeds, label each cell by majority "
+                                        "and score how reproducible each cluster is.")
+        self.consensus_seeds_spin = QSpinBox()
+        self.consensus_seeds_spin.setRange(2, 100)
+        self.consensus_seeds_spin.setValue(10)
+        self.consensus_seeds_spin.setEnabled(False)
+        self.consensus_check.toggled.connect(self.consensus_seeds_spin.setEnabled)
+        consensus_layout.addRow(self.consensus_check)
+        consensus_layout.addRow("Seeds:", self.consensus_seeds_spin)
+        consensus_group.setLayout(consensus_layout)
+        left_layout.addWidget(consensus_group)
+
+        # Number-of-clusters sweep
+        sweep_group = QGroupBox("Cluster Count Sweep")
+        sweep_layout = QFormLayout()
+        self.sweep_check = QCheckBox("Compare a range of cluster counts")
+        self.sweep_check.setToolTip("KMeans / FlowSOM only: fit every count in the range, score each and save a "
+                                    "comparison table and plot instead of full results.")
+        self.sweep_from_spin = QSpinBox()
+        self.sweep_from_spin.setRange(2, 500)
+        self.sweep_from_spin.setValue(5)
+        self.sweep_to_spin = QSpinBox()
+        self.sweep_to_spin.setRange(2, 500)
+        self.sweep_to_spin.setValue(30)
+        self.sweep_step_spin = QSpinBox()
+        self.sweep_step_spin.setRange(1, 100)
+        self.sweep_step_spin.setValue(5)
+        self.silhouette_cells_spin = QSpinBox()
+        self.silhouette_cells_spin.setRange(500, 1000000)
+        self.silhouette_cells_spin.setSingleStep(5000)
+        self.silhouette_cells_spin.setValue(10000)
+        self.silhouette_cells_spin.setToolTip("Cells used for the silhouette score (it compares all pairs of cells).")
+        for widget in (self.sweep_from_spin, self.sweep_to_spin, self.sweep_step_spin, self.silhouette_cells_spin):
+            widget.setEnabled(False)
+            self.sweep_check.toggled.connect(widget.setEnabled)
+        sweep_layout.addRow(self.sweep_check)
+        sweep_layout.addRow("From:", self.sweep_from_spin)
+        sweep_layout.addRow("To:", self.sweep_to_spin)
+        sweep_layout.addRow("Step:", self.sweep_step_spin)
+        sweep_layout.addRow("Silhouette cells:", self.silhouette_cells_spin)
+        sweep_group.setLayout(sweep_layout)
+        left_layout.addWidget(sweep_group)
+
+        # Result files
+        output_group = QGroupBox("Output")
+        output_layout = QFormLayout()
+        self.output_format_combo = QComboBox()
+        self.output_format_combo.addItems(["CSV", "Parquet", "Feather"])
+        self.output_format_combo.setToolTip("Format of the combined and per-file results. Parquet and Feather "
+                                            "are much smaller and faster to write and read; they need pyarrow.")
+        self.decimals_spin = QSpinBox()
+        self.decimals_spin.setRange(-1, 10)
+        self.decimals_spin.setValue(-1)
+        self.decimals_spin.setSpecialValueText("Full")
+        self.decimals_spin.setToolTip("Round marker values in the result files to this many decimals. Full keeps "
+                                      "the loaded precision (see Value precision: float32 unless float64 is chosen).")
+        self.combined_check = QCheckBox("Also write combined table")
+        self.combined_check.setToolTip("Results are saved once per sample with a manifest that tools read as one "
+                                       "dataset. Tick to also write every cell again into combined_results.")
+        output_layout.addRow("Format:", self.output_format_combo)
+        output_layout.addRow("Decimals:", self.decimals_spin)
+        output_layout.addRow(self.combined_check)
+        output_group.setLayout(output_layout)
+        left_layout.addWidget(output_group)
+
         left_layout.addStretch()
 
         # 3. Execution (Moved to Bottom Left)
@@ -215,6 +342,21 @@ class ClusteringTab(QWidget):
             sb_iter.setValue(300)
             self.params['max_iter'] = sb_iter
             self.param_layout.addRow("Max Iter:", sb_iter)
+
+            sb_init = QSpinBox()
+            sb_init.setRange(1, 100)
+            sb_init.setValue(10)
+            self.params['n_init'] = sb_init
+            self.param_layout.addRow("Restarts (n_init):", sb_init)
+
+            sb_jobs = QSpinBox()
+            sb_jobs.setRange(0, os.cpu_count() or 1)
+            sb_jobs.setValue(0)
+            sb_jobs.setSpecialValueText("Default")
+            sb_jobs.setToolTip("Default runs the restarts one after another in this process. Choosing a core count "
+                               "runs them in parallel worker processes instead; the labels are the same.")
+            self.params['n_jobs'] = sb_jobs
+            self.param_layout.addRow("CPU Cores:", sb_jobs)
             
             sb_seed = QSpinBox()
             sb_seed.setRange(0, 10000)
@@ -222,6 +364,80 @@ class ClusteringTab(QWidget):
             self.params['random_state'] = sb_seed
             self.param_layout.addRow("Random Seed:", sb_seed)
 
+        elif algo == "Mini-batch KMeans":
+            sb_clusters = QSpinBox()
+            sb_clusters.setRange(2, 100)
+            sb_clusters.setValue(10)
+            self.params['n_clusters'] = sb_clusters
+            self.param_layout.addRow("Clusters (n):", sb_clusters)
+
+            sb_batch = QSpinBox()
+            sb_batch.setRange(256, 1000000)
+            sb_batch.setSingleStep(1024)
+            sb_batch.setValue(4096)
+            self.params['batch_size'] = sb_batch
+            self.param_layout.addRow("Batch Size:", sb_batch)
+
+            sb_iter = QSpinBox()
+            sb_iter.setRange(1, 500)
+            sb_iter.setValue(20)
+            self.params['max_iter'] = sb_iter
+            self.param_layout.addRow("Max Passes:", sb_iter)
+
+            sb_tol = QDoubleSpinBox()
+            sb_tol.setDecimals(6)
+            sb_tol.setRange(0.0, 1.0)
+            sb_tol.setSingleStep(0.0001)
+            sb_tol.setValue(0.0001)
+            self.params['tol'] = sb_tol
+            self.param_layout.addRow("Tolerance:", sb_tol)
+
+            sb_seed = QSpinBox()
+            sb_seed.setRange(0, 10000)
+            sb_seed.setValue(42)
+            self.params['random_state'] = sb_seed
+            self.param_layout.addRow("Random Seed:", sb_seed)
+
+        elif algo == "Graph (Leiden/Louvain)":
+            sb_k = QSpinBox()
+            sb_k.setRange(5, 200)
+            sb_k.setValue(30)
+            self.params['k'] = sb_k
+            self.param_layout.addRow("Neighbors (k):", sb_k)
+
+            cb_method = QComboBox()
+            cb_method.addItems(["leiden", "louvain"])
+            self.params['method'] = cb_method
+            self.param_layout.addRow("Method:", cb_method)
+
+            sb_res = QDoubleSpinBox()
+            sb_res.setRange(0.05, 10.0)
+            sb_res.setSingleStep(0.1)
+            sb_res.setValue(1.0)
+            self.params['resolution'] = sb_res
+            self.param_layout.addRow("Resolution:", sb_res)
+
+            sb_restarts = QSpinBox()
+            sb_restarts.setRange(1, 50)
+            sb_restarts.setValue(1)
+            sb_restarts.setToolTip("Community detection runs once per restart and keeps the best partition. "
+                                   "Restarts run in parallel on the CPU cores; a single run uses one core.")
+            self.params['n_restarts'] = sb_restarts
+            self.param_layout.addRow("Restarts:", sb_restarts)
+
+            sb_jobs = QSpinBox()
+            sb_jobs.setRange(0, os.cpu_count() or 1)
+            sb_jobs.setValue(0)
+            sb_jobs.setSpecialValueText("All")
+            self.params['n_jobs'] = sb_jobs
+            self.param_layout.addRow("CPU Cores:", sb_jobs)
+
+            sb_seed = QSpinBox()
+            sb_seed.setRange(0, 10000)
+            sb_seed.setValue(42)
+            self.params['random_state'] = sb_seed
+            self.param_layout.addRow("Random Seed:", sb_seed)
+
         elif algo == "Phenograph":
             sb_k = QSpinBox()
             sb_k.setRange(5, 200)
@@ -273,6 +489,11 @@ class ClusteringTab(QWidget):
             self.params['seed'] = sb_seed
             self.param_layout.addRow("Seed:", sb_seed)
 
+            cb_engine = QComboBox()
+            cb_engine.addItems(["native", "flowsom"])
+            self.params['engine'] = cb_engine
+            self.param_layout.addRow("Engine:", cb_engine)
+
     def on_run(self):
         input_dir = self.dir_label.text()
         if not os.path.isdir(input_dir):
@@ -282,8 +503,27 @@ class ClusteringTab(QWidget):
         config = {
             'type': 'clustering',
             'input_dir': input_dir,
+            'max_cells_per_file': self.max_cells_spin.value() or None,
+            'dtype': 'float64' if self.precision_combo.currentIndex() == 1 else 'float32',
+            'transform': {'cofactor': self.cofactor_spin.value()} if self.arcsinh_check.isChecked() else None,
             'algorithm': self.algo_combo.currentText(),
-            'params': {k: v.value() if isinstance(v, QSpinBox) else v.currentText() 
+            'subsample': {
+                'n_cells': self.subsample_cells_spin.value(),
+                'extend': 'knn' if self.extend_combo.currentText() == "kNN vote" else 'centroid',
+                'k': self.extend_k_spin.value(),
+            } if self.subsample_check.isChecked() else None,
+            'consensus': {'n_seeds': self.consensus_seeds_spin.value()} if self.consensus_check.isChecked() else None,
+            'sweep': {
+                'values': list(range(self.sweep_from_spin.value(), self.sweep_to_spin.value() + 1,
+                                     self.sweep_step_spin.value())),
+                'silhouette_cells': self.silhouette_cells_spin.value(),
+            } if self.sweep_check.isChecked() else None,
+            'output': {
+                'format': self.output_format_combo.currentText().lower(),
+                'float_precision': self.decimals_spin.value() if self.decimals_spin.value() >= 0 else None,
+                'combined': self.combined_check.isChecked(),
+            },
+            'params': {k: v.value() if isinstance(v, (QSpinBox, QDoubleSpinBox)) else v.currentText() 
                        for k, v in self.params.items()}
         }
         self.run_analysis_signal.emit(config)
@@ -460,8 +700,9 @@ class DimReductionTab(QWidget):
             self.param_layout.addRow("Perplexity:", sb_perp)
             
             sb_lr = QDoubleSpinBox()
-            sb_lr.setRange(10, 1000)
-            sb_lr.setValue(200)
+            sb_lr.setRange(0, 1000)
+            sb_lr.setSpecialValueText("Auto")  # 0 = scaled with the number of cells
+            sb_lr.setValue(0)
             self.params['learning_rate'] = sb_lr
             self.param_layout.addRow("Learning Rate:", sb_lr)
             
@@ -471,6 +712,24 @@ class DimReductionTab(QWidget):
             self.params['n_iter'] = sb_iter
             self.param_layout.addRow("Iterations:", sb_iter)
 
+            cb_early = QComboBox()
+            cb_early.addItems(["On", "Off"])
+            self.params['early_stopping'] = cb_early
+            self.param_layout.addRow("Early Stopping:", cb_early)
+
+            sb_angle = QDoubleSpinBox()
+            sb_angle.setRange(0.0, 1.0)
+            sb_angle.setSingleStep(0.1)
+            sb_angle.setValue(0.5)
+            self.params['angle'] = sb_angle
+            self.param_layout.addRow("Barnes-Hut Angle:", sb_angle)
+
+            sb_jobs = QSpinBox()
+            sb_jobs.setRange(0, os.cpu_count() or 1)
+            sb_jobs.setSpecialValueText("All")
+            self.params['n_jobs'] = sb_jobs
+            self.param_layout.addRow("CPU Cores:", sb_jobs)
+
             sb_seed = QSpinBox()
             sb_seed.setRange(0, 10000)
             sb_seed.setValue(42)
@@ -1,4 +1,5 @@
 from PyQt6.QtCore import QThread, pyqtSignal
+from src.utils.cancellation import CancellationToken, OperationCancelled, activate
 import traceback
 import sys
 
@@ -12,17 +13,33 @@ class AnalysisWorker(QThread):
     finished = pyqtSignal()
     error = pyqtSignal(str)
     result = pyqtSignal(object)
+    cancelled = pyqtSignal()
     
     def __init__(self, func, *args, **kwargs):
         super().__init__()
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.cancel_token = CancellationToken()
+
+    def cancel(self):
+        """Ask func to stop at its next cancellation checkpoint (safe from any thread)."""
+        self.cancel_token.cancel()
+
+    def is_cancelled(self):
+        return self.cancel_token.cancelled
+
+    def blocking_stage(self):
+        """Name of the running stage that cannot stop at a checkpoint, or None."""
+        return self.cancel_token.blocking_stage
 
     def run(self):
         try:
-            output = self.func(*self.args, **self.kwargs)
+            with activate(self.cancel_token):
+                output = self.func(*self.args, **self.kwargs)
             self.result.emit(output)
+        except OperationCancelled:
+            self.cancelled.emit()
         except Exception as e:
             # traceback.print_exc()
             self.error.emit(str(e))
@@ -1,5 +1,6 @@
 import sys
 import os
+import multiprocessing
 import warnings
 from pathlib import Path
 
@@ -85,4 +86,6 @@ def main():
     sys.exit(app.exec())
 
 if __name__ == '__main__':
+    # Frozen (PyInstaller) builds re-enter here in every spawned worker process
+    multiprocessing.freeze_support()
     main()
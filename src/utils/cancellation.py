@@ -0,0 +1,75 @@
+import threading
+from contextlib import contextmanager
+
+
+class OperationCancelled(Exception):
+    """Raised at a cancellation checkpoint once the running operation was asked to stop."""
+
+
+class CancellationToken:
+    """Thread-safe stop request shared between the GUI and a running analysis."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.blocking_stage = None  # name of the running stage that has no checkpoints, if any
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise OperationCancelled("Operation cancelled")
+
+
+_active = threading.local()
+
+
+@contextmanager
+def activate(token):
+    """Make token the one checked by checkpoint() on this thread while the block runs."""
+    previous = getattr(_active, "token", None)
+    _active.token = token
+    try:
+        yield token
+    finally:
+        _active.token = previous
+
+
+def active_token():
+    """The token checked on this thread (None when none is active), for handing to helper threads."""
+    return getattr(_active, "token", None)
+
+
+def checkpoint():
+    """
+    Cooperative cancellation point: raises OperationCancelled when the token
+    active on this thread was cancelled. A no-op on threads (and worker
+    processes) without an active token, so library code can call it freely.
+    """
+    token = getattr(_active, "token", None)
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def uninterruptible(stage):
+    """
+    Mark a stage that never reaches a checkpoint (a third-party fit or graph
+    build), so a stop request can report what it is waiting for. Checks for
+    cancellation before the stage starts.
+    """
+    checkpoint()
+    token = getattr(_active, "token", None)
+    if token is None:
+        yield
+        return
+    previous = token.blocking_stage
+    token.blocking_stage = stage
+    try:
+        yield
+    finally:
+        token.blocking_stage = previous
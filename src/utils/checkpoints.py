@@ -0,0 +1,58 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.utils.feature_store import _remove_quietly
+from src.utils.sample_cache import CACHE_DIR_NAME
+
+CHECKPOINT_DIR_NAME = "checkpoints"
+
+
+class CheckpointStore:
+    """
+    Progress of long iterative stages (SOM epochs, KMeans restarts, t-SNE
+    optimizer state) saved under ``<folder>/.cydat_cache/checkpoints`` so a
+    stopped run resumes where it left off. Each checkpoint is one .npz of
+    arrays, keyed by the stage and a hash of everything its result depends
+    on; it is replaced atomically and removed once the stage completes.
+    Without a folder (e.g. custom data) checkpoints are disabled.
+    """
+
+    def __init__(self, directory):
+        self.cache_dir = Path(directory) / CACHE_DIR_NAME / CHECKPOINT_DIR_NAME if directory else None
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+    def _path(self, stage, key):
+        return self.cache_dir / f"{stage}_{key}.npz"
+
+    def load(self, stage, key):
+        """Saved arrays of the stage as a dict, or None when there is no checkpoint."""
+        if self.cache_dir is None:
+            return None
+        try:
+            with np.load(self._path(stage, key)) as arrays:
+                return {name: arrays[name] for name in arrays.files}
+        except (OSError, ValueError):
+            return None
+
+    def save(self, stage, key, **arrays):
+        if self.cache_dir is None:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(stage, key)
+            tmp = path.with_name(path.stem + ".tmp.npz")
+            np.savez(tmp, **arrays)
+            os.replace(tmp, path)
+        except OSError:
+            # Read-only folder: progress just isn't saved
+            pass
+
+    def clear(self, stage, key):
+        if self.cache_dir is not None:
+            _remove_quietly(self._path(stage, key))
@@ -1,71 +1,412 @@
+import hashlib
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import os
+import tempfile
+from src.utils.sample_cache import SampleCache
+from src.utils.fcs_reader import read_fcs
+from src.utils.sampling import RowSampler
+from src.utils.folder_index import FolderIndex
+from src.utils.feature_store import DEFAULT_CHUNK_ROWS, FeatureStore, allocate_array, iter_row_chunks
+from src.utils.cancellation import checkpoint
+
+SAMPLE_CHUNK_ROWS = 100000
 
 class DataLoader:
-    def __init__(self):
-        self.data_map = {}  # filename -> dataframe
-        self.merged_data = None
+    """
+    Loads a folder of sample files into one compact in-memory table.
+
+    Marker values live in a single contiguous ``feature_matrix`` (float32 by
+    default, float64 on request). Per-row metadata is kept alongside it as a
+    categorical file id and int32 original row indices; reserved columns
+    (``cluster_label``/``cell_type``) are stored as plain arrays. No per-file
+    frames are retained: ``file_slices`` maps each file id to its row range.
+
+    ``max_cells_per_file`` / ``sample_fraction`` downsample each file while it
+    is read (seeded by ``sample_seed`` and the file name); ``original_index``
+    then records the source row of every kept cell.
+
+    With ``storage="memmap"`` the marker matrix is spilled to a memory-mapped
+    file under ``spill_dir`` (a local temp folder by default) while files are
+    read, so cohorts larger than RAM can be loaded. Consumers that need to
+    scale the whole matrix should go through ``iter_feature_chunks``.
+    """
+
+    SUPPORTED_SUFFIXES = (".csv", ".fcs")
+
+    def __init__(self, n_jobs=None, use_cache=True, dtype=np.float32, storage="memory", spill_dir=None,
+                 fcs_column_names="marker", max_cells_per_file=None, sample_fraction=None, sample_seed=0):
+        if storage not in ("memory", "memmap"):
+            raise ValueError(f"Unknown storage mode: {storage}")
+        if fcs_column_names not in ("marker", "channel"):
+            raise ValueError(f"Unknown FCS column naming: {fcs_column_names}")
+        self.feature_matrix = None  # (n_cells, n_features) contiguous array
+        self.file_ids = None  # pd.Categorical, one entry per row
+        self.original_index = None  # int32 row index within the source file
+        self.reserved_data = {}  # reserved column name -> array
+        self.file_slices = {}  # file id -> slice into feature_matrix
+        self.columns = None  # column order of the source files
         self.feature_columns = None
         self.filenames = []
+        self.version = 0  # bumped whenever the loaded data changes; keys derived caches
+        self.n_jobs = n_jobs  # parallel readers; None = one per CPU, 1 = serial
+        self.use_cache = use_cache  # binary sidecar cache in <folder>/.cydat_cache
+        self.cache = None
+        self.index = None  # FolderIndex of the loaded folder
+        self.directory = None
+        self.file_tokens = {}  # file id -> content fingerprint of the loaded version
+        self.last_changes = None  # result of the last load/refresh
+        self._loaded_settings = None
+        self.dtype = np.dtype(dtype)
+        self.storage = storage
+        self.spill_dir = spill_dir
+        self.fcs_column_names = fcs_column_names  # "marker" ($PnS, else $PnN) or "channel" ($PnN)
+        self.max_cells_per_file = max_cells_per_file  # None/0 = keep all rows
+        self.sample_fraction = sample_fraction  # None = keep all rows
+        self.sample_seed = sample_seed
 
     def _is_reserved_column(self, column_name: str) -> bool:
         return column_name.strip().lower() in {"cluster_label", "cell_type"}
 
-    def load_directory(self, directory_path):
+    def _resolve_n_jobs(self, n_jobs, n_files):
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        if n_jobs is None or n_jobs <= 0:
+            n_jobs = os.cpu_count() or 1
+        return max(1, min(int(n_jobs), n_files))
+
+    def _resolve_spill_dir(self):
+        if self.storage != "memmap":
+            return None
+        return self.spill_dir or os.path.join(tempfile.gettempdir(), "cydat")
+
+    def _exact_floats(self):
+        # pandas' default float parser can be one ulp off; float64 loads promise the source values
+        return self.dtype == np.float64
+
+    def _read_file(self, file_path):
+        exact = self._exact_floats()
+        if self.cache is not None:
+            df = self.cache.get(file_path, exact=exact)
+            if df is not None:
+                return df
+        try:
+            df = pd.read_csv(file_path, float_precision="round_trip" if exact else None)
+        except Exception as e:
+            raise ValueError(f"Error reading {file_path.name}: {str(e)}")
+        if self.cache is not None:
+            self.cache.put(file_path, df, exact=exact)
+        return df
+
+    def _make_sampler(self, file_path):
+        return RowSampler(self.max_cells_per_file, self.sample_fraction, seed=self.sample_seed, name=file_path.name)
+
+    def _read_sampled(self, file_path, sampler):
+        """
+        Read a downsampled CSV. Cached files are indexed directly; otherwise
+        the file is streamed in chunks through the reservoir so the full table
+        is never held in memory.
+        """
+        exact = self._exact_floats()
+        df = self.cache.get(file_path, exact=exact) if self.cache is not None else None
+        if df is not None:
+            idx = sampler.select(len(df))
+            return df.iloc[idx].reset_index(drop=True), idx
+        try:
+            with pd.read_csv(file_path, chunksize=SAMPLE_CHUNK_ROWS,
+                             float_precision="round_trip" if exact else None) as reader:
+                df, idx = sampler.sample_chunks(reader)
+            if df is None:
+                df = pd.read_csv(file_path, nrows=0)
+        except Exception as e:
+            raise ValueError(f"Error reading {file_path.name}: {str(e)}")
+        return df, idx
+
+    def _read_compact(self, file_path):
+        """
+        Parse one file and reduce it to (columns, feature block, reserved
+        columns, original row indices or None for "all rows").
+        The parsed DataFrame is dropped before returning, so concurrent readers
+        only hold the compact form.
+        """
+        if file_path.suffix.lower() == ".fcs":
+            return self._read_compact_fcs(file_path)
+
+        sampler = self._make_sampler(file_path)
+        if sampler.active:
+            df, row_index = self._read_sampled(file_path, sampler)
+        else:
+            df, row_index = self._read_file(file_path), None
+        columns = list(df.columns)
+        feature_cols = [c for c in columns if not self._is_reserved_column(c)]
+        try:
+            block = df[feature_cols].to_numpy(dtype=self.dtype)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Non-numeric marker column in {file_path.name}: {e}")
+        reserved = {c: df[c].to_numpy() for c in columns if self._is_reserved_column(c)}
+        return columns, block, reserved, row_index
+
+    def _read_compact_fcs(self, file_path):
+        # FCS events are binary already, so they bypass the sidecar cache
+        try:
+            fcs = read_fcs(file_path)
+        except Exception as e:
+            raise ValueError(f"Error reading {file_path.name}: {str(e)}")
+        columns = fcs.column_names(prefer=self.fcs_column_names)
+        data = fcs.data
+        sampler = self._make_sampler(file_path)
+        row_index = None
+        if sampler.active:
+            # Fancy indexing gathers only the kept events from the memory map
+            row_index = sampler.select(len(data))
+            data = data[row_index]
+        feature_idx = [i for i, c in enumerate(columns) if not self._is_reserved_column(c)]
+        reserved = {c: data[:, i].copy() for i, c in enumerate(columns) if self._is_reserved_column(c)}
+        if len(feature_idx) == len(columns):
+            block = data.astype(self.dtype)
+        else:
+            block = data[:, feature_idx].astype(self.dtype)
+        return columns, block, reserved, row_index
+
+    def load_directory(self, directory_path, n_jobs=None):
         """
-        Load all CSV files from a directory.
-        Checks for consistency in columns.
+        Load all CSV and FCS (3.0/3.1) files from a directory.
+        Checks for consistency in columns; FCS channels are named according to
+        fcs_column_names, so CSV and FCS samples can be mixed in one folder.
+
+        Files are parsed concurrently on a thread pool (the pandas C parser
+        releases the GIL). Results are collected in sorted filename order, so
+        the merged table is the same regardless of which file finishes first.
+
+        Unless use_cache is off, parsed files are kept in a binary sidecar
+        cache (see SampleCache) and unchanged files are memory-mapped from it
+        on the next load instead of being parsed again.
+
+        File discovery and the column check use the folder's FolderIndex, so a
+        mismatching file is reported before any data is parsed.
         """
         directory = Path(directory_path)
         if not directory.exists() or not directory.is_dir():
             raise ValueError(f"Invalid directory: {directory_path}")
 
-        csv_files = list(directory.glob("*.csv"))
-        if not csv_files:
-            raise ValueError(f"No CSV files found in {directory_path}")
+        sample_files = self._index_folder(directory, n_jobs)
+        is_consistent, msg, _ = self.index.check_consistency(sample_files, fcs_prefer=self.fcs_column_names)
+        if not is_consistent:
+            raise ValueError(msg)
 
-        self.data_map = {}
-        self.filenames = []
-        first_columns = None
-        
-        all_dfs = []
+        self.cache = SampleCache(directory) if self.use_cache else None
+
+        # Drop the previous matrix first so a memmap store can be released
+        self.feature_matrix = None
+        self._build(sample_files, n_jobs, reuse={})
+        self.directory = directory
+        self._loaded_settings = self._load_settings()
+        self.last_changes = {'added': list(self.filenames), 'removed': [], 'modified': []}
+
+        return self.filenames, self.feature_columns
+
+    def _index_folder(self, directory, n_jobs):
+        """Refresh the folder index and return the sample files it lists."""
+        self.index = FolderIndex.load_or_build(directory, n_jobs=n_jobs or self.n_jobs)
+        sample_files = self.index.files(self.SUPPORTED_SUFFIXES)
+        if not sample_files:
+            raise ValueError(f"No CSV or FCS files found in {directory}")
+        stems = [f.stem for f in sample_files]
+        if len(set(stems)) != len(stems):
+            dupes = sorted({s for s in stems if stems.count(s) > 1})
+            raise ValueError(f"Several files share the sample name(s) {dupes}; rename them so each sample is unique.")
+        return sample_files
+
+    def _load_settings(self):
+        return (self.dtype, self._exact_floats(), self.fcs_column_names, self.max_cells_per_file,
+                self.sample_fraction, self.sample_seed)
+
+    def _build(self, sample_files, n_jobs, reuse):
+        """
+        Assemble the merged matrix from sample_files. Files listed in reuse
+        (file id -> slice of the current matrix) are copied from the loaded
+        data; all others are parsed.
+        """
+        to_parse = [f for f in sample_files if f.stem not in reuse]
+        parsed = self._iter_compact(to_parse, self._resolve_n_jobs(n_jobs, max(len(to_parse), 1)))
 
-        for file_path in csv_files:
-            try:
-                df = pd.read_csv(file_path)
-                
+        store = None
+        first_columns = None
+        reserved_parts = []
+        index_parts = []
+        sizes = []
+        try:
+            for file_path in sample_files:
+                checkpoint()
+                sl = reuse.get(file_path.stem)
+                if sl is not None:
+                    current_columns = self.columns
+                    block = self.feature_matrix[sl]
+                    reserved = {name: values[sl] for name, values in self.reserved_data.items()}
+                    row_index = self.original_index[sl]
+                else:
+                    current_columns, block, reserved, row_index = next(parsed)
                 # Check columns consistency
-                current_columns = list(df.columns)
                 if first_columns is None:
                     first_columns = current_columns
-                else:
-                    if current_columns != first_columns:
-                        raise ValueError(f"Column mismatch in file {file_path.name}. Expected {first_columns}, got {current_columns}")
-                
-                file_id = file_path.stem
-                self.filenames.append(file_id)
-                self.data_map[file_id] = df
-                
-                # Add identifier for merging
-                df_copy = df.copy()
-                df_copy['_file_id'] = file_id
-                df_copy['_original_index'] = df.index
-                all_dfs.append(df_copy)
-                
-            except Exception as e:
-                raise ValueError(f"Error reading {file_path.name}: {str(e)}")
+                    store = FeatureStore(block.shape[1], dtype=self.dtype, spill_dir=self._resolve_spill_dir())
+                elif current_columns != first_columns:
+                    raise ValueError(f"Column mismatch in file {file_path.name}. Expected {first_columns}, got {current_columns}")
+                store.append(block)
+                reserved_parts.append(reserved)
+                index_parts.append(row_index)
+                sizes.append(len(block))
+        except Exception:
+            if store is not None:
+                store.discard()
+            raise
+        finally:
+            parsed.close()
+
+        if self.cache is not None:
+            self.cache.prune(sample_files)
 
+        self.filenames = [f.stem for f in sample_files]
+        self.columns = first_columns
         self.feature_columns = [c for c in first_columns if not self._is_reserved_column(c)]
-        self.merged_data = pd.concat(all_dfs, ignore_index=True)
-        
-        return self.filenames, self.feature_columns
+        self._assemble(store.finalize(), self.filenames, sizes, reserved_parts, index_parts)
+        self.file_tokens = dict(zip(self.filenames, self.index.fingerprints(sample_files, n_jobs or self.n_jobs)))
+        self.version += 1
+
+    def refresh(self, n_jobs=None):
+        """
+        Bring the loaded data up to date with the folder on disk.
+
+        Added and modified files (by content fingerprint) are parsed, removed
+        files are dropped, and unchanged files are spliced over from the
+        current matrix without re-reading them. Falls back to a full load when
+        the load settings (sampling, dtype, FCS naming) changed.
+
+        Returns {'added': [...], 'removed': [...], 'modified': [...]} of file ids;
+        the data version is bumped only when something changed.
+        """
+        if not self.has_data() or self.directory is None:
+            raise ValueError("No data loaded")
+        if self._loaded_settings != self._load_settings():
+            self.load_directory(self.directory, n_jobs=n_jobs)
+            return self.last_changes
+
+        sample_files = self._index_folder(self.directory, n_jobs)
+        stems = [f.stem for f in sample_files]
+
+        tokens = dict(zip(stems, self.index.fingerprints(sample_files, n_jobs or self.n_jobs)))
+        added = [fid for fid in stems if fid not in self.file_tokens]
+        removed = [fid for fid in self.filenames if fid not in tokens]
+        modified = [fid for fid in stems if fid in self.file_tokens and self.file_tokens[fid] != tokens[fid]]
+        changes = {'added': added, 'removed': removed, 'modified': modified}
+        if not (added or removed or modified):
+            self.last_changes = changes
+            return changes
+
+        changed = [f for f in sample_files if f.stem in set(added) | set(modified)]
+        is_consistent, msg, columns = self.index.check_consistency(changed, fcs_prefer=self.fcs_column_names)
+        if changed and (not is_consistent or list(columns) != list(self.columns)):
+            raise ValueError(msg if not is_consistent else f"Column mismatch in {changed[0].name}. Expected {self.columns}, got {columns}")
+
+        reuse = {fid: self.file_slices[fid] for fid in stems if fid not in added and fid not in modified}
+        self._build(sample_files, n_jobs, reuse=reuse)
+        self.last_changes = changes
+        return changes
+
+    def _iter_compact(self, files, n_jobs):
+        """Yield _read_compact results in file order; blocks are handed over as they complete."""
+        if n_jobs == 1:
+            for f in files:
+                yield self._read_compact(f)
+            return
+        # executor.map yields in submission order -> deterministic concat
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            yield from executor.map(self._read_compact, files)
+
+    def _assemble(self, matrix, file_ids, sizes, reserved_parts, index_parts):
+        """
+        Attach the merged matrix and build row metadata from per-file sizes,
+        reserved columns and original row indices (None = all rows in order).
+        """
+        self.feature_matrix = matrix
+
+        codes = np.repeat(np.arange(len(file_ids), dtype=np.int32), sizes)
+        self.file_ids = pd.Categorical.from_codes(codes, categories=list(file_ids))
+        self.original_index = np.concatenate([
+            np.arange(n, dtype=np.int32) if idx is None else np.asarray(idx, dtype=np.int32)
+            for n, idx in zip(sizes, index_parts)
+        ])
+
+        self.reserved_data = {}
+        for name in (reserved_parts[0] if reserved_parts else {}):
+            self.reserved_data[name] = np.concatenate([reserved[name] for reserved in reserved_parts])
+
+        self.file_slices = {}
+        start = 0
+        for file_id, n in zip(file_ids, sizes):
+            self.file_slices[file_id] = slice(start, start + n)
+            start += n
+
+    def has_data(self):
+        return self.feature_matrix is not None
+
+    def fingerprint(self):
+        """
+        Content fingerprint of the loaded dataset: the content fingerprint of
+        every loaded file in order, the feature columns and the load settings
+        (dtype, FCS naming, sampling). Equal fingerprints mean equal matrices,
+        even across reloads, so it keys caches of derived data.
+        """
+        if self.feature_matrix is None:
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((self._load_settings(), list(self.feature_columns))).encode("utf-8"))
+        for file_id in self.filenames:
+            h.update(f"{file_id}:{self.file_tokens.get(file_id)};".encode("utf-8"))
+        return h.hexdigest()
 
     def get_merged_data(self):
-        return self.merged_data
+        """
+        Build the merged DataFrame (source columns + ``_file_id`` and
+        ``_original_index``). The frame is constructed on demand and not kept.
+        """
+        if self.feature_matrix is None:
+            return None
+        data = {}
+        feature_pos = {c: i for i, c in enumerate(self.feature_columns)}
+        for c in self.columns:
+            if c in feature_pos:
+                data[c] = self.feature_matrix[:, feature_pos[c]]
+            else:
+                data[c] = self.reserved_data[c]
+        data['_file_id'] = self.file_ids
+        data['_original_index'] = self.original_index
+        return pd.DataFrame(data)
+
+    def get_metadata_column(self, name):
+        """Return a reserved column (case-insensitive lookup), or None if absent."""
+        for c, values in self.reserved_data.items():
+            if str(c).strip().lower() == name.strip().lower():
+                return values
+        return None
+
+    def get_feature_matrix(self):
+        return self.feature_matrix
+
+    def iter_feature_chunks(self, chunk_size=DEFAULT_CHUNK_ROWS):
+        """Yield (start_row, block) views over the marker matrix, chunk_size rows at a time."""
+        if self.feature_matrix is None:
+            return
+        yield from iter_row_chunks(self.feature_matrix, chunk_size)
+
+    def allocate(self, shape, dtype=None):
+        """Allocate an array for derived data, on disk when the loader spills to memmap."""
+        return allocate_array(shape, dtype or self.dtype, spill_dir=self._resolve_spill_dir())
 
     def get_feature_data(self):
-        if self.merged_data is not None:
-            feature_columns = [c for c in self.feature_columns if not self._is_reserved_column(c)]
-            return self.merged_data[feature_columns]
+        """Feature columns as a DataFrame view over feature_matrix (no copy)."""
+        if self.feature_matrix is not None:
+            return pd.DataFrame(self.feature_matrix, columns=self.feature_columns, copy=False)
         return None
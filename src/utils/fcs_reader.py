@@ -0,0 +1,146 @@
+import mmap
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class FcsData:
+    text: dict  # TEXT segment keywords, upper-cased keys
+    channel_names: list  # $PnN
+    marker_names: list  # $PnS ('' when absent)
+    data: np.ndarray  # (n_events, n_parameters), read-only view over the file
+
+    def column_names(self, prefer="marker"):
+        return column_labels(self.channel_names, self.marker_names, prefer)
+
+
+def column_labels(channel_names, marker_names, prefer="marker"):
+    """
+    Column labels for the event matrix. With prefer="marker" the $PnS label
+    is used where present and unique, falling back to $PnN; "channel" always
+    uses $PnN.
+    """
+    if prefer == "channel":
+        return list(channel_names)
+    names = []
+    seen = {m for m in marker_names if m}
+    dupes = {m for m in seen if list(marker_names).count(m) > 1}
+    for channel, marker in zip(channel_names, marker_names):
+        names.append(marker if marker and marker not in dupes else channel)
+    return names
+
+
+def _parse_text_segment(raw: bytes) -> dict:
+    text = raw.decode("utf-8", errors="replace")
+    if not text:
+        raise ValueError("Empty TEXT segment")
+    delim = text[0]
+    body = text[1:]
+    # A doubled delimiter is an escaped literal delimiter inside a value
+    placeholder = "\x00"
+    tokens = body.replace(delim * 2, placeholder).split(delim)
+    tokens = [t.replace(placeholder, delim) for t in tokens]
+    if tokens and tokens[-1] == "":
+        tokens.pop()
+    if len(tokens) % 2:
+        tokens.pop()
+    return {tokens[i].strip().upper(): tokens[i + 1] for i in range(0, len(tokens), 2)}
+
+
+def _header_offset(header: bytes, start: int) -> int:
+    value = header[start:start + 8].strip()
+    return int(value) if value else 0
+
+
+def _event_dtype(text: dict, n_par: int) -> np.dtype:
+    byteord = text.get("$BYTEORD", "1,2,3,4").strip()
+    endian = "<" if byteord.startswith("1") else ">"
+    datatype = text.get("$DATATYPE", "").strip().upper()
+
+    if datatype == "F":
+        return np.dtype(f"{endian}f4")
+    if datatype == "D":
+        return np.dtype(f"{endian}f8")
+    if datatype == "I":
+        bits = {text.get(f"$P{i}B", "").strip() for i in range(1, n_par + 1)}
+        if len(bits) != 1:
+            raise ValueError(f"Mixed integer widths are not supported: {sorted(bits)}")
+        width = int(bits.pop())
+        if width not in (8, 16, 32, 64):
+            raise ValueError(f"Unsupported integer width: {width} bits")
+        return np.dtype(f"{endian}u{width // 8}")
+    raise ValueError(f"Unsupported $DATATYPE: {datatype or '(missing)'}")
+
+
+def read_fcs_text(file_path) -> dict:
+    """Read only the HEADER and TEXT segment of an FCS 3.x file (no event data)."""
+    file_path = Path(file_path)
+    with open(file_path, "rb") as f:
+        header = f.read(58)
+        if len(header) < 58 or not header.startswith(b"FCS3."):
+            raise ValueError(f"{file_path.name} is not an FCS 3.x file")
+        text_start = _header_offset(header, 10)
+        text_end = _header_offset(header, 18)
+        f.seek(text_start)
+        return _parse_text_segment(f.read(text_end - text_start + 1))
+
+
+def fcs_names(text: dict):
+    """($PnN list, $PnS list) from a parsed TEXT segment."""
+    n_par = int(text["$PAR"])
+    channel_names = [text.get(f"$P{i}N", f"P{i}").strip() for i in range(1, n_par + 1)]
+    marker_names = [text.get(f"$P{i}S", "").strip() for i in range(1, n_par + 1)]
+    return channel_names, marker_names
+
+
+def read_fcs(file_path) -> FcsData:
+    """
+    Read an FCS 3.0/3.1 list-mode file.
+
+    The TEXT segment is parsed for channel metadata; the DATA segment is
+    decoded with ``np.frombuffer`` over a read-only memory map of the file, so
+    no event values are copied or parsed as text. The returned array keeps the
+    map alive for as long as it is referenced.
+    """
+    file_path = Path(file_path)
+    with open(file_path, "rb") as f:
+        header = f.read(58)
+        if len(header) < 58 or not header.startswith(b"FCS3."):
+            raise ValueError(f"{file_path.name} is not an FCS 3.x file")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    text_start = _header_offset(header, 10)
+    text_end = _header_offset(header, 18)
+    text = _parse_text_segment(mm[text_start:text_end + 1])
+
+    mode = text.get("$MODE", "L").strip().upper()
+    if mode != "L":
+        raise ValueError(f"Unsupported $MODE: {mode} (only list mode is supported)")
+
+    n_par = int(text["$PAR"])
+    n_events = int(text["$TOT"])
+
+    data_start = _header_offset(header, 26)
+    data_end = _header_offset(header, 34)
+    if data_start == 0 or data_end == 0:
+        # Offsets beyond 99,999,999 bytes are only given in the TEXT segment
+        data_start = int(text.get("$BEGINDATA", "0").strip())
+        data_end = int(text.get("$ENDDATA", "0").strip())
+
+    dtype = _event_dtype(text, n_par)
+    needed = n_events * n_par * dtype.itemsize
+    if data_end - data_start + 1 < needed or data_start + needed > len(mm):
+        raise ValueError(f"DATA segment of {file_path.name} is shorter than $TOT x $PAR")
+
+    data = np.frombuffer(mm, dtype=dtype, count=n_events * n_par, offset=data_start).reshape(n_events, n_par)
+
+    if dtype.kind == "u":
+        # Honour $PnR bit masks for integer data (values above range are garbage bits)
+        ranges = [int(float(text.get(f"$P{i}R", "0"))) for i in range(1, n_par + 1)]
+        if all(r > 0 and (r & (r - 1)) == 0 and r < 2 ** (8 * dtype.itemsize) for r in ranges):
+            data = data & np.array([r - 1 for r in ranges], dtype=dtype)
+
+    channel_names, marker_names = fcs_names(text)
+    return FcsData(text=text, channel_names=channel_names, marker_names=marker_names, data=data)
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+from src.utils.cancellation import checkpoint
+
+DEFAULT_CHUNK_ROWS = 262144
+
+
+def iter_row_chunks(data, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Yield (start_row, block) views over a 2D array, chunk_size rows at a time.
+    Every chunk is a cancellation checkpoint.
+    """
+    n = data.shape[0]
+    for start in range(0, n, chunk_size):
+        checkpoint()
+        yield start, data[start:start + chunk_size]
+
+
+def array_fingerprint(data, chunk_size=DEFAULT_CHUNK_ROWS):
+    """blake2b fingerprint of an array's shape, dtype and values (hashed chunk by chunk)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{tuple(data.shape)}|{np.dtype(data.dtype).str};".encode("utf-8"))
+    for _, chunk in iter_row_chunks(data, chunk_size):
+        h.update(np.ascontiguousarray(chunk).data)
+    return h.hexdigest()
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def allocate_array(shape, dtype, spill_dir=None, prefix="cydat-"):
+    """
+    Allocate an uninitialized array. With spill_dir set the array is a
+    np.memmap backed by a temporary file in that directory, removed again
+    when the array is garbage collected.
+    """
+    if spill_dir is None:
+        return np.empty(shape, dtype=dtype)
+    Path(spill_dir).mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=".bin", dir=spill_dir)
+    os.close(fd)
+    if int(np.prod(shape)) == 0:
+        _remove_quietly(path)
+        return np.empty(shape, dtype=dtype)
+    arr = np.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+    weakref.finalize(arr, _remove_quietly, path)
+    return arr
+
+
+class FeatureStore:
+    """
+    Append-only builder for the merged marker matrix.
+
+    In memory mode blocks are concatenated into one contiguous array. In
+    memmap mode each block is written straight to a temporary file on local
+    disk as soon as it arrives, and the finished matrix is a read-only
+    np.memmap over that file, so a cohort never has to fit in RAM at once.
+    """
+
+    def __init__(self, n_features, dtype=np.float32, spill_dir=None):
+        self.n_features = int(n_features)
+        self.dtype = np.dtype(dtype)
+        self.spill_dir = spill_dir
+        self.n_rows = 0
+        self._blocks = []
+        self._file = None
+        self._path = None
+        if spill_dir is not None:
+            Path(spill_dir).mkdir(parents=True, exist_ok=True)
+            fd, self._path = tempfile.mkstemp(prefix="cydat-features-", suffix=".bin", dir=spill_dir)
+            self._file = os.fdopen(fd, "wb")
+
+    def append(self, block):
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        if block.ndim != 2 or block.shape[1] != self.n_features:
+            raise ValueError(f"Expected a block with {self.n_features} columns, got shape {block.shape}")
+        if self._file is not None:
+            block.tofile(self._file)
+        else:
+            self._blocks.append(block)
+        self.n_rows += len(block)
+
+    def finalize(self):
+        if self._file is None:
+            if not self._blocks:
+                return np.empty((0, self.n_features), dtype=self.dtype)
+            matrix = np.concatenate(self._blocks, axis=0) if len(self._blocks) > 1 else self._blocks[0]
+            self._blocks = []
+            return matrix
+
+        self._file.close()
+        self._file = None
+        if self.n_rows == 0:
+            _remove_quietly(self._path)
+            return np.empty((0, self.n_features), dtype=self.dtype)
+        matrix = np.memmap(self._path, dtype=self.dtype, mode="r", shape=(self.n_rows, self.n_features))
+        weakref.finalize(matrix, _remove_quietly, self._path)
+        return matrix
+
+    def discard(self):
+        """Drop everything appended so far (used when a load fails midway)."""
+        self._blocks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            _remove_quietly(self._path)
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+
+import pandas as pd
+
+from src.utils.fcs_reader import column_labels, fcs_names, read_fcs_text
+from src.utils.sample_cache import CACHE_DIR_NAME
+
+INDEX_FILE_NAME = "index.json"
+INDEX_FORMAT = 2
+SAMPLE_SUFFIXES = (".csv", ".fcs")
+_READ_BLOCK = 1 << 20
+
+# Entries seen in this process, by resolved folder: they stand in for index.json in folders where it
+# is not written (persist=False) or cannot be (read-only), so headers and fingerprints are not recomputed
+_session_entries = {}
+
+
+@dataclass(frozen=True)
+class FileEntry:
+    name: str
+    size: int
+    mtime_ns: int
+    n_rows: int | None  # FCS $TOT; None for CSV (not known without parsing)
+    fingerprint: str = ""  # blake2b of the file contents, computed on first use ('' until then)
+    columns: tuple = ()  # CSV header
+    channels: tuple = ()  # FCS $PnN
+    markers: tuple = ()  # FCS $PnS ('' when absent)
+    error: str | None = None  # set when the header could not be read
+
+    @property
+    def is_fcs(self):
+        return self.name.lower().endswith(".fcs")
+
+    def column_names(self, fcs_prefer="marker"):
+        if self.is_fcs:
+            return column_labels(self.channels, self.markers, fcs_prefer)
+        return list(self.columns)
+
+
+def _hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(_READ_BLOCK)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _map_files(func, paths, n_jobs=None):
+    """func over paths in order, on a thread pool when there is more than one file."""
+    workers = max(1, min(n_jobs or os.cpu_count() or 1, len(paths)))
+    if workers == 1:
+        return [func(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, paths))
+
+
+def scan_file(path):
+    """Build the index entry for one file from its header only (CSV header or FCS TEXT segment)."""
+    path = Path(path)
+    st = path.stat()
+    base = dict(name=path.name, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    try:
+        if path.suffix.lower() == ".fcs":
+            text = read_fcs_text(path)
+            channels, markers = fcs_names(text)
+            return FileEntry(n_rows=int(text.get("$TOT", 0)), channels=tuple(channels), markers=tuple(markers),
+                             **base)
+        columns = tuple(pd.read_csv(path, nrows=0).columns)
+        return FileEntry(n_rows=None, columns=columns, **base)
+    except Exception as e:
+        return FileEntry(n_rows=None, error=str(e), **base)
+
+
+class FolderIndex:
+    """
+    Per-file schema index of a sample folder: columns, byte size and mtime of
+    every CSV/FCS file (plus the event count of FCS files), read from the
+    headers only.
+
+    Header questions (column consistency, cell_type lookup) are answered
+    without parsing any data. Content fingerprints are computed lazily, when
+    fingerprints() is asked for them (the loader does, to detect changed
+    files). With persist the index is saved to
+    ``<folder>/.cydat_cache/index.json`` and reused on the next call for every
+    file whose size and mtime are unchanged; without it an existing index is
+    still read but nothing is written to the folder. Either way the entries
+    are also kept in memory for the rest of the session, so folders whose
+    index is not (or cannot be) saved are not rescanned or rehashed.
+    """
+
+    def __init__(self, directory, entries, persist=True):
+        self.directory = Path(directory)
+        self.entries = entries  # file name -> FileEntry
+        self.persist = persist
+
+    @classmethod
+    def load_or_build(cls, directory, n_jobs=None, persist=True):
+        directory = Path(directory)
+        if not directory.exists() or not directory.is_dir():
+            raise ValueError(f"Invalid directory: {directory}")
+
+        paths = sorted(
+            (p for p in directory.iterdir() if p.is_file() and p.suffix.lower() in SAMPLE_SUFFIXES),
+            key=lambda p: p.name,
+        )
+        persisted = cls._read_persisted(directory)
+        session = _session_entries.get(cls._session_key(directory), {})
+
+        entries = {}
+        to_scan = []
+        for p in paths:
+            st = p.stat()
+            # This session's entry first: it may hold a fingerprint the saved index lacks
+            for old in (session.get(p.name), persisted.get(p.name)):
+                if (old is not None and old.size == st.st_size and old.mtime_ns == st.st_mtime_ns
+                        and old.error is None):
+                    entries[p.name] = old
+                    break
+            else:
+                to_scan.append(p)
+
+        for entry in _map_files(scan_file, to_scan, n_jobs):
+            entries[entry.name] = entry
+
+        index = cls(directory, {name: entries[name] for name in sorted(entries)}, persist=persist)
+        index._remember()
+        if persist and index.entries != persisted:
+            index.save()
+        return index
+
+    @staticmethod
+    def _session_key(directory):
+        return str(Path(directory).resolve())
+
+    def _remember(self):
+        _session_entries[self._session_key(self.directory)] = dict(self.entries)
+
+    @staticmethod
+    def _index_path(directory):
+        return Path(directory) / CACHE_DIR_NAME / INDEX_FILE_NAME
+
+    @classmethod
+    def _read_persisted(cls, directory):
+        try:
+            with open(cls._index_path(directory), "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            if raw.get("format") != INDEX_FORMAT:
+                return {}
+            entries = {}
+            for item in raw.get("files", []):
+                for key in ("columns", "channels", "markers"):
+                    item[key] = tuple(item.get(key, ()))
+                entries[item["name"]] = FileEntry(**item)
+            return entries
+        except (OSError, ValueError, TypeError, KeyError):
+            return {}
+
+    def save(self):
+        path = self._index_path(self.directory)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"format": INDEX_FORMAT, "files": [asdict(e) for e in self.entries.values()]}, f)
+            os.replace(tmp, path)
+        except OSError:
+            # Read-only folder: the index just isn't persisted
+            pass
+
+    def files(self, suffixes=SAMPLE_SUFFIXES):
+        """Sorted paths of indexed files with one of the given suffixes."""
+        suffixes = tuple(s.lower() for s in suffixes)
+        return [self.directory / name for name in self.entries if Path(name).suffix.lower() in suffixes]
+
+    def entry(self, path):
+        return self.entries[Path(path).name]
+
+    def check_consistency(self, files=None, ordered=True, fcs_prefer="marker"):
+        """
+        Compare the columns of files (default: all indexed files) against the
+        first one. Returns (is_consistent, message, first_file_columns).
+        With ordered=False only the column sets are compared.
+        """
+        files = self.files() if files is None else [Path(f) for f in files]
+        if not files:
+            return False, "No sample files found in the folder.", None
+
+        first = self.entry(files[0])
+        if first.error:
+            return False, f"Error reading {first.name}: {first.error}", None
+        first_cols = first.column_names(fcs_prefer)
+        for f in files[1:]:
+            e = self.entry(f)
+            if e.error:
+                return False, f"Error reading {e.name}: {e.error}", None
+            cols = e.column_names(fcs_prefer)
+            same = cols == first_cols if ordered else set(cols) == set(first_cols)
+            if not same:
+                return False, f"Column mismatch in {e.name}. Expected {first_cols}, got {cols}", None
+        return True, "All files have consistent columns.", first_cols
+
+    def fingerprints(self, files=None, n_jobs=None):
+        """
+        Content fingerprint of each of files (default: all), in order. Files
+        not hashed yet are read in full (in parallel) and their fingerprints
+        kept in the index (and in memory for the session).
+        """
+        files = self.files() if files is None else [Path(f) for f in files]
+        missing = [f for f in files if not self.entry(f).fingerprint]
+        if missing:
+            for f, digest in zip(missing, _map_files(_hash_file, missing, n_jobs)):
+                self.entries[f.name] = replace(self.entry(f), fingerprint=digest)
+            self._remember()
+            if self.persist:
+                self.save()
+        return [self.entry(f).fingerprint for f in files]
+
+    def fingerprint(self, files=None):
+        """Combined content fingerprint of the given files (default: all)."""
+        files = self.files() if files is None else [Path(f) for f in files]
+        h = hashlib.blake2b(digest_size=16)
+        for f, digest in zip(files, self.fingerprints(files)):
+            h.update(f"{f.name}:{digest};".encode("utf-8"))
+        return h.hexdigest()
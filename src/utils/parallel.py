@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from src.utils.cancellation import OperationCancelled, checkpoint
+from src.utils.feature_store import _remove_quietly
+
+POLL_SECONDS = 0.2
+
+
+def resolve_cpu_budget(n_jobs=None):
+    """
+    Number of cores a parallel stage may use. None or 0 means all cores;
+    negative values count back from the total (-1 = all, -2 = all but one).
+    """
+    total = os.cpu_count() or 1
+    if n_jobs is None or n_jobs == 0:
+        return total
+    if n_jobs < 0:
+        return max(1, total + 1 + n_jobs)
+    return max(1, min(int(n_jobs), total))
+
+
+def split_budget(n_tasks, budget):
+    """
+    Split a core budget over independent tasks: (worker processes, BLAS/OpenMP
+    threads per worker), so workers x threads never exceeds the budget.
+    """
+    workers = max(1, min(int(n_tasks), int(budget)))
+    return workers, max(1, int(budget) // workers)
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """
+    Picklable handle to an array on disk that worker processes open as a
+    read-only memory map instead of receiving a pickled copy.
+    """
+    path: str
+    dtype: str
+    shape: tuple
+    offset: int = 0
+    owned: bool = False  # True when the file was written just for sharing
+
+    @classmethod
+    def from_array(cls, data, spill_dir=None):
+        """
+        Share an array with worker processes. A C-contiguous np.memmap (as
+        produced by the loader in memmap mode) is shared in place; anything
+        else is written once to a temporary file in spill_dir.
+        """
+        if isinstance(data, np.memmap) and data.filename and data.flags.c_contiguous:
+            return cls(str(data.filename), data.dtype.str, tuple(data.shape), int(data.offset))
+
+        data = np.ascontiguousarray(data)
+        spill_dir = Path(spill_dir) if spill_dir is not None else Path(tempfile.gettempdir()) / "cydat"
+        spill_dir.mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="cydat-shared-", suffix=".bin", dir=spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            data.tofile(f)
+        return cls(path, data.dtype.str, tuple(data.shape), 0, owned=True)
+
+    def open(self):
+        if int(np.prod(self.shape)) == 0:
+            return np.empty(self.shape, dtype=np.dtype(self.dtype))
+        return np.memmap(self.path, dtype=np.dtype(self.dtype), mode="r", shape=self.shape, offset=self.offset)
+
+    def release(self):
+        """Remove the backing file if it was written for sharing."""
+        if self.owned:
+            _remove_quietly(self.path)
+
+
+_worker_limits = None
+
+
+def _init_worker(threads):
+    # Kept referenced for the lifetime of the worker so the limits stay applied
+    global _worker_limits
+    _worker_limits = threadpool_limits(limits=threads)
+
+
+def process_pool(workers, threads_per_worker=1):
+    """
+    Process pool whose workers are capped at threads_per_worker BLAS/OpenMP
+    threads each. Workers are spawned (not forked), which is safe from the
+    GUI's worker threads and behaves the same on every platform.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads_per_worker,),
+    )
+
+
+def _stop_pool(pool):
+    # Running tasks cannot be interrupted, so the workers are killed; the pool then marks
+    # every pending future as failed and shuts down
+    if hasattr(pool, "terminate_workers"):
+        pool.terminate_workers()
+        return
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=True)
+
+
+def results_in_order(pool, futures):
+    """
+    Yield the results of futures in submission order, checking for
+    cancellation while waiting. On cancellation the pool's workers are
+    stopped and OperationCancelled is raised, so a stop request does not
+    wait for the remaining tasks.
+    """
+    futures = list(futures)
+    try:
+        for future in futures:
+            while True:
+                checkpoint()
+                try:
+                    result = future.result(timeout=POLL_SECONDS)
+                    break
+                except FutureTimeout:
+                    continue
+            yield result
+    except OperationCancelled:
+        _stop_pool(pool)
+        raise
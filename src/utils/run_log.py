@@ -0,0 +1,15 @@
+def format_run_log(run_log):
+    """
+    One line per timed stage, for the GUI log. run_log is a list of dicts
+    with 'stage', 'seconds' and any stage details.
+    """
+    lines = []
+    for record in run_log:
+        details = []
+        for key, value in record.items():
+            if key in ('stage', 'seconds'):
+                continue
+            details.append(f"{key} {value:.6g}" if isinstance(value, float) else f"{key} {value}")
+        detail_text = f" ({', '.join(details)})" if details else ""
+        lines.append(f"{record['stage']}{detail_text}: {record['seconds']:.2f}s")
+    return lines
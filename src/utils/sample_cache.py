@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR_NAME = ".cydat_cache"
+
+
+class SampleCache:
+    """
+    Binary sidecar cache of parsed sample files.
+
+    Each sample is stored under ``<folder>/.cydat_cache/samples`` as a raw
+    ``.npy`` block of its numeric columns (memory-mapped on load), an ``.npz``
+    of its text and boolean columns, plus a small JSON manifest. Nothing is
+    pickled, so a cache folder copied from elsewhere cannot run code on load.
+    Entries are keyed by file name, size and mtime, so editing or replacing a
+    sample invalidates its entry automatically. Each entry records whether it
+    was parsed with exact (round-trip) floats; an exact request misses on an
+    entry that was not.
+    """
+
+    def __init__(self, directory, enabled=True):
+        self.directory = Path(directory)
+        self.cache_dir = self.directory / CACHE_DIR_NAME / "samples"
+        self.enabled = enabled
+
+    @staticmethod
+    def file_key(file_path):
+        st = Path(file_path).stat()
+        raw = f"{Path(file_path).name}|{st.st_size}|{st.st_mtime_ns}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=10).hexdigest()
+
+    def _paths(self, file_path, key):
+        stem = f"{Path(file_path).stem}-{key}"
+        return (
+            self.cache_dir / f"{stem}.json",
+            self.cache_dir / f"{stem}.npy",
+            self.cache_dir / f"{stem}.obj.npz",
+        )
+
+    @staticmethod
+    def _encode_objects(df, columns):
+        """
+        Arrays for the non-numeric columns: booleans as-is, text as a fixed-width
+        unicode array plus a missing-value mask. Columns holding anything other
+        than strings and missing values raise ValueError (left uncached).
+        """
+        arrays = {}
+        for i, name in enumerate(columns):
+            col = df[name]
+            if pd.api.types.is_bool_dtype(col):
+                arrays[f"c{i}"] = col.to_numpy(dtype=bool)
+                continue
+            missing = col.isna().to_numpy()
+            values = col.to_numpy(dtype=object)[~missing]
+            if not all(isinstance(v, str) for v in values):
+                raise ValueError(f"Column {name} is not plain text")
+            text = np.full(len(col), "", dtype=np.str_ if not len(values) else np.asarray(values, dtype=str).dtype)
+            text[~missing] = values
+            arrays[f"c{i}"] = text
+            arrays[f"c{i}_na"] = missing
+        return arrays
+
+    @staticmethod
+    def _decode_objects(arrays, columns, dtypes):
+        decoded = {}
+        for i, name in enumerate(columns):
+            values = arrays[f"c{i}"]
+            if values.dtype == bool:
+                decoded[name] = pd.Series(values)
+                continue
+            col = values.astype(object)
+            col[arrays[f"c{i}_na"]] = np.nan
+            col = pd.Series(col, dtype=object)
+            # Text columns come back as parsed: object, or pandas' string dtype
+            decoded[name] = col if dtypes[name] == "object" else col.astype(dtypes[name])
+        return decoded
+
+    def get(self, file_path, exact=False):
+        """Return the cached DataFrame for file_path, or None on a miss."""
+        if not self.enabled:
+            return None
+        try:
+            meta_path, npy_path, obj_path = self._paths(file_path, self.file_key(file_path))
+            if not meta_path.exists():
+                return None
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if exact and not meta.get("exact_floats", False):
+                return None
+
+            block = np.load(npy_path, mmap_mode="r")
+            columns = {}
+            for i, name in enumerate(meta["numeric_columns"]):
+                columns[name] = block[:, i].astype(meta["dtypes"][name], copy=False)
+            if meta["object_columns"]:
+                with np.load(obj_path, allow_pickle=False) as arrays:
+                    columns.update(self._decode_objects(arrays, meta["object_columns"], meta["object_dtypes"]))
+            return pd.DataFrame({name: columns[name] for name in meta["columns"]})
+        except Exception:
+            # A corrupt or partially written entry is treated as a miss
+            return None
+
+    def put(self, file_path, df, exact=False):
+        if not self.enabled:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            key = self.file_key(file_path)
+            meta_path, npy_path, obj_path = self._paths(file_path, key)
+
+            numeric_cols = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c]) and not pd.api.types.is_bool_dtype(df[c])]
+            object_cols = [c for c in df.columns if c not in numeric_cols]
+
+            block = np.ascontiguousarray(df[numeric_cols].to_numpy()) if numeric_cols else np.empty((len(df), 0))
+            tmp_npy = npy_path.with_name(npy_path.name + ".tmp")
+            with open(tmp_npy, "wb") as f:
+                np.save(f, block)
+            os.replace(tmp_npy, npy_path)
+
+            if object_cols:
+                tmp_obj = obj_path.with_name(obj_path.stem + ".tmp.npz")
+                np.savez(tmp_obj, **self._encode_objects(df, object_cols))
+                os.replace(tmp_obj, obj_path)
+
+            meta = {
+                "source": Path(file_path).name,
+                "columns": [str(c) for c in df.columns],
+                "numeric_columns": [str(c) for c in numeric_cols],
+                "object_columns": [str(c) for c in object_cols],
+                "dtypes": {str(c): str(df[c].dtype) for c in numeric_cols},
+                "object_dtypes": {str(c): str(df[c].dtype) for c in object_cols},
+                "exact_floats": bool(exact),
+            }
+            # Manifest is written last so an interrupted put is never read back
+            tmp_meta = meta_path.with_name(meta_path.name + ".tmp")
+            with open(tmp_meta, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_meta, meta_path)
+        except (OSError, ValueError, TypeError):
+            # Read-only or full disk, or columns that cannot be stored: loading still works, just uncached
+            pass
+
+    def prune(self, file_paths):
+        """Delete entries that do not belong to the current version of file_paths."""
+        if not self.enabled or not self.cache_dir.exists():
+            return
+        live = set()
+        for fp in file_paths:
+            try:
+                live.update(p.name for p in self._paths(fp, self.file_key(fp)))
+            except OSError:
+                continue
+        for p in self.cache_dir.iterdir():
+            if p.name not in live:
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
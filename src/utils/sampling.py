@@ -0,0 +1,77 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+class RowSampler:
+    """
+    Seeded per-file row sampler (cap and/or fraction).
+
+    Every row gets a uniform random key from a generator seeded by
+    (seed, file name). A row is kept when its key is below ``fraction`` and
+    among the ``max_rows`` smallest such keys. Because the keys depend only on
+    the row position, streaming a file in chunks (reservoir over the smallest
+    keys) and selecting from a fully indexed array give the same rows.
+    """
+
+    def __init__(self, max_rows=None, fraction=None, seed=0, name=""):
+        if max_rows is not None and max_rows <= 0:
+            max_rows = None
+        if fraction is not None and not (0.0 < fraction <= 1.0):
+            raise ValueError(f"Sampling fraction must be in (0, 1], got {fraction}")
+        self.max_rows = max_rows
+        self.fraction = None if fraction in (None, 1.0) else fraction
+        self.rng = np.random.default_rng([int(seed or 0), zlib.crc32(str(name).encode("utf-8"))])
+
+    @property
+    def active(self):
+        return self.max_rows is not None or self.fraction is not None
+
+    def _keep(self, keys):
+        """Positions (unsorted) of the rows to keep from a key vector."""
+        positions = np.flatnonzero(keys < self.fraction) if self.fraction is not None else np.arange(len(keys))
+        if self.max_rows is not None and len(positions) > self.max_rows:
+            top = np.argpartition(keys[positions], self.max_rows - 1)[:self.max_rows]
+            positions = positions[top]
+        return positions
+
+    def select(self, n_rows):
+        """Sorted row indices to keep out of n_rows (for sources that can be indexed directly)."""
+        keys = self.rng.random(n_rows)
+        return np.sort(self._keep(keys))
+
+    def sample_chunks(self, chunks):
+        """
+        Reservoir-sample an iterable of DataFrame chunks. Only the current
+        reservoir and one chunk are held at a time.
+
+        Returns (sampled DataFrame in original row order, original row indices).
+        """
+        kept_df = None
+        kept_keys = np.empty(0)
+        kept_idx = np.empty(0, dtype=np.int64)
+        offset = 0
+        for chunk in chunks:
+            keys = self.rng.random(len(chunk))
+            local = self._keep(keys)
+            candidates_df = chunk.iloc[local]
+            candidates_keys = keys[local]
+            candidates_idx = local.astype(np.int64) + offset
+            offset += len(chunk)
+
+            if kept_df is None:
+                kept_df, kept_keys, kept_idx = candidates_df, candidates_keys, candidates_idx
+            else:
+                kept_df = pd.concat([kept_df, candidates_df], ignore_index=True)
+                kept_keys = np.concatenate([kept_keys, candidates_keys])
+                kept_idx = np.concatenate([kept_idx, candidates_idx])
+
+            if self.max_rows is not None and len(kept_keys) > self.max_rows:
+                top = np.argpartition(kept_keys, self.max_rows - 1)[:self.max_rows]
+                kept_df, kept_keys, kept_idx = kept_df.iloc[top], kept_keys[top], kept_idx[top]
+
+        if kept_df is None:
+            return None, kept_idx
+        order = np.argsort(kept_idx, kind="stable")
+        return kept_df.iloc[order].reset_index(drop=True), kept_idx[order]
@@ -0,0 +1,15 @@
+import numpy as np
+
+from src.analysis.dim_reduction import DimReductionManager
+from src.utils.data_loader import DataLoader
+
+
+def test_run_3d_reduction_tsne():
+    data = np.random.RandomState(0).normal(size=(60, 4))
+    manager = DimReductionManager(DataLoader())
+    manager.set_custom_data(data)
+
+    embedding = manager.run_3d_reduction(method='tsne', perplexity=5, random_state=0)
+
+    assert embedding.shape == (60, 3)
+    assert np.isfinite(embedding).all()